@@ -6,6 +6,8 @@ import structlog
 import tree_sitter_iml
 from tree_sitter import Language, Parser
 
+from iml_query.pipeline import read_sources
+
 logger = structlog.get_logger()
 
 
@@ -170,7 +172,11 @@ def compare_file_parsing(file_path, max_depth=None, write_files=False):
         return
 
     code = file_path.read_text()
+    compare_source_parsing(file_path, code, max_depth, write_files)
+
 
+def compare_source_parsing(file_path, code, max_depth=None, write_files=False):
+    """Compare parsing results for the content of a file."""
     # Parse with both parsers
     logger.info(f'Analyzing file: {file_path.name}')
     ocaml_result = parse_with_parser(code, use_iml=False, max_depth=max_depth)
@@ -224,36 +230,38 @@ def main():
         logger.error(f'Examples directory {examples_dir} not found')
         return
 
-    # Find all matching files
-    example_files = list(examples_dir.glob(args.pattern))
+    # Files are listed, read and analyzed one at a time; `Path.glob` keeps
+    # patterns with directories such as `sub/*.iml` or `**/*.iml`
+    sources = read_sources(examples_dir.glob(args.pattern))
 
-    if not example_files:
+    # Process files
+    n_files = _process_files(sources, args.max_depth, args.write_files)
+
+    if n_files == 0:
         logger.error(
             f'No files found matching pattern {args.pattern} in {examples_dir}'
         )
-        return
-
-    # Process files
-    _process_files(example_files, args.max_depth, args.write_files)
-
-
-def _process_files(example_files, max_depth, write_files):
-    """Process all example files and generate comparison results."""
-    summary_msg = f'Found {len(example_files)} files to analyze:'
-    logger.info(summary_msg)
 
-    for file in sorted(example_files):
-        file_msg = f'  - {file.name}'
-        logger.info(file_msg)
 
-    # Compare parsing for each file
-    for file_path in sorted(example_files):
-        compare_file_parsing(
-            file_path, max_depth=max_depth, write_files=write_files
+def _process_files(sources, max_depth, write_files):
+    """Process example files as they are read and return their number."""
+    n_files = 0
+    for source in sources:
+        n_files += 1
+        if source.error is not None:
+            logger.error(f'Could not read {source.path}: {source.error}')
+            continue
+        compare_source_parsing(
+            source.path,
+            source.text,
+            max_depth=max_depth,
+            write_files=write_files,
         )
 
-    completion_msg = f'Analysis complete for {len(example_files)} files'
-    logger.info(completion_msg)
+    if n_files:
+        completion_msg = f'Analysis complete for {n_files} files'
+        logger.info(completion_msg)
+    return n_files
 
 
 if __name__ == '__main__':
@@ -0,0 +1,285 @@
+"""Asyncio counterparts of the parsing and extraction functions.
+
+The tree-sitter work runs in a bounded thread pool so that it does not block
+the event loop. Each worker thread uses its own parser (see `ParserPool`).
+
+Cancelling the awaiting task, e.g. with `asyncio.timeout`, also stops the
+work in the thread: a parse in progress is aborted at the next chunk of
+input, a query at the next progress check, and the remaining steps are
+skipped.
+
+Example:
+    async with asyncio.timeout(1):
+        outline = await aiml_outline(iml)
+
+"""
+
+import asyncio
+import os
+import threading
+import weakref
+from collections.abc import Callable
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any
+
+from tree_sitter import Node, Query, Tree
+
+from iml_query.instrumentation import span
+from iml_query.processing import (
+    extract_decomp_reqs,
+    extract_instance_reqs,
+    extract_verify_reqs,
+    iml_outline,
+)
+from iml_query.tree_sitter_utils import (
+    QueryMatches,
+    Source,
+    TreeCache,
+    get_language,
+    get_parser,
+    get_tree_cache,
+    run_query,
+    source_bytes,
+)
+
+# Size of the chunks handed to the parser, between two cancellation checks
+_PARSE_CHUNK_SIZE = 64 * 1024
+# Size of the chunks read by `Node.text` once the parse is done
+_TEXT_CHUNK_SIZE = 1024
+
+
+class _CancelledError(Exception):
+    """Raised in a worker thread when the awaiting task was cancelled."""
+
+
+class AsyncExecutor:
+    """Run blocking tree-sitter work from asyncio code.
+
+    Arguments:
+        max_workers: number of worker threads, as for `ThreadPoolExecutor`
+        max_concurrency: maximum number of calls running or queued in the
+            thread pool at once, per event loop; other calls wait without
+            holding a thread. Defaults to the number of worker threads.
+
+    """
+
+    def __init__(
+        self,
+        max_workers: int | None = None,
+        max_concurrency: int | None = None,
+    ) -> None:
+        if max_workers is None:
+            # Same default as ThreadPoolExecutor
+            max_workers = min(32, (os.cpu_count() or 1) + 4)
+        self._executor = ThreadPoolExecutor(
+            max_workers=max_workers, thread_name_prefix='iml-query'
+        )
+        if max_concurrency is None:
+            max_concurrency = max_workers
+        if max_concurrency < 1:
+            raise ValueError('max_concurrency must be positive')
+        self.max_concurrency: int = max_concurrency
+        # asyncio primitives are bound to the loop they are first used in
+        self._semaphores: weakref.WeakKeyDictionary[
+            asyncio.AbstractEventLoop, asyncio.Semaphore
+        ] = weakref.WeakKeyDictionary()
+
+    def _semaphore(self, loop: asyncio.AbstractEventLoop) -> asyncio.Semaphore:
+        semaphore = self._semaphores.get(loop)
+        if semaphore is None:
+            semaphore = self._semaphores[loop] = asyncio.Semaphore(
+                self.max_concurrency
+            )
+        return semaphore
+
+    async def run[T](self, func: Callable[[threading.Event], T]) -> T:
+        """Run `func` in a worker thread and return its result.
+
+        `func` receives an event that is set when the awaiting task is
+        cancelled, and should stop early when it is.
+        """
+        loop = asyncio.get_running_loop()
+        async with self._semaphore(loop):
+            cancelled = threading.Event()
+            future = loop.run_in_executor(self._executor, func, cancelled)
+            try:
+                return await asyncio.shield(future)
+            except asyncio.CancelledError:
+                cancelled.set()
+                # Hold the concurrency slot until the thread is done
+                await asyncio.wait([future])
+                if not future.cancelled():
+                    future.exception()  # the result is discarded
+                raise
+
+    def shutdown(self, wait: bool = True) -> None:
+        self._executor.shutdown(wait=wait)
+
+
+_default_executor: AsyncExecutor | None = None
+_default_executor_lock = threading.Lock()
+
+
+def get_default_executor() -> AsyncExecutor:
+    """Return the executor used when none is given, creating it if needed."""
+    global _default_executor
+    with _default_executor_lock:
+        if _default_executor is None:
+            _default_executor = AsyncExecutor()
+        return _default_executor
+
+
+def set_default_executor(executor: AsyncExecutor) -> None:
+    global _default_executor
+    with _default_executor_lock:
+        _default_executor = executor
+
+
+def _check_cancelled(cancelled: threading.Event) -> None:
+    if cancelled.is_set():
+        raise _CancelledError
+
+
+def _parse(
+    iml: Source,
+    old_tree: Tree | None,
+    ocaml: bool,
+    cancelled: threading.Event,
+) -> Tree:
+    src = source_bytes(iml)
+    tree_cache = get_tree_cache()
+    key = TreeCache.key(get_language(ocaml), src)
+    if old_tree is None and (tree := tree_cache.get(key)) is not None:
+        return tree.copy()
+    parser = get_parser(ocaml)
+    parsed = False
+
+    def read(byte_offset: int, _point: tuple[int, int]) -> bytes:
+        if parsed:
+            # `Node.text` reads from the start of the node through `read`:
+            # smaller chunks avoid copying far past its end
+            return bytes(src[byte_offset : byte_offset + _TEXT_CHUNK_SIZE])
+        # Ending the input early makes the parser return at once
+        if cancelled.is_set():
+            return b''
+        return bytes(src[byte_offset : byte_offset + _PARSE_CHUNK_SIZE])
+
+    with span('parse' if old_tree is None else 'reparse', bytes=len(src)) as s:
+        if old_tree is None:
+            tree = parser.parse(read)
+        else:
+            tree = parser.parse(read, old_tree)
+        _check_cancelled(cancelled)
+        parsed = True
+        if s is not None:
+            s.nodes = tree.root_node.descendant_count
+    tree_cache.put(key, tree)
+    return tree.copy()
+
+
+async def aparse(
+    iml: Source,
+    old_tree: Tree | None = None,
+    *,
+    ocaml: bool = False,
+    executor: AsyncExecutor | None = None,
+) -> Tree:
+    """Parse IML code without blocking the event loop."""
+    executor = executor or get_default_executor()
+    return await executor.run(
+        lambda cancelled: _parse(iml, old_tree, ocaml, cancelled)
+    )
+
+
+async def arun_query(
+    query: Query,
+    *,
+    code: Source | None = None,
+    node: Node | None = None,
+    executor: AsyncExecutor | None = None,
+) -> QueryMatches:
+    """Run a query on the given code or node, see `run_query`.
+
+    If the task is cancelled while the query runs, the matches found so far
+    are discarded.
+    """
+    if (code is None) == (node is None):
+        raise ValueError('Exactly one of code or node must be provided')
+    executor = executor or get_default_executor()
+
+    def work(cancelled: threading.Event) -> QueryMatches:
+        def progress(_done: int, _total: int) -> bool:
+            return cancelled.is_set()
+
+        target = node
+        if code is not None:
+            target = _parse(code, None, False, cancelled).root_node
+        _check_cancelled(cancelled)
+        return run_query(query, node=target, progress_callback=progress)
+
+    return await executor.run(work)
+
+
+async def aiml_outline(
+    iml: Source,
+    tree: Tree | None = None,
+    *,
+    executor: AsyncExecutor | None = None,
+) -> dict[str, Any]:
+    """Summarize IML code without blocking the event loop, see `iml_outline`."""
+    executor = executor or get_default_executor()
+
+    def work(cancelled: threading.Event) -> dict[str, Any]:
+        parsed = tree or _parse(iml, None, False, cancelled)
+        _check_cancelled(cancelled)
+        return iml_outline(iml, parsed)
+
+    return await executor.run(work)
+
+
+async def _aextract[S: (str, bytes)](
+    extract: Callable[[S, Tree], tuple[S, Tree, list[dict[str, Any]]]],
+    iml: S,
+    tree: Tree | None,
+    executor: AsyncExecutor | None,
+) -> tuple[S, Tree, list[dict[str, Any]]]:
+    executor = executor or get_default_executor()
+
+    def work(
+        cancelled: threading.Event,
+    ) -> tuple[S, Tree, list[dict[str, Any]]]:
+        parsed = tree or _parse(iml, None, False, cancelled)
+        _check_cancelled(cancelled)
+        return extract(iml, parsed)
+
+    return await executor.run(work)
+
+
+async def aextract_verify_reqs[S: (str, bytes)](
+    iml: S,
+    tree: Tree | None = None,
+    *,
+    executor: AsyncExecutor | None = None,
+) -> tuple[S, Tree, list[dict[str, Any]]]:
+    """Async `extract_verify_reqs`; the code is parsed if `tree` is None."""
+    return await _aextract(extract_verify_reqs, iml, tree, executor)
+
+
+async def aextract_instance_reqs[S: (str, bytes)](
+    iml: S,
+    tree: Tree | None = None,
+    *,
+    executor: AsyncExecutor | None = None,
+) -> tuple[S, Tree, list[dict[str, Any]]]:
+    """Async `extract_instance_reqs`; the code is parsed if `tree` is None."""
+    return await _aextract(extract_instance_reqs, iml, tree, executor)
+
+
+async def aextract_decomp_reqs[S: (str, bytes)](
+    iml: S,
+    tree: Tree | None = None,
+    *,
+    executor: AsyncExecutor | None = None,
+) -> tuple[S, Tree, list[dict[str, Any]]]:
+    """Async `extract_decomp_reqs`; the code is parsed if `tree` is None."""
+    return await _aextract(extract_decomp_reqs, iml, tree, executor)
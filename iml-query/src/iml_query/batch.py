@@ -0,0 +1,157 @@
+"""Run IML processing over many files with a process pool."""
+
+import os
+from collections.abc import Callable, Iterable, Iterator
+from concurrent.futures import ProcessPoolExecutor
+from dataclasses import dataclass
+from itertools import repeat
+from pathlib import Path
+from typing import Any
+
+from iml_query.processing import extract_reqs_source, outline_source
+from iml_query.queries import OUTLINE_QUERIES
+from iml_query.tree_sitter_utils import (
+    get_parser,
+    merge_queries,
+    mk_query,
+    precompile_queries,
+)
+
+
+@dataclass(slots=True, frozen=True)
+class FileResult[T]:
+    """Result of processing one file.
+
+    Exactly one of `result` and `error` is set.
+    """
+
+    path: Path
+    result: T | None = None
+    error: str | None = None
+
+    @property
+    def ok(self) -> bool:
+        return self.error is None
+
+
+def init_worker() -> None:
+    """Warm up the parser and the query cache of a worker process.
+
+    Besides the built-in queries, this compiles the merged query run by
+    `iml_outline`.
+    """
+    get_parser()
+    precompile_queries()
+    mk_query(merge_queries(OUTLINE_QUERIES))
+
+
+def _process_file[T](func: Callable[[str], T], path: Path) -> FileResult[T]:
+    try:
+        iml = path.read_text(encoding='utf-8')
+        return FileResult(path, result=func(iml))
+    except Exception as e:
+        return FileResult(path, error=f'{type(e).__name__}: {e}')
+
+
+def _process_chunk[T](
+    func: Callable[[str], T], paths: list[Path]
+) -> list[FileResult[T]]:
+    return [_process_file(func, path) for path in paths]
+
+
+def _chunks(paths: list[Path], size: int) -> Iterator[list[Path]]:
+    for i in range(0, len(paths), size):
+        yield paths[i : i + size]
+
+
+def map_files[T](
+    func: Callable[[str], T],
+    paths: Iterable[str | os.PathLike[str]],
+    *,
+    workers: int | None = None,
+    chunksize: int | None = None,
+) -> Iterator[FileResult[T]]:
+    """Apply `func` to the content of each file across worker processes.
+
+    Arguments:
+        func: module-level (picklable) function of the file content; its
+            result must be picklable
+        paths: files to process
+        workers: number of processes, `os.cpu_count()` by default; with 0
+            the files are processed in the calling process
+        chunksize: number of files sent to a worker at once, chosen from the
+            number of files and workers by default
+
+    Returns:
+        One `FileResult` per path, in the order of `paths`. A failure on one
+        file is reported in its result and does not stop the batch.
+
+    """
+    path_list = [Path(p) for p in paths]
+    if workers is None:
+        workers = os.cpu_count() or 1
+    if workers < 0:
+        raise ValueError('workers must be non-negative')
+    if chunksize is None:
+        # A few chunks per worker balances the load without paying the
+        # inter-process overhead for every file
+        chunksize = max(1, min(64, len(path_list) // (max(workers, 1) * 4)))
+    elif chunksize < 1:
+        raise ValueError('chunksize must be positive')
+
+    if workers == 0 or len(path_list) <= 1:
+        return _map_files_in_process(func, path_list)
+    return _map_files_in_pool(func, path_list, workers, chunksize)
+
+
+def _map_files_in_process[T](
+    func: Callable[[str], T], paths: list[Path]
+) -> Iterator[FileResult[T]]:
+    init_worker()
+    for path in paths:
+        yield _process_file(func, path)
+
+
+def _map_files_in_pool[T](
+    func: Callable[[str], T], paths: list[Path], workers: int, chunksize: int
+) -> Iterator[FileResult[T]]:
+    with ProcessPoolExecutor(
+        max_workers=min(workers, len(paths)), initializer=init_worker
+    ) as executor:
+        for results in executor.map(
+            _process_chunk, repeat(func), _chunks(paths, chunksize)
+        ):
+            yield from results
+
+
+def outline_many(
+    paths: Iterable[str | os.PathLike[str]],
+    *,
+    workers: int | None = None,
+    chunksize: int | None = None,
+) -> list[FileResult[dict[str, Any]]]:
+    """Compute the `iml_outline` of many files in parallel.
+
+    Example:
+        for res in outline_many(Path('models').rglob('*.iml'), workers=8):
+            if not res.ok:
+                print(res.path, res.error)
+
+    """
+    return list(
+        map_files(outline_source, paths, workers=workers, chunksize=chunksize)
+    )
+
+
+def extract_reqs_many(
+    paths: Iterable[str | os.PathLike[str]],
+    *,
+    workers: int | None = None,
+    chunksize: int | None = None,
+) -> list[FileResult[dict[str, list[dict[str, Any]]]]]:
+    """Collect the verify, instance and decomp requests of many files."""
+    return list(
+        map_files(
+            extract_reqs_source, paths, workers=workers, chunksize=chunksize
+        )
+    )
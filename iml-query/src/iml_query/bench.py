@@ -0,0 +1,326 @@
+"""Benchmarks of the parse, query, outline and edit paths.
+
+Run `iml-query-bench --help` for the options. Results are printed, or
+written with `--output`, as JSON; with `--baseline`, the run fails when a
+case is slower than in the baseline by more than `--max-regression`.
+
+Example:
+    iml-query-bench --sizes 100,1000 --output baseline.json
+    iml-query-bench --sizes 100,1000 --baseline baseline.json
+
+"""
+
+import argparse
+import json
+import platform
+import re
+import statistics
+import sys
+import time
+from collections.abc import Callable, Iterable, Sequence
+from dataclasses import asdict, dataclass
+from pathlib import Path
+from typing import Any
+
+from tree_sitter import Tree
+
+from iml_query.processing import (
+    collect_verify_reqs,
+    extract_decomp_reqs,
+    extract_instance_reqs,
+    extract_verify_reqs,
+    iml_outline,
+)
+from iml_query.queries import OUTLINE_QUERIES, VALUE_DEFINITION_QUERY_SRC
+from iml_query.tree_sitter_utils import (
+    clear_tree_cache,
+    delete_nodes,
+    get_parser,
+    insert_lines,
+    mk_query,
+    run_queries,
+    run_query,
+)
+from iml_query.utils import package_version
+from iml_query.workload import WorkloadSpec, generate_iml
+
+DEFAULT_SIZES = (10, 100, 1000)
+
+
+@dataclass(slots=True, frozen=True)
+class BenchInput:
+    name: str
+    sources: list[str]
+
+    @property
+    def n_bytes(self) -> int:
+        return sum(len(src.encode('utf-8')) for src in self.sources)
+
+
+@dataclass(slots=True, frozen=True)
+class BenchResult:
+    case: str
+    input: str
+    bytes: int
+    repeat: int
+    min_ms: float
+    mean_ms: float
+    p50_ms: float
+    p90_ms: float
+    p99_ms: float
+    mb_per_s: float
+
+
+_CORPUS_HEADER = re.compile(r'^=+\n.*?\n=+\n', re.MULTILINE | re.DOTALL)
+
+
+def corpus_sources(corpus_dir: Path) -> list[str]:
+    """Extract the code of the tree-sitter test cases in `corpus_dir/*.txt`."""
+    sources: list[str] = []
+    for path in sorted(corpus_dir.glob('*.txt')):
+        text = path.read_text(encoding='utf-8')
+        for case in _CORPUS_HEADER.split(text)[1:]:
+            code, _, _ = case.partition('\n---\n')
+            sources.append(code.strip('\n') + '\n')
+    return sources
+
+
+def _percentile(sorted_values: Sequence[float], q: float) -> float:
+    if len(sorted_values) == 1:
+        return sorted_values[0]
+    return statistics.quantiles(sorted_values, n=100, method='inclusive')[
+        int(q) - 1
+    ]
+
+
+def _time(func: Callable[[], object], repeat: int, warmup: int) -> list[float]:
+    for _ in range(warmup):
+        func()
+    timings: list[float] = []
+    for _ in range(repeat):
+        start = time.perf_counter_ns()
+        func()
+        timings.append((time.perf_counter_ns() - start) / 1e6)
+    return timings
+
+
+def _cases(
+    sources: list[str], trees: list[Tree]
+) -> dict[str, Callable[[], object]]:
+    """Build one closure per benchmarked function over all `sources`.
+
+    `iml_outline` parses each source itself, with an empty tree cache, so
+    that parsing is timed on every iteration. The `extract_*_reqs` cases
+    include building the code with the requests removed.
+    """
+    pairs = list(zip(sources, trees, strict=True))
+    encoded = [src.encode('utf-8') for src in sources]
+    value_def_query = mk_query(VALUE_DEFINITION_QUERY_SRC)
+    verify_nodes = [collect_verify_reqs(src, tree).nodes for src, tree in pairs]
+
+    def each(func: Callable[[str, Tree], object]) -> Callable[[], None]:
+        def run() -> None:
+            for src, tree in pairs:
+                func(src, tree)
+
+        return run
+
+    def cold(func: Callable[[str], object]) -> Callable[[], None]:
+        def run() -> None:
+            for src in sources:
+                clear_tree_cache()
+                func(src)
+
+        return run
+
+    def parse() -> None:
+        parser = get_parser()
+        for src in encoded:
+            parser.parse(src)
+
+    def delete() -> None:
+        for (src, tree), nodes in zip(pairs, verify_nodes, strict=True):
+            delete_nodes(src, tree, nodes=nodes)
+
+    return {
+        'parse': parse,
+        'run_query': each(
+            lambda _, tree: run_query(value_def_query, node=tree.root_node)
+        ),
+        'run_queries': each(
+            lambda _, tree: run_queries(OUTLINE_QUERIES, tree.root_node)
+        ),
+        'iml_outline': cold(iml_outline),
+        'delete_nodes': delete,
+        'insert_lines': each(
+            lambda src, tree: insert_lines(
+                src,
+                tree,
+                lines=['verify (fun x -> x = x)'],
+                insert_after=tree.root_node.end_point[0] // 2,
+            )
+        ),
+        'extract_verify_reqs': each(extract_verify_reqs),
+        'extract_instance_reqs': each(extract_instance_reqs),
+        'extract_decomp_reqs': each(extract_decomp_reqs),
+    }
+
+
+def run_benchmarks(
+    inputs: Iterable[BenchInput],
+    *,
+    repeat: int = 20,
+    warmup: int = 3,
+    cases: Sequence[str] | None = None,
+) -> list[BenchResult]:
+    """Time every case over every input."""
+    results: list[BenchResult] = []
+    for bench_input in inputs:
+        trees = [
+            get_parser().parse(src.encode('utf-8'))
+            for src in bench_input.sources
+        ]
+        for case, func in _cases(bench_input.sources, trees).items():
+            if cases is not None and case not in cases:
+                continue
+            timings = sorted(_time(func, repeat, warmup))
+            p50 = _percentile(timings, 50)
+            results.append(
+                BenchResult(
+                    case=case,
+                    input=bench_input.name,
+                    bytes=bench_input.n_bytes,
+                    repeat=repeat,
+                    min_ms=timings[0],
+                    mean_ms=statistics.fmean(timings),
+                    p50_ms=p50,
+                    p90_ms=_percentile(timings, 90),
+                    p99_ms=_percentile(timings, 99),
+                    mb_per_s=(
+                        bench_input.n_bytes / 1e6 / (p50 / 1e3)
+                        if p50 > 0
+                        else float('inf')
+                    ),
+                )
+            )
+    return results
+
+
+def report(results: list[BenchResult]) -> dict[str, Any]:
+    return {
+        'meta': {
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'tree-sitter': package_version('tree-sitter'),
+            'tree-sitter-iml': package_version('tree-sitter-iml'),
+            'iml-query': package_version('iml-query'),
+        },
+        'results': [asdict(r) for r in results],
+    }
+
+
+def compare(
+    results: list[BenchResult],
+    baseline: dict[str, Any],
+    max_regression: float,
+) -> list[str]:
+    """Return a message for each case slower than in `baseline`.
+
+    A case regresses when its median time exceeds the baseline median by
+    more than `max_regression` (e.g. 0.2 for 20%). Cases missing from the
+    baseline are ignored.
+    """
+    baseline_p50 = {
+        (r['case'], r['input']): r['p50_ms'] for r in baseline['results']
+    }
+    regressions: list[str] = []
+    for r in results:
+        base = baseline_p50.get((r.case, r.input))
+        if base is None or base <= 0:
+            continue
+        ratio = r.p50_ms / base
+        if ratio > 1 + max_regression:
+            regressions.append(
+                f'{r.case} [{r.input}]: p50 {r.p50_ms:.3f} ms vs '
+                f'{base:.3f} ms in baseline ({ratio - 1:+.0%})'
+            )
+    return regressions
+
+
+def _parse_args(argv: Sequence[str] | None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(
+        prog='iml-query-bench',
+        description='Benchmarks of the parse, query, outline and edit paths.',
+    )
+    parser.add_argument(
+        '--sizes',
+        default=','.join(map(str, DEFAULT_SIZES)),
+        help='comma-separated numbers of synthetic definitions '
+        '(default: %(default)s)',
+    )
+    parser.add_argument(
+        '--corpus',
+        type=Path,
+        help='directory of tree-sitter corpus files (e.g. test/corpus)',
+    )
+    parser.add_argument(
+        '--seed', type=int, default=0, help='seed of the synthetic inputs'
+    )
+    parser.add_argument('--repeat', type=int, default=20)
+    parser.add_argument('--warmup', type=int, default=3)
+    parser.add_argument(
+        '--cases', help='comma-separated cases to run (default: all)'
+    )
+    parser.add_argument('--output', type=Path, help='write the JSON here')
+    parser.add_argument(
+        '--baseline', type=Path, help='JSON of an earlier run to compare to'
+    )
+    parser.add_argument(
+        '--max-regression',
+        type=float,
+        default=0.2,
+        help='allowed slowdown of the median vs the baseline '
+        '(default: %(default)s)',
+    )
+    return parser.parse_args(argv)
+
+
+def main(argv: Sequence[str] | None = None) -> int:
+    args = _parse_args(argv)
+    if args.repeat < 1:
+        raise SystemExit('--repeat must be positive')
+
+    inputs = [
+        BenchInput(
+            f'synthetic-{n}',
+            [generate_iml(WorkloadSpec(definitions=n), seed=args.seed)],
+        )
+        for n in (int(s) for s in args.sizes.split(',') if s)
+    ]
+    if args.corpus is not None:
+        inputs.append(BenchInput('corpus', corpus_sources(args.corpus)))
+
+    results = run_benchmarks(
+        inputs,
+        repeat=args.repeat,
+        warmup=args.warmup,
+        cases=args.cases.split(',') if args.cases else None,
+    )
+    output = json.dumps(report(results), indent=2)
+    if args.output is not None:
+        args.output.write_text(output + '\n', encoding='utf-8')
+    else:
+        print(output)
+
+    if args.baseline is not None:
+        baseline = json.loads(args.baseline.read_text(encoding='utf-8'))
+        regressions = compare(results, baseline, args.max_regression)
+        for message in regressions:
+            print(f'REGRESSION {message}', file=sys.stderr)
+        if regressions:
+            return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,335 @@
+"""Persistent on-disk cache of analysis results.
+
+Results are stored in a SQLite database, keyed by the SHA-256 of the IML
+source, the kind of analysis, and the versions of the grammar and of
+`iml_query`. Upgrading either package therefore never returns stale results.
+
+Values are stored as JSON: on hits and misses alike, results are returned as
+they come out of `json.loads`, e.g. tuples become lists.
+
+Example:
+    with AnalysisCache() as cache:
+        for path in paths:
+            outline = cache.iml_outline(path.read_text())
+
+"""
+
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+from collections.abc import Callable
+from pathlib import Path
+from typing import Any, NamedTuple
+
+from tree_sitter import Node
+
+from iml_query.processing import (
+    extract_opaque_function_names,
+    extract_reqs_source,
+    find_nested_measures,
+    find_nested_rec,
+    iml_outline,
+)
+from iml_query.tree_sitter_utils import get_language, parse
+from iml_query.utils import package_version
+
+DEFAULT_MAX_SIZE = 256 * 1024 * 1024
+
+# Access times of hits are written in batches of this size
+_TOUCH_BATCH_SIZE = 256
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS entries (
+    key TEXT PRIMARY KEY,
+    kind TEXT NOT NULL,
+    value TEXT NOT NULL,
+    size INTEGER NOT NULL,
+    accessed REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS entries_accessed ON entries (accessed);
+CREATE TABLE IF NOT EXISTS totals (
+    name TEXT PRIMARY KEY,
+    value INTEGER NOT NULL
+);
+INSERT OR IGNORE INTO totals (name, value)
+    SELECT 'size', COALESCE(SUM(size), 0) FROM entries
+    WHERE NOT EXISTS (SELECT 1 FROM totals WHERE name = 'size');
+"""
+
+
+class CacheInfo(NamedTuple):
+    hits: int
+    misses: int
+    entries: int
+    size: int
+    max_size: int
+
+
+def cache_namespace() -> str:
+    """Identify the grammar and `iml_query` versions the results depend on."""
+    language = get_language()
+    return (
+        f'tree-sitter-iml={package_version("tree-sitter-iml")};'
+        f'abi={language.abi_version};'
+        f'iml-query={package_version("iml-query")}'
+    )
+
+
+def default_cache_dir() -> Path:
+    """Return `$IML_QUERY_CACHE_DIR`, or `iml-query` in the user cache dir."""
+    if env_dir := os.environ.get('IML_QUERY_CACHE_DIR'):
+        return Path(env_dir)
+    xdg_cache = os.environ.get('XDG_CACHE_HOME')
+    base = Path(xdg_cache) if xdg_cache else Path.home() / '.cache'
+    return base / 'iml-query'
+
+
+def _range_to_dict(node: Node) -> dict[str, Any]:
+    start_point, end_point = node.start_point, node.end_point
+    return {
+        'start_point': (start_point.row, start_point.column),
+        'end_point': (end_point.row, end_point.column),
+        'start_byte': node.start_byte,
+        'end_byte': node.end_byte,
+    }
+
+
+def nested_measures_summary(iml: str) -> list[dict[str, Any]]:
+    """Serializable projection of `find_nested_measures`, without nodes."""
+    tree = parse(iml)
+    return [
+        {
+            'top_level_function_name': func['top_level_function_name'],
+            **_range_to_dict(func['node']),
+            'nested_measures': [
+                {
+                    'function_name': nested['function_name'],
+                    'level': nested['level'],
+                    **_range_to_dict(nested['node']),
+                }
+                for nested in func['nested_measures']
+            ],
+        }
+        for func in find_nested_measures(tree.root_node)
+    ]
+
+
+class AnalysisCache:
+    """Content-addressed cache of analysis results in a SQLite database.
+
+    Arguments:
+        directory: where the database is stored, `default_cache_dir()` by
+            default
+        max_size: total size in bytes of the stored values above which the
+            least recently used entries are evicted
+
+    The cache can be shared by threads and processes. The total size of
+    the values is kept up to date in the database by each `set`, so that
+    eviction does not need to scan the whole table.
+
+    """
+
+    def __init__(
+        self,
+        directory: str | os.PathLike[str] | None = None,
+        *,
+        max_size: int = DEFAULT_MAX_SIZE,
+    ) -> None:
+        if max_size < 0:
+            raise ValueError('max_size must be non-negative')
+        self.directory = (
+            Path(directory) if directory is not None else default_cache_dir()
+        )
+        self.directory.mkdir(parents=True, exist_ok=True)
+        self.path = self.directory / 'cache.sqlite3'
+        self.max_size = max_size
+        self.namespace = cache_namespace()
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._touched: dict[str, float] = {}
+        # (source, digest) of the last source hashed
+        self._last_digest: tuple[str, str] | None = None
+        self._conn = sqlite3.connect(
+            self.path, check_same_thread=False, isolation_level=None
+        )
+        self._conn.execute('PRAGMA journal_mode=WAL')
+        self._conn.execute('PRAGMA synchronous=NORMAL')
+        self._conn.executescript(_SCHEMA)
+
+    def digest(self, iml: str) -> str:
+        """Return the SHA-256 of `iml`, reusing the last one computed.
+
+        The analyses of a source share its digest, so looking up several
+        kinds of results for the same source hashes it once.
+        """
+        last = self._last_digest
+        if last is not None and last[0] == iml:
+            return last[1]
+        digest = hashlib.sha256(iml.encode('utf-8')).hexdigest()
+        self._last_digest = (iml, digest)
+        return digest
+
+    def key(self, kind: str, iml: str) -> str:
+        return f'{kind}:{self.digest(iml)}'
+
+    def _full_key(self, key: str) -> str:
+        return f'{self.namespace}:{key}'
+
+    def get(self, key: str) -> Any | None:
+        """Return the value stored under `key`, or None."""
+        full_key = self._full_key(key)
+        with self._lock:
+            row = self._conn.execute(
+                'SELECT value FROM entries WHERE key = ?', (full_key,)
+            ).fetchone()
+            if row is None:
+                return None
+            self._touched[full_key] = time.time()
+            if len(self._touched) >= _TOUCH_BATCH_SIZE:
+                self._flush_touched()
+        return json.loads(row[0])
+
+    def set(self, key: str, value: Any) -> None:
+        """Store a JSON-serializable value under `key`."""
+        payload = json.dumps(value, separators=(',', ':'))
+        size = len(payload.encode('utf-8'))
+        kind = key.split(':', 1)[0]
+        full_key = self._full_key(key)
+        with self._lock:
+            self._conn.execute('BEGIN IMMEDIATE')
+            try:
+                row = self._conn.execute(
+                    'SELECT size FROM entries WHERE key = ?', (full_key,)
+                ).fetchone()
+                self._conn.execute(
+                    'INSERT OR REPLACE INTO entries '
+                    '(key, kind, value, size, accessed) VALUES (?, ?, ?, ?, ?)',
+                    (full_key, kind, payload, size, time.time()),
+                )
+                total = self._add_size(size - (row[0] if row else 0))
+                if total > self.max_size:
+                    self._evict(total)
+                self._conn.execute('COMMIT')
+            except BaseException:
+                self._conn.execute('ROLLBACK')
+                raise
+
+    def _flush_touched(self) -> None:
+        if not self._touched:
+            return
+        self._conn.executemany(
+            'UPDATE entries SET accessed = ? WHERE key = ?',
+            [(t, k) for k, t in self._touched.items()],
+        )
+        self._touched.clear()
+
+    def _add_size(self, delta: int) -> int:
+        """Add `delta` to the total size of the values and return the total."""
+        self._conn.execute(
+            "UPDATE totals SET value = value + ? WHERE name = 'size'", (delta,)
+        )
+        (total,) = self._conn.execute(
+            "SELECT value FROM totals WHERE name = 'size'"
+        ).fetchone()
+        return total
+
+    def _evict(self, total: int) -> None:
+        """Remove least recently used entries until under `max_size`."""
+        self._flush_touched()
+        excess = total - self.max_size
+        cursor = self._conn.execute(
+            'SELECT key, size FROM entries ORDER BY accessed'
+        )
+        stale: list[tuple[str]] = []
+        freed = 0
+        for key, size in cursor:
+            if freed >= excess:
+                break
+            stale.append((key,))
+            freed += size
+        cursor.close()
+        self._conn.executemany('DELETE FROM entries WHERE key = ?', stale)
+        self._add_size(-freed)
+
+    def get_or_compute(
+        self, kind: str, iml: str, compute: Callable[[str], Any]
+    ) -> Any:
+        """Return the cached `compute(iml)`, computing and storing it on a miss.
+
+        `kind` names the analysis and must be unique per `compute` function.
+        """
+        key = self.key(kind, iml)
+        value = self.get(key)
+        if value is not None:
+            self.hits += 1
+            return value
+        self.misses += 1
+        value = compute(iml)
+        self.set(key, value)
+        return json.loads(json.dumps(value))
+
+    def iml_outline(self, iml: str) -> dict[str, Any]:
+        return self.get_or_compute('iml_outline', iml, iml_outline)
+
+    def find_nested_rec(self, iml: str) -> list[dict[str, Any]]:
+        return self.get_or_compute('find_nested_rec', iml, find_nested_rec)
+
+    def find_nested_measures(self, iml: str) -> list[dict[str, Any]]:
+        """Return the cached `nested_measures_summary` of `iml`."""
+        return self.get_or_compute(
+            'find_nested_measures', iml, nested_measures_summary
+        )
+
+    def extract_opaque_function_names(self, iml: str) -> list[str]:
+        return self.get_or_compute(
+            'opaque_functions', iml, extract_opaque_function_names
+        )
+
+    def collect_reqs(self, iml: str) -> dict[str, list[dict[str, Any]]]:
+        """Return the cached verify, instance and decomp requests of `iml`."""
+        return self.get_or_compute('reqs', iml, extract_reqs_source)
+
+    def info(self) -> CacheInfo:
+        with self._lock:
+            (entries,) = self._conn.execute(
+                'SELECT COUNT(*) FROM entries'
+            ).fetchone()
+            (size,) = self._conn.execute(
+                "SELECT value FROM totals WHERE name = 'size'"
+            ).fetchone()
+        return CacheInfo(
+            hits=self.hits,
+            misses=self.misses,
+            entries=entries,
+            size=size,
+            max_size=self.max_size,
+        )
+
+    def clear(self) -> None:
+        with self._lock:
+            self._touched.clear()
+            self._conn.execute('BEGIN IMMEDIATE')
+            try:
+                self._conn.execute('DELETE FROM entries')
+                self._conn.execute(
+                    "UPDATE totals SET value = 0 WHERE name = 'size'"
+                )
+                self._conn.execute('COMMIT')
+            except BaseException:
+                self._conn.execute('ROLLBACK')
+                raise
+
+    def close(self) -> None:
+        with self._lock:
+            self._flush_touched()
+            self._conn.close()
+
+    def __enter__(self) -> 'AnalysisCache':
+        return self
+
+    def __exit__(self, *exc_info: object) -> None:
+        self.close()
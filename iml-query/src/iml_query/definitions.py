@@ -0,0 +1,309 @@
+"""Index of the value definitions of an IML tree."""
+
+from __future__ import annotations
+
+from bisect import bisect_right
+from collections.abc import Iterable, Iterator, Sequence
+from dataclasses import dataclass
+
+from tree_sitter import Node, Range, Tree
+
+from .incremental import ItemChange, ItemSpan, ItemSpans
+from .queries import VALUE_DEFINITION_QUERY_SRC
+from .tree_sitter_utils import (
+    SourceText,
+    TreeEdit,
+    mk_query,
+    node_text,
+    run_query,
+)
+
+
+@dataclass(slots=True, frozen=True)
+class Definition:
+    """A `let` binding of a named value.
+
+    Bindings of a `let rec ... and ...` share the same `node`.
+    """
+
+    name: str
+    node: Node  # value_definition
+    binding: Node  # let_binding
+    top_level: bool
+    recursive: bool
+    measure: bool
+    opaque: bool
+
+    @property
+    def range(self) -> Range:
+        return self.node.range
+
+
+@dataclass(slots=True, frozen=True)
+class _DefEntry:
+    """Position-independent record of a definition within a top-level item.
+
+    Byte offsets are relative to the start of the top-level item, so the
+    record stays valid when the item is moved by edits elsewhere.
+    """
+
+    name: str
+    rel_start: int
+    rel_end: int
+    binding_index: int
+    top_level: bool
+    recursive: bool
+    measure: bool
+    opaque: bool
+
+
+class _Item:
+    """Definition entries of one top-level item.
+
+    `definitions` holds the entries resolved in `tree`. Nodes belong to a
+    single tree, so they are resolved again on the first lookup in a new
+    tree.
+    """
+
+    __slots__ = ('definitions', 'entries', 'span', 'tree')
+
+    def __init__(self, entries: list[_DefEntry], span: ItemSpan) -> None:
+        self.entries = entries
+        self.span = span
+        self.definitions: list[Definition] = []
+        self.tree: Tree | None = None
+
+
+class DefinitionIndex:
+    """Map value names to their definitions, top-level and nested.
+
+    The index is built by one query over the tree. After an incremental
+    reparse, `refresh` only queries the top-level items affected by the
+    edits and only updates the names they define. Definitions are resolved to
+    nodes lazily, one top-level item at a time, when they are looked up.
+
+    `items_collected` counts the top-level items collected since the index
+    was created.
+
+    Arguments:
+        tree: the tree to index
+        spans: the `ItemSpans` of `tree`, when they are shared with other
+            per-item results; the index is then moved to a new tree by
+            `apply_changes` with the changes of `ItemSpans.update`
+        source: the source of `tree`, to read names from instead of
+            `Node.text`
+
+    Example:
+        index = DefinitionIndex(tree)
+        index.first('f')  # same node as `find_func_definition(tree, 'f')`
+
+    """
+
+    def __init__(
+        self,
+        tree: Tree,
+        spans: ItemSpans | None = None,
+        *,
+        source: SourceText | None = None,
+    ) -> None:
+        self.tree = tree
+        self.items_collected = tree.root_node.child_count
+        self._spans = ItemSpans(tree) if spans is None else spans
+        root = tree.root_node
+        self._items: list[_Item] = [
+            _Item(entries, self._spans.span(i))
+            for i, entries in enumerate(
+                _collect_items(root, root.children, source)
+            )
+        ]
+        # name -> (item, index of the entry in the item), in document order
+        self._by_name: dict[str, list[tuple[_Item, int]]] = {}
+        self._count = 0
+        for item in self._items:
+            self._add(item)
+
+    def _add(self, item: _Item) -> None:
+        for i, entry in enumerate(item.entries):
+            self._by_name.setdefault(entry.name, []).append((item, i))
+        self._count += len(item.entries)
+
+    def _remove(self, item: _Item) -> None:
+        for name in {entry.name for entry in item.entries}:
+            refs = [ref for ref in self._by_name[name] if ref[0] is not item]
+            if refs:
+                self._by_name[name] = refs
+            else:
+                del self._by_name[name]
+        self._count -= len(item.entries)
+
+    def _definition(self, item: _Item, i: int) -> Definition:
+        if item.tree is not self.tree:
+            node = self._spans.node(item.span)
+            item.definitions = [_resolve(node, entry) for entry in item.entries]
+            item.tree = self.tree
+        return item.definitions[i]
+
+    def __len__(self) -> int:
+        return self._count
+
+    def __iter__(self) -> Iterator[Definition]:
+        """Iterate over all definitions in document order."""
+        for item in self._items:
+            for i in range(len(item.entries)):
+                yield self._definition(item, i)
+
+    def __contains__(self, name: object) -> bool:
+        return name in self._by_name
+
+    def get(self, name: str) -> list[Definition]:
+        """Return all definitions of `name` in document order."""
+        return [
+            self._definition(item, i) for item, i in self._by_name.get(name, [])
+        ]
+
+    def first(self, name: str) -> Definition | None:
+        """Return the first definition of `name` in document order."""
+        refs = self._by_name.get(name)
+        return self._definition(*refs[0]) if refs else None
+
+    def refresh(
+        self,
+        new_tree: Tree,
+        old_tree: Tree,
+        edits: Sequence[TreeEdit],
+        *,
+        source: SourceText | None = None,
+    ) -> None:
+        """Update the index to `new_tree` after an incremental reparse.
+
+        Arguments:
+            new_tree: the tree produced by the incremental parse
+            old_tree: the tree this index was built on, with `edits`
+                applied, i.e. the `old_tree` passed to the parser (see
+                `EditSession.edited_tree`)
+            edits: the `Tree.edit` calls applied to `old_tree`, in order (see
+                `EditSession.tree_edits`)
+            source: the source of `new_tree`, to read names from
+
+        Top-level items that were not touched by the edits, and that are not
+        in the ranges reported by `Tree.changed_ranges`, keep their entries.
+        Only the other items are queried again, and only the names defined by
+        the removed and added items are updated.
+
+        """
+        self.apply_changes(
+            new_tree,
+            self._spans.update(new_tree, old_tree, edits),
+            source=source,
+        )
+
+    def apply_changes(
+        self,
+        new_tree: Tree,
+        changes: Iterable[ItemChange],
+        *,
+        source: SourceText | None = None,
+    ) -> None:
+        """Move to `new_tree` given the items replaced by `ItemSpans.update`.
+
+        Use with the `spans` given to the constructor, updated once for all
+        their users; `refresh` updates them itself.
+        """
+        self.tree = new_tree
+        added: list[_Item] = []
+        for change in changes:
+            end = change.position + change.removed
+            for item in self._items[change.position : end]:
+                self._remove(item)
+            new_items = [
+                _Item(
+                    _collect_items(node, [node], source)[0],
+                    self._spans.span(change.position + k),
+                )
+                for k, node in enumerate(change.added)
+            ]
+            self._items[change.position : end] = new_items
+            self.items_collected += len(new_items)
+            added.extend(new_items)
+        for item in added:
+            self._add(item)
+
+        # The other items keep their relative order, so only the names of
+        # added items need to be put back in document order
+        for name in {entry.name for item in added for entry in item.entries}:
+            self._by_name[name].sort(
+                key=lambda ref: (self._spans.start(ref[0].span), ref[1])
+            )
+
+
+def _collect_items(
+    node: Node, items: Sequence[Node], source: SourceText | None
+) -> list[list[_DefEntry]]:
+    """Collect the definitions of the top-level items within `node`.
+
+    Returns the entries of each of `items`, in document order.
+    """
+    starts = [item.start_byte for item in items]
+    entries: list[list[_DefEntry]] = [[] for _ in items]
+    matches = run_query(mk_query(VALUE_DEFINITION_QUERY_SRC), node=node)
+    for _, capture in matches:
+        name = capture['function_name'][0]
+        binding = name.parent
+        if binding is None or binding.child_by_field_name('pattern') != name:
+            continue
+        definition = capture['function_definition'][0]
+        i = max(bisect_right(starts, definition.start_byte) - 1, 0)
+        entries[i].append(
+            _definition_entry(items[i], definition, binding, name, source)
+        )
+    # A definition starts before the definitions nested in its bindings
+    for item_entries in entries:
+        item_entries.sort(key=lambda e: (e.rel_start, e.binding_index))
+    return entries
+
+
+def _definition_entry(
+    item: Node,
+    node: Node,
+    binding: Node,
+    name: Node,
+    source: SourceText | None,
+) -> _DefEntry:
+    children = node.children
+    attribute_ids = {
+        node_text(attr_id, source)
+        for attr in binding.children
+        if attr.type == 'item_attribute'
+        for attr_id in attr.children
+        if attr_id.type == 'attribute_id'
+    }
+    return _DefEntry(
+        name=node_text(name, source),
+        rel_start=node.start_byte - item.start_byte,
+        rel_end=node.end_byte - item.start_byte,
+        binding_index=children.index(binding),
+        top_level=node == item,
+        recursive=any(child.type == 'rec' for child in children),
+        measure='measure' in attribute_ids,
+        opaque='opaque' in attribute_ids,
+    )
+
+
+def _resolve(item: Node, entry: _DefEntry) -> Definition:
+    """Find the nodes of a definition entry within its top-level item."""
+    start = item.start_byte + entry.rel_start
+    node = item.descendant_for_byte_range(
+        start, item.start_byte + entry.rel_end
+    )
+    while node is not None and node.type != 'value_definition':
+        node = node.parent
+    assert node is not None, 'Never: definition entry without node'
+    return Definition(
+        name=entry.name,
+        node=node,
+        binding=node.children[entry.binding_index],
+        top_level=entry.top_level,
+        recursive=entry.recursive,
+        measure=entry.measure,
+        opaque=entry.opaque,
+    )
@@ -0,0 +1,268 @@
+"""Long-lived IML document, updated incrementally by text edits."""
+
+from collections.abc import Iterable
+from itertools import chain
+from typing import Any, Literal, NotRequired, TypedDict
+
+from tree_sitter import Node, Tree
+
+from iml_query.definitions import DefinitionIndex
+from iml_query.incremental import ItemResults, ItemSpans, split_captures
+from iml_query.instrumentation import span
+from iml_query.line_index import LineIndex, end_point
+from iml_query.processing import node_outline, outline_from_captures
+from iml_query.queries import OUTLINE_QUERIES
+from iml_query.tree_sitter_utils import (
+    SourceText,
+    TreeEdit,
+    parse,
+    reparse,
+    run_queries,
+)
+
+PositionEncoding = Literal['utf-8', 'utf-16', 'utf-32']
+
+
+class Position(TypedDict):
+    """Zero-based position, as in the Language Server Protocol."""
+
+    line: int
+    character: int
+
+
+class Range(TypedDict):
+    start: Position
+    end: Position
+
+
+class ContentChange(TypedDict):
+    """Change of a document, as in LSP `TextDocumentContentChangeEvent`.
+
+    Without `range`, `text` replaces the whole document.
+    """
+
+    range: NotRequired[Range]
+    text: str
+
+
+class ImlDocument:
+    """IML source with its syntax tree and derived data, kept up to date.
+
+    Edits are applied to the tree with `Tree.edit` and followed by a single
+    incremental parse. The outline and the definition index are computed on
+    first access; after an edit, only the top-level items reported as
+    changed by the parser are analyzed again.
+
+    Arguments:
+        iml: the initial source
+        position_encoding: unit of `Position.character`; LSP uses 'utf-16'
+            unless another encoding was negotiated
+
+    Example:
+        doc = ImlDocument(iml)
+        doc.apply_changes([{'range': range_, 'text': 'x + 1'}])
+        doc.outline['verify_req']
+
+    """
+
+    def __init__(
+        self,
+        iml: str,
+        *,
+        position_encoding: PositionEncoding = 'utf-16',
+    ) -> None:
+        self.position_encoding: PositionEncoding = position_encoding
+        self.version = 0
+        src = iml.encode('utf-8')
+        self._set_source(src, parse(src))
+
+    def _set_source(self, src: bytes, tree: Tree) -> None:
+        self.src = src
+        self.tree = tree
+        self.line_index = LineIndex(src)
+        self._text: str | None = None
+        # Top-level items shared by the outline and the definition index,
+        # tracked once one of them is computed
+        self._spans: ItemSpans | None = None
+        self._outline_items: ItemResults[dict[str, Any]] | None = None
+        self._outline: dict[str, Any] | None = None
+        self._definitions: DefinitionIndex | None = None
+
+    def _item_spans(self) -> ItemSpans:
+        if self._spans is None:
+            self._spans = ItemSpans(self.tree)
+        return self._spans
+
+    @property
+    def text(self) -> str:
+        if self._text is None:
+            self._text = self.src.decode('utf-8')
+        return self._text
+
+    def byte_at(self, position: Position) -> int:
+        """Byte offset of an LSP position.
+
+        As in LSP, a character past the end of the line means the end of the
+        line, and a line past the end of the document means its end.
+        """
+        line, character = position['line'], position['character']
+        if line >= self.line_index.row_count:
+            return len(self.src)
+        start = self.line_index.line_start(line)
+        end = self.line_index.line_end(line)
+        if end > start and self.src[end - 1 : end] == b'\n':
+            end -= 1
+        if self.position_encoding == 'utf-8':
+            return min(start + character, end)
+
+        offset = start
+        units = 0
+        for char in self.src[start:end].decode('utf-8'):
+            if units >= character:
+                break
+            if self.position_encoding == 'utf-32' or ord(char) <= 0xFFFF:
+                units += 1
+            else:
+                units += 2  # surrogate pair
+            offset += len(char.encode('utf-8'))
+        return offset
+
+    def apply_changes(self, changes: Iterable[ContentChange]) -> None:
+        """Apply LSP content changes, in order, then reparse once.
+
+        Each change is expressed in the document as left by the previous
+        ones, as in `textDocument/didChange`.
+        """
+        tree: Tree | None = None
+        edits: list[TreeEdit] = []
+        for change in changes:
+            change_range = change.get('range')
+            if change_range is None:
+                src = change['text'].encode('utf-8')
+                self._set_source(src, parse(src))
+                tree = None
+                edits = []
+                continue
+            if tree is None:
+                tree = self.tree.copy()
+            start = self.byte_at(change_range['start'])
+            old_end = max(start, self.byte_at(change_range['end']))
+            edits.append(self._edit(tree, start, old_end, change['text']))
+        if tree is not None:
+            self._reparse(tree, edits)
+
+    def replace(self, start_byte: int, old_end_byte: int, text: str) -> None:
+        """Replace the bytes in [start_byte, old_end_byte) with `text`."""
+        tree = self.tree.copy()
+        edit = self._edit(tree, start_byte, old_end_byte, text)
+        self._reparse(tree, [edit])
+
+    def _edit(
+        self, tree: Tree, start_byte: int, old_end_byte: int, text: str
+    ) -> TreeEdit:
+        """Apply a text edit to the source, the line index and `tree`."""
+        if not 0 <= start_byte <= old_end_byte <= len(self.src):
+            raise ValueError(
+                f'Invalid byte range ({start_byte}, {old_end_byte}) for a '
+                f'document of {len(self.src)} bytes'
+            )
+        new_text = text.encode('utf-8')
+        with span('edit', bytes=len(self.src)):
+            start_point = self.line_index.point_at(start_byte)
+            edit = TreeEdit(
+                start_byte,
+                old_end_byte,
+                start_byte + len(new_text),
+                start_point,
+                self.line_index.point_at(old_end_byte),
+                end_point(start_point, new_text),
+            )
+            edit.apply(tree)
+            self.src = (
+                self.src[:start_byte] + new_text + self.src[old_end_byte:]
+            )
+            self._text = None
+            self.line_index.edit(start_byte, old_end_byte, new_text)
+        return edit
+
+    def _reparse(self, edited_tree: Tree, edits: list[TreeEdit]) -> None:
+        new_tree = reparse(self.src, edited_tree)
+        if self._spans is not None:
+            changes = self._spans.update(new_tree, edited_tree, edits)
+            if self._outline_items is not None:
+                self._outline_items.update(new_tree, changes)
+            if self._definitions is not None:
+                self._definitions.apply_changes(
+                    new_tree, changes, source=SourceText(self.src)
+                )
+        self._outline = None
+        self.tree = new_tree
+        self.version += 1
+
+    @property
+    def outline_items_computed(self) -> int:
+        """Number of top-level items outlined since the source was set.
+
+        Replacing the whole document resets it.
+        """
+        if self._outline_items is None:
+            return 0
+        return self._outline_items.computed
+
+    def _outline_item(self, node: Node) -> dict[str, Any]:
+        return node_outline(node, source=SourceText(self.src))
+
+    @property
+    def outline(self) -> dict[str, Any]:
+        """The `iml_outline` of the document.
+
+        The first outline comes from a single query over the tree, split by
+        top-level item; after an edit, only the replaced items are outlined
+        again. The result is cached until the next edit and must not be
+        modified.
+        """
+        if self._outline is not None:
+            return self._outline
+        root = self.tree.root_node
+        if not root.child_count:
+            self._outline = node_outline(root)
+            return self._outline
+        if self._outline_items is None:
+            self._item_spans()
+            source = SourceText(self.src)
+            self._outline_items = ItemResults(
+                self.tree,
+                self._outline_item,
+                [
+                    outline_from_captures(captures, source)
+                    for captures in split_captures(
+                        run_queries(OUTLINE_QUERIES, root), root
+                    )
+                ],
+            )
+        items = list(self._outline_items)
+        self._outline = {
+            key: list(chain.from_iterable(item[key] for item in items))
+            for key in items[0]
+        }
+        return self._outline
+
+    @property
+    def verify_reqs(self) -> list[dict[str, Any]]:
+        return self.outline['verify_req']
+
+    @property
+    def instance_reqs(self) -> list[dict[str, Any]]:
+        return self.outline['instance_req']
+
+    @property
+    def decomp_reqs(self) -> list[dict[str, Any]]:
+        return self.outline['decompose_req']
+
+    @property
+    def definitions(self) -> DefinitionIndex:
+        if self._definitions is None:
+            self._definitions = DefinitionIndex(
+                self.tree, self._item_spans(), source=SourceText(self.src)
+            )
+        return self._definitions
@@ -0,0 +1,438 @@
+"""Query results kept up to date across incremental reparses.
+
+Results are stored per top-level item. After an edit, the items that the
+edit and `Tree.changed_ranges` leave untouched keep their results, and only
+the other items are queried again. The edited spans are located by binary
+search over the item positions, and the items after an edit are moved
+lazily, so the cost of an update depends on the size of the edit rather
+than on the size of the file.
+
+Example:
+    verify = IncrementalQuery({'verify': VERIFY_QUERY_SRC}, tree)
+    session = EditSession(iml, tree)
+    session.insert_lines(['verify (fun x -> x = x)'], insert_after=3)
+    new_iml, new_tree = session.commit()
+    verify.update(new_tree, session.edited_tree, session.tree_edits)
+    verify.captures()['verify']  # nodes of new_tree
+
+"""
+
+from bisect import bisect_left, bisect_right
+from collections.abc import Callable, Iterable, Iterator, Sequence
+from dataclasses import dataclass
+from typing import NamedTuple
+
+from tree_sitter import Node, Tree
+
+from iml_query.tree_sitter_utils import TreeEdit, run_queries
+
+
+class ItemSpan:
+    """Position of a top-level item tracked by `ItemSpans`.
+
+    Items after the last edits are moved lazily, so the stored offsets may
+    lag behind: read the position with `ItemSpans.start` and `ItemSpans.end`.
+    """
+
+    __slots__ = ('end', 'shifted', 'start')
+
+    def __init__(self, start: int, end: int, shifted: bool = False) -> None:
+        self.start = start
+        self.end = end
+        # Whether the span is stored `ItemSpans._delta` bytes early
+        self.shifted = shifted
+
+
+class ItemChange(NamedTuple):
+    """Replacement of `removed` top-level items by the items `added`.
+
+    `position` is the index of the first replaced item once the previous
+    changes of the same update are applied, so the changes can be replayed
+    in order on any list with one entry per item.
+    """
+
+    position: int
+    removed: int
+    added: list[Node]
+
+
+class ItemSpans:
+    """Byte spans of the top-level items of a tree, kept across edits.
+
+    An edit moves all the items after it. Rather than updating them, the
+    items from `_pivot` on are stored `_delta` bytes before their position,
+    and the pivot follows the edits: an edit only updates the items between
+    the previous edit and itself, so a burst of edits in one place costs
+    O(log n).
+    """
+
+    def __init__(self, tree: Tree) -> None:
+        self._reset(tree)
+
+    def _reset(self, tree: Tree) -> None:
+        self.tree = tree
+        self._spans = [
+            ItemSpan(child.start_byte, child.end_byte)
+            for child in tree.root_node.children
+        ]
+        self._pivot = len(self._spans)
+        self._delta = 0
+
+    def __len__(self) -> int:
+        return len(self._spans)
+
+    def span(self, i: int) -> ItemSpan:
+        """Return the span of the `i`-th top-level item."""
+        return self._spans[i]
+
+    def start(self, span: ItemSpan) -> int:
+        return span.start + self._delta if span.shifted else span.start
+
+    def end(self, span: ItemSpan) -> int:
+        return span.end + self._delta if span.shifted else span.end
+
+    def node(self, span: ItemSpan) -> Node:
+        """Return the node of the item in the current tree."""
+        start = self.start(span)
+        node = self.tree.root_node.first_child_for_byte(start)
+        assert node is not None and node.start_byte == start, (
+            'Never: item span out of sync with the tree'
+        )
+        return node
+
+    def _move_pivot(self, i: int) -> None:
+        delta = self._delta
+        if i > self._pivot:
+            for span in self._spans[self._pivot : i]:
+                span.start += delta
+                span.end += delta
+                span.shifted = False
+        else:
+            for span in self._spans[i : self._pivot]:
+                span.start -= delta
+                span.end -= delta
+                span.shifted = True
+        self._pivot = i
+
+    def update(
+        self, new_tree: Tree, old_tree: Tree, edits: Sequence[TreeEdit]
+    ) -> list[ItemChange]:
+        """Move to `new_tree` after an incremental reparse.
+
+        Arguments:
+            new_tree: the tree produced by the incremental parse
+            old_tree: the tree of the spans, with `edits` applied, i.e. the
+                `old_tree` passed to the parser (see `EditSession.edited_tree`)
+            edits: the `Tree.edit` calls applied to `old_tree`, in order (see
+                `EditSession.tree_edits`)
+
+        Returns:
+            The replaced items, in document order. Items touched by an edit
+            or in a range reported by `Tree.changed_ranges` are replaced by
+            the items of `new_tree` at their place; the others are kept.
+
+        """
+        old_count = len(self._spans)
+        # Touched items, as ranges [i, j) of indices; i == j for a change
+        # between two items, which may still add items there
+        dirty: list[tuple[int, int]] = []
+        for edit in edits:
+            i = bisect_left(self._spans, edit.start_byte, key=self.end)
+            j = bisect_right(self._spans, edit.old_end_byte, key=self.start)
+            self._move_pivot(j)
+            # Touched items are replaced below; keep the spans sorted until
+            # then by clamping them to the edit
+            for span in self._spans[i:j]:
+                span.start = min(span.start, edit.start_byte)
+                span.end = (
+                    span.end + edit.new_end_byte - edit.old_end_byte
+                    if span.end > edit.old_end_byte
+                    else edit.new_end_byte
+                )
+            self._delta += edit.new_end_byte - edit.old_end_byte
+            dirty.append((i, j))
+        for changed in old_tree.changed_ranges(new_tree):
+            dirty.append(
+                (
+                    bisect_right(self._spans, changed.start_byte, key=self.end),
+                    bisect_left(self._spans, changed.end_byte, key=self.start),
+                )
+            )
+
+        self.tree = new_tree
+        changes: list[ItemChange] = []
+        offset = 0
+        # Index of the first old item not replaced yet
+        done = 0
+        for i, j in _merge_ranges(dirty):
+            if j < done:
+                continue
+            change = self._replace(max(i, done) + offset, j + offset)
+            done = change.position + change.removed - offset
+            if change.removed or change.added:
+                changes.append(change)
+                offset += len(change.added) - change.removed
+
+        if len(self._spans) != new_tree.root_node.child_count:
+            # Not expected from tree-sitter, but cheap to check: start over
+            self._reset(new_tree)
+            return [ItemChange(0, old_count, new_tree.root_node.children)]
+        return changes
+
+    def _in_place(self, i: int, k: int) -> bool:
+        """Whether item i has the span of child k of the new tree."""
+        root = self.tree.root_node
+        if k >= root.child_count:
+            return False
+        node = root.child(k)
+        span = self._spans[i]
+        return (
+            node is not None
+            and node.start_byte == self.start(span)
+            and node.end_byte == self.end(span)
+        )
+
+    def _replace(self, i: int, j: int) -> ItemChange:
+        """Replace items [i, j) with the new items before item j.
+
+        The range is widened until the items around it are in place: an
+        edit may also change its neighbors, e.g. by merging them with the
+        edited item, and missing nodes such as `;;` are empty items that
+        cannot be told apart from new empty items before item j. The items
+        before i are in place, so the new items start at child i
+        (`next_sibling` would skip missing nodes).
+        """
+        root = self.tree.root_node
+        while i and not self._in_place(i - 1, i - 1):
+            i -= 1
+        while True:
+            hi = self.start(self._spans[j]) if j < len(self._spans) else None
+            added: list[Node] = []
+            for k in range(i, root.child_count):
+                node = root.child(k)
+                assert node is not None
+                # Empty items at `hi` come before item j
+                if hi is not None and node.start_byte >= hi < node.end_byte:
+                    break
+                added.append(node)
+            if j == len(self._spans) or self._in_place(j, i + len(added)):
+                break
+            j += 1
+
+        # New spans are stored shifted, like the items after them
+        self._move_pivot(i)
+        self._spans[i:j] = [
+            ItemSpan(n.start_byte - self._delta, n.end_byte - self._delta, True)
+            for n in added
+        ]
+        return ItemChange(i, j - i, added)
+
+
+def _merge_ranges(ranges: list[tuple[int, int]]) -> list[tuple[int, int]]:
+    """Merge overlapping or adjacent index ranges, in order."""
+    merged: list[tuple[int, int]] = []
+    for i, j in sorted(ranges):
+        if merged and i <= merged[-1][1]:
+            merged[-1] = (merged[-1][0], max(merged[-1][1], j))
+        else:
+            merged.append((i, j))
+    return merged
+
+
+class ItemResults[T]:
+    """Value of `compute` for each top-level item of a tree.
+
+    Values are computed on first access, unless given, and kept by `update`
+    for the items not affected by an edit. They must not refer to nodes,
+    which belong to a single tree; see `IncrementalQuery` for node results.
+    """
+
+    def __init__(
+        self,
+        tree: Tree,
+        compute: Callable[[Node], T],
+        values: list[T] | None = None,
+    ) -> None:
+        self.tree = tree
+        self.compute = compute
+        self._items: list[T | None]
+        if values is None:
+            self._items = [None] * tree.root_node.child_count
+            # Number of items computed since creation, for diagnostics
+            self.computed = 0
+        else:
+            if len(values) != tree.root_node.child_count:
+                raise ValueError('values do not match the items of tree')
+            self._items = list(values)
+            self.computed = len(values)
+
+    def update(self, new_tree: Tree, changes: Iterable[ItemChange]) -> None:
+        """Move to `new_tree`, dropping the values of replaced items.
+
+        Arguments:
+            new_tree: the tree produced by the incremental parse
+            changes: the replaced items, see `ItemSpans.update`
+
+        """
+        for change in changes:
+            end = change.position + change.removed
+            self._items[change.position : end] = [None] * len(change.added)
+        if len(self._items) != new_tree.root_node.child_count:
+            raise ValueError('changes do not match the items of new_tree')
+        self.tree = new_tree
+
+    def get(self, i: int) -> T:
+        """Return the value of the `i`-th top-level item."""
+        item = self._items[i]
+        if item is None:
+            node = self.tree.root_node.child(i)
+            if node is None:
+                raise IndexError(f'No top-level item {i}')
+            item = self._items[i] = self.compute(node)
+            self.computed += 1
+        return item
+
+    def __len__(self) -> int:
+        return len(self._items)
+
+    def __iter__(self) -> Iterator[T]:
+        """Iterate over the values of all items in document order."""
+        return (self.get(i) for i in range(len(self._items)))
+
+
+type _Captures = dict[str, list[dict[str, list[Node]]]]
+
+
+def split_captures(captures: _Captures, root: Node) -> list[_Captures]:
+    """Split `run_queries` results over `root` by top-level item.
+
+    Each capture goes to the item where its first captured node starts.
+    Returns one dictionary per child of `root`, as `run_queries` would
+    return for that child.
+    """
+    starts = [child.start_byte for child in root.children]
+    items: list[_Captures] = [{} for _ in starts]
+    for name, name_captures in captures.items():
+        for capture in name_captures:
+            start = min(
+                (n.start_byte for ns in capture.values() for n in ns),
+                default=root.start_byte,
+            )
+            i = max(bisect_right(starts, start) - 1, 0)
+            items[i].setdefault(name, []).append(capture)
+    return items
+
+
+@dataclass(slots=True, frozen=True)
+class _CapturedNode:
+    """Position of a captured node relative to its top-level item."""
+
+    rel_start: int
+    rel_end: int
+    type: str
+
+    def resolve(self, item: Node) -> Node:
+        start = item.start_byte + self.rel_start
+        end = item.start_byte + self.rel_end
+        node = item.descendant_for_byte_range(start, end)
+        # The smallest node spanning the range may be a descendant with the
+        # same range, e.g. an identifier wrapped by an expression
+        while node is not None and node.type != self.type:
+            node = node.parent
+        assert node is not None, 'Never: captured node not found'
+        return node
+
+
+type _ItemMatches = list[tuple[str, dict[str, list[_CapturedNode]]]]
+
+
+class IncrementalQuery:
+    """Results of `run_queries` over a tree, updated after edits.
+
+    Each query must match within a single top-level item: patterns anchored
+    at the root `compilation_unit` are not supported.
+    """
+
+    def __init__(self, queries: dict[str, str], tree: Tree) -> None:
+        self.queries = queries
+        self._spans = ItemSpans(tree)
+        root = tree.root_node
+        self._results: ItemResults[_ItemMatches] = ItemResults(
+            tree,
+            self._query_item,
+            [
+                _relative_matches(item, captures)
+                for item, captures in zip(
+                    root.children,
+                    split_captures(run_queries(queries, root), root),
+                    strict=True,
+                )
+            ],
+        )
+        # Captures resolved in the current tree, until the next update
+        self._captures: _Captures | None = None
+
+    @property
+    def tree(self) -> Tree:
+        return self._results.tree
+
+    @property
+    def queried_items(self) -> int:
+        """Number of top-level items queried so far."""
+        return self._results.computed
+
+    def _query_item(self, item: Node) -> _ItemMatches:
+        return _relative_matches(item, run_queries(self.queries, item))
+
+    def update(
+        self, new_tree: Tree, old_tree: Tree, edits: Sequence[TreeEdit]
+    ) -> None:
+        """Move to `new_tree`, see `ItemSpans.update`."""
+        changes = self._spans.update(new_tree, old_tree, edits)
+        self._results.update(new_tree, changes)
+        self._captures = None
+
+    def captures(self) -> _Captures:
+        """Return the captures of the current tree, as `run_queries` does.
+
+        The result is cached until the next `update`, and must not be
+        modified.
+        """
+        if self._captures is not None:
+            return self._captures
+        captures_map: _Captures = {}
+        children = self.tree.root_node.children
+        for item, matches in zip(children, self._results, strict=True):
+            for name, capture in matches:
+                captures_map.setdefault(name, []).append(
+                    {
+                        capture_name: [node.resolve(item) for node in nodes]
+                        for capture_name, nodes in capture.items()
+                    }
+                )
+        self._captures = captures_map
+        return captures_map
+
+
+def _relative_matches(item: Node, captures: _Captures) -> _ItemMatches:
+    """Record the captures within `item` relative to its start."""
+    matches: _ItemMatches = []
+    for name, name_captures in captures.items():
+        for capture in name_captures:
+            matches.append(
+                (
+                    name,
+                    {
+                        capture_name: [
+                            _CapturedNode(
+                                node.start_byte - item.start_byte,
+                                node.end_byte - item.start_byte,
+                                node.type,
+                            )
+                            for node in nodes
+                        ]
+                        for capture_name, nodes in capture.items()
+                    },
+                )
+            )
+    return matches
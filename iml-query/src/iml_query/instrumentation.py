@@ -0,0 +1,204 @@
+"""Opt-in timing of the hot paths.
+
+Parsing, query compilation and execution, edits and reparses, and the
+entry points of `iml_query.processing` are wrapped in spans. A span is
+recorded only while a hook is registered or logging is enabled; otherwise
+the overhead is a flag check.
+
+Example:
+    add_hook(lambda span: print(span.name, span.wall_ms, span.bytes))
+    enable_logging()  # also emit a structlog event per span
+
+    with record_spans() as spans:
+        iml_outline(iml)
+    slowest = max(spans, key=lambda s: s.duration_ns)
+
+"""
+
+import functools
+import threading
+import time
+from collections.abc import Callable, Generator
+from contextlib import contextmanager
+from dataclasses import dataclass, field
+from typing import Any
+
+import structlog
+from tree_sitter import Node, Tree
+
+logger = structlog.get_logger(__name__)
+
+
+@dataclass(slots=True)
+class Span:
+    """Measurements of one stage.
+
+    Attributes:
+        name: the stage, e.g. 'parse', 'query.run' or
+            'processing.iml_outline'
+        duration_ns: wall time
+        bytes: size of the input source or node, when known
+        nodes: number of nodes of the tree or node involved, when known
+        matches: number of query matches, when known
+        error: name of the exception raised by the stage, if any
+        attrs: stage-specific values, e.g. `cached` for 'parse'
+
+    """
+
+    name: str
+    duration_ns: int = 0
+    bytes: int | None = None
+    nodes: int | None = None
+    matches: int | None = None
+    error: str | None = None
+    attrs: dict[str, Any] = field(default_factory=dict[str, Any])
+
+    @property
+    def wall_ms(self) -> float:
+        return self.duration_ns / 1e6
+
+
+type Hook = Callable[[Span], None]
+
+_lock = threading.Lock()
+_hooks: tuple[Hook, ...] = ()
+_log_events = False
+# Whether spans are recorded, checked on every instrumented call
+_active = False
+
+
+def _update_active() -> None:
+    global _active
+    _active = bool(_hooks) or _log_events
+
+
+def add_hook(hook: Hook) -> None:
+    """Call `hook` with each finished span, in the thread that ran it."""
+    global _hooks
+    with _lock:
+        _hooks = (*_hooks, hook)
+        _update_active()
+
+
+def remove_hook(hook: Hook) -> None:
+    global _hooks
+    with _lock:
+        hooks = list(_hooks)
+        hooks.remove(hook)
+        _hooks = tuple(hooks)
+        _update_active()
+
+
+def enable_logging(enabled: bool = True) -> None:
+    """Emit a structlog debug event for each finished span."""
+    global _log_events
+    with _lock:
+        _log_events = enabled
+        _update_active()
+
+
+def is_enabled() -> bool:
+    return _active
+
+
+@contextmanager
+def record_spans() -> Generator[list[Span]]:
+    """Collect the spans finished in the block into a list."""
+    spans: list[Span] = []
+    add_hook(spans.append)
+    try:
+        yield spans
+    finally:
+        remove_hook(spans.append)
+
+
+def _emit(span: Span) -> None:
+    for hook in _hooks:
+        try:
+            hook(span)
+        except Exception:
+            logger.exception('instrumentation hook failed', span=span.name)
+    if _log_events:
+        logger.debug(
+            span.name,
+            wall_ms=span.wall_ms,
+            bytes=span.bytes,
+            nodes=span.nodes,
+            matches=span.matches,
+            error=span.error,
+            **span.attrs,
+        )
+
+
+class _SpanContext:
+    __slots__ = ('_span', '_start')
+
+    def __init__(self, span: Span | None) -> None:
+        self._span = span
+        self._start = 0
+
+    def __enter__(self) -> Span | None:
+        if self._span is not None:
+            self._start = time.perf_counter_ns()
+        return self._span
+
+    def __exit__(
+        self, exc_type: type[BaseException] | None, *_: object
+    ) -> None:
+        span = self._span
+        if span is None:
+            return
+        span.duration_ns = time.perf_counter_ns() - self._start
+        if exc_type is not None:
+            span.error = exc_type.__name__
+        _emit(span)
+
+
+def span(name: str, *, bytes: int | None = None) -> _SpanContext:
+    """Time a block as a span named `name`.
+
+    The context value is the `Span`, for the block to fill in counts, or
+    None when instrumentation is disabled:
+
+        with span('query.run', bytes=size) as s:
+            matches = cursor.matches(node)
+            if s is not None:
+                s.matches = len(matches)
+
+    """
+    return _SpanContext(Span(name, bytes=bytes) if _active else None)
+
+
+def _describe_input(span: Span, args: tuple[Any, ...]) -> None:
+    """Set the size of the first source and node count of the first tree."""
+    for arg in args:
+        if span.bytes is None:
+            if isinstance(arg, str):
+                span.bytes = len(arg.encode('utf-8'))
+            elif isinstance(arg, bytes):
+                span.bytes = len(arg)
+            elif isinstance(arg, memoryview):
+                span.bytes = arg.nbytes
+        if span.nodes is None:
+            if isinstance(arg, Tree):
+                span.nodes = arg.root_node.descendant_count
+            elif isinstance(arg, Node):
+                span.nodes = arg.descendant_count
+                if span.bytes is None:
+                    span.bytes = arg.end_byte - arg.start_byte
+
+
+def instrumented[**P, R](func: Callable[P, R]) -> Callable[P, R]:
+    """Record each call of `func` as a '<module>.<function>' span."""
+    name = f'{func.__module__.rsplit(".", 1)[-1]}.{func.__name__}'
+
+    @functools.wraps(func)
+    def wrapper(*args: P.args, **kwargs: P.kwargs) -> R:
+        if not _active:
+            return func(*args, **kwargs)
+        with span(name) as s:
+            if s is not None:
+                _describe_input(s, (*args, *kwargs.values()))
+            return func(*args, **kwargs)
+
+    return wrapper
@@ -0,0 +1,152 @@
+"""Line index for converting between byte offsets and points."""
+
+from bisect import bisect_right
+
+from tree_sitter import Point
+
+
+class LineIndex:
+    """Start offsets of the lines of a UTF-8 document.
+
+    Rows and columns follow tree-sitter: rows are separated by newlines and
+    the column is the byte offset within the row. The index is built once in
+    linear time, answers conversions in O(log n) and is updated in place by
+    `edit` and `apply_edits`.
+
+    An edit moves all the lines after it. Rather than updating them, the
+    line starts from `_pivot` on are stored `_delta` bytes early, and the
+    pivot follows the edits, so repeated edits in one place cost O(log n)
+    plus the lines they add or remove.
+    """
+
+    def __init__(self, src: str | bytes | memoryview) -> None:
+        if isinstance(src, str):
+            src = src.encode('utf-8')
+        src = bytes(src) if isinstance(src, memoryview) else src
+        self.length = len(src)
+        self._starts = [0]
+        pos = src.find(b'\n')
+        while pos != -1:
+            self._starts.append(pos + 1)
+            pos = src.find(b'\n', pos + 1)
+        self._pivot = len(self._starts)
+        self._delta = 0
+
+    @property
+    def line_starts(self) -> list[int]:
+        """Byte offsets of the first byte of each row."""
+        self._move_pivot(len(self._starts))
+        return self._starts
+
+    @property
+    def row_count(self) -> int:
+        """Number of rows, counting the empty row after a final newline."""
+        return len(self._starts)
+
+    @property
+    def ends_with_newline(self) -> bool:
+        return self.length > 0 and self._start(len(self._starts) - 1) == (
+            self.length
+        )
+
+    def _start(self, row: int) -> int:
+        start = self._starts[row]
+        return start + self._delta if row >= self._pivot else start
+
+    def _move_pivot(self, row: int) -> None:
+        starts, pivot, delta = self._starts, self._pivot, self._delta
+        if row > pivot:
+            starts[pivot:row] = [start + delta for start in starts[pivot:row]]
+        elif row < pivot:
+            starts[row:pivot] = [start - delta for start in starts[row:pivot]]
+        self._pivot = row
+
+    def _row_after(self, byte_offset: int) -> int:
+        """Index of the first line start after `byte_offset`."""
+        row = bisect_right(self._starts, byte_offset, hi=self._pivot)
+        if row < self._pivot:
+            return row
+        return bisect_right(
+            self._starts, byte_offset - self._delta, lo=self._pivot
+        )
+
+    def line_start(self, row: int) -> int:
+        """Byte offset of the first byte of `row`."""
+        if not 0 <= row < len(self._starts):
+            raise ValueError(
+                f'Row {row} out of range (0-{len(self._starts) - 1})'
+            )
+        return self._start(row)
+
+    def line_end(self, row: int) -> int:
+        """Byte offset just after `row`, including its newline if any."""
+        if row + 1 < len(self._starts):
+            return self._start(row + 1)
+        self.line_start(row)  # validate row
+        return self.length
+
+    def point_at(self, byte_offset: int) -> Point:
+        """Point of the given byte offset."""
+        if not 0 <= byte_offset <= self.length:
+            raise ValueError(
+                f'Byte offset {byte_offset} out of range (0-{self.length})'
+            )
+        row = self._row_after(byte_offset) - 1
+        return Point(row, byte_offset - self._start(row))
+
+    def byte_at(self, point: Point | tuple[int, int]) -> int:
+        """Byte offset of the given point."""
+        row, column = point
+        offset = self.line_start(row) + column
+        if offset > self.line_end(row):
+            raise ValueError(f'Column {column} out of range for row {row}')
+        return offset
+
+    def edit(self, start_byte: int, old_end_byte: int, new_text: bytes) -> None:
+        """Update the index after replacing [start_byte, old_end_byte)."""
+        self.apply_edits([(start_byte, old_end_byte, new_text)])
+
+    def apply_edits(self, edits: list[tuple[int, int, bytes]]) -> None:
+        """Update the index after several replacements.
+
+        The line starts of each replaced range are patched in place; the
+        lines after the edits are moved lazily.
+
+        Arguments:
+            edits: (start_byte, old_end_byte, new_text) tuples in old
+                document coordinates, sorted by position and non-overlapping
+
+        """
+        for start_byte, old_end_byte, _ in edits:
+            if not 0 <= start_byte <= old_end_byte <= self.length:
+                raise ValueError(
+                    f'Invalid byte range ({start_byte}, {old_end_byte}) for '
+                    f'a document of {self.length} bytes'
+                )
+        delta = 0  # shift of the old coordinates by the previous edits
+        for start_byte, old_end_byte, new_text in edits:
+            start = start_byte + delta
+            # Line starts in (start, old_end] are replaced by those of the
+            # new text
+            first = self._row_after(start)
+            last = self._row_after(old_end_byte + delta)
+            self._move_pivot(last)
+            new_starts: list[int] = []
+            pos = new_text.find(b'\n')
+            while pos != -1:
+                new_starts.append(start + pos + 1)
+                pos = new_text.find(b'\n', pos + 1)
+            self._starts[first:last] = new_starts
+            self._pivot = first + len(new_starts)
+            shift = len(new_text) - (old_end_byte - start_byte)
+            self._delta += shift
+            self.length += shift
+            delta += shift
+
+
+def end_point(start_point: Point, text: bytes) -> Point:
+    """Point reached after inserting `text` at `start_point`."""
+    newlines = text.count(b'\n')
+    if not newlines:
+        return Point(start_point.row, start_point.column + len(text))
+    return Point(start_point.row + newlines, len(text) - text.rfind(b'\n') - 1)
@@ -0,0 +1,184 @@
+"""Streaming pipeline over IML source files.
+
+Each stage is an iterator over the previous one, so only the files in flight
+are held in memory, however many files there are:
+
+    files = iter_paths('models', '*.iml')
+    for record in outline_records(parse_sources(read_sources(files))):
+        ...
+
+"""
+
+import fnmatch
+import os
+import queue
+import threading
+from collections.abc import Callable, Generator, Iterable
+from dataclasses import dataclass, replace
+from pathlib import Path
+from typing import Any
+
+from tree_sitter import Tree
+
+from iml_query.batch import FileResult
+from iml_query.processing import iml_outline
+from iml_query.tree_sitter_utils import parse
+
+_DONE = object()
+
+
+@dataclass(slots=True, frozen=True)
+class SourceFile:
+    """A file going through the pipeline.
+
+    `error` is set, and the later stages skip the file, once a stage fails.
+    """
+
+    path: Path
+    text: str | None = None
+    tree: Tree | None = None
+    error: str | None = None
+
+
+def prefetch[T](items: Iterable[T], size: int = 8) -> Generator[T]:
+    """Produce `items` in a background thread, at most `size` ahead.
+
+    Exceptions raised by `items` are re-raised in the consumer. The thread
+    stops when the returned generator is closed or garbage collected.
+    """
+    if size < 1:
+        raise ValueError('size must be positive')
+    buffer: queue.Queue[Any] = queue.Queue(maxsize=size)
+    stop = threading.Event()
+
+    def put(item: object) -> bool:
+        while not stop.is_set():
+            try:
+                buffer.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def produce() -> None:
+        try:
+            for item in items:
+                if not put(item):
+                    return
+        except BaseException as e:
+            put(e)
+            return
+        put(_DONE)
+
+    thread = threading.Thread(
+        target=produce, name='iml-query-prefetch', daemon=True
+    )
+
+    def consume() -> Generator[T]:
+        thread.start()
+        try:
+            while True:
+                item = buffer.get()
+                if item is _DONE:
+                    return
+                if isinstance(item, BaseException):
+                    raise item
+                yield item
+        finally:
+            stop.set()
+
+    return consume()
+
+
+def iter_paths(
+    root: str | os.PathLike[str],
+    pattern: str = '*.iml',
+    *,
+    recursive: bool = True,
+) -> Generator[Path]:
+    """Yield the files under `root` whose name matches `pattern`.
+
+    Directories are listed lazily, one at a time, and in sorted order, so
+    the order of the files is deterministic.
+    """
+    for dirpath, dirnames, filenames in os.walk(root):
+        dirnames.sort()
+        for filename in sorted(fnmatch.filter(filenames, pattern)):
+            yield Path(dirpath) / filename
+        if not recursive:
+            return
+
+
+def _read(path: Path) -> SourceFile:
+    try:
+        return SourceFile(path, text=path.read_text(encoding='utf-8'))
+    except (OSError, UnicodeDecodeError) as e:
+        return SourceFile(path, error=f'{type(e).__name__}: {e}')
+
+
+def read_sources(
+    paths: Iterable[str | os.PathLike[str]], *, prefetch_size: int = 8
+) -> Generator[SourceFile]:
+    """Read the files in a background thread, at most `prefetch_size` ahead."""
+    return prefetch((_read(Path(p)) for p in paths), prefetch_size)
+
+
+def parse_sources(
+    sources: Iterable[SourceFile], *, ocaml: bool = False
+) -> Generator[SourceFile]:
+    """Parse the text of each source.
+
+    The trees bypass the tree cache of `parse`, so that they are freed once
+    the later stages are done with them.
+    """
+    for source in sources:
+        if source.error is not None or source.text is None:
+            yield source
+            continue
+        tree = parse(source.text, ocaml, cache=False)
+        yield replace(source, tree=tree)
+
+
+def map_sources[T](
+    func: Callable[[str, Tree], T], sources: Iterable[SourceFile]
+) -> Generator[FileResult[T]]:
+    """Apply `func` to the text and tree of each parsed source.
+
+    The sources are not kept, so their trees can be freed as soon as the
+    record is produced.
+    """
+    for source in sources:
+        if source.error is not None:
+            yield FileResult(source.path, error=source.error)
+            continue
+        assert source.text is not None and source.tree is not None, (
+            'Never: unparsed source'
+        )
+        record: FileResult[T]
+        try:
+            record = FileResult(
+                source.path, result=func(source.text, source.tree)
+            )
+        except Exception as e:
+            record = FileResult(source.path, error=f'{type(e).__name__}: {e}')
+        yield record
+
+
+def outline_records(
+    sources: Iterable[SourceFile],
+) -> Generator[FileResult[dict[str, Any]]]:
+    """Yield the `iml_outline` of each parsed source."""
+    return map_sources(iml_outline, sources)
+
+
+def outline_directory(
+    root: str | os.PathLike[str],
+    pattern: str = '*.iml',
+    *,
+    prefetch_size: int = 8,
+) -> Generator[FileResult[dict[str, Any]]]:
+    """Read, parse and outline the IML files of a directory, file by file."""
+    sources = read_sources(
+        iter_paths(root, pattern), prefetch_size=prefetch_size
+    )
+    return outline_records(parse_sources(sources))
@@ -1,37 +1,68 @@
 """Post-processing and manipulation functions for IML queries."""
 
-from typing import Any
+from bisect import bisect_right
+from dataclasses import dataclass
+from functools import cached_property
+from typing import Any, TypedDict
 
 from tree_sitter import Node, Tree
 
+from iml_query.definitions import DefinitionIndex
+from iml_query.instrumentation import instrumented
+from iml_query.line_index import LineIndex
 from iml_query.queries import (
     DECOMP_QUERY_SRC,
     INSTANCE_QUERY_SRC,
+    NESTED_MEASURE_QUERY_SRC,
     OPAQUE_QUERY_SRC,
+    OUTLINE_QUERIES,
     REC_QUERY_SRC,
     TOP_LEVEL_VALUE_DEFINITION_QUERY_SRC,
     VALUE_DEFINITION_QUERY_SRC,
     VERIFY_QUERY_SRC,
+    AxiomCapture,
     DecompCapture,
+    EvalCapture,
     InstanceCapture,
+    LemmaCapture,
+    OpaqueCapture,
     RecCapture,
+    TheoremCapture,
     TopDefCapture,
     VerifyCapture,
 )
 
 from .tree_sitter_utils import (
+    ByteRange,
+    EditSession,
+    PointRange,
+    Source,
+    SourceText,
     delete_nodes,
     get_nesting_relationship,
-    get_parser,
-    insert_lines,
     mk_query,
+    node_text,
+    parse,
     run_queries,
     run_query,
-    unwrap_bytes,
+    source_bytes,
 )
 
 
-def find_func_definition(tree: Tree, function_name: str) -> Node | None:
+def find_func_definition(
+    tree: Tree,
+    function_name: str,
+    index: DefinitionIndex | None = None,
+) -> Node | None:
+    """Find the first definition of a function, top-level or nested.
+
+    Pass a `DefinitionIndex` of `tree` to answer repeated lookups without
+    querying the whole tree each time.
+    """
+    if index is not None:
+        definition = index.first(function_name)
+        return definition.node if definition is not None else None
+
     matches = run_query(
         mk_query(VALUE_DEFINITION_QUERY_SRC),
         node=tree.root_node,
@@ -40,9 +71,7 @@ def find_func_definition(tree: Tree, function_name: str) -> Node | None:
     func_def: Node | None = None
     for _, capture in matches:
         function_name_node = capture['function_name'][0]
-        function_name_rhs = unwrap_bytes(function_name_node.text).decode(
-            'utf-8'
-        )
+        function_name_rhs = node_text(function_name_node)
         if function_name_rhs == function_name:
             func_def = capture['function_definition'][0]
             break
@@ -50,6 +79,7 @@ def find_func_definition(tree: Tree, function_name: str) -> Node | None:
     return func_def
 
 
+@instrumented
 def find_nested_measures(root_node: Node) -> list[dict[str, Any]]:
     """Find nested measures.
 
@@ -66,28 +96,7 @@ def find_nested_measures(root_node: Node) -> list[dict[str, Any]]:
                 range: range of nested function node
     """
     # Query that finds both top-level functions and all functions with a measure
-    combined_query = mk_query(r"""
-    ; Find top-level functions
-    (compilation_unit
-        (value_definition
-            (let_binding
-                pattern: (value_name) @top_func_name
-            )
-        ) @top_function
-    )
-
-    ; Find functions with a measure attribute
-    (value_definition
-        (let_binding
-            pattern: (value_name) @nested_func_name
-            (item_attribute
-                "[@@"
-                (attribute_id) @_measure_id
-                (#eq? @_measure_id "measure")
-            )
-        )
-    ) @nested_function
-    """)
+    combined_query = mk_query(NESTED_MEASURE_QUERY_SRC)
 
     matches = run_query(combined_query, node=root_node)
 
@@ -98,9 +107,7 @@ def find_nested_measures(root_node: Node) -> list[dict[str, Any]]:
     for pattern_idx, capture in matches:
         if pattern_idx == 0:  # Top-level function pattern
             func_def = capture['top_function'][0]
-            func_name = unwrap_bytes(capture['top_func_name'][0].text).decode(
-                'utf-8'
-            )
+            func_name = node_text(capture['top_func_name'][0])
             top_level_functions.append(
                 {
                     'name': func_name,
@@ -110,9 +117,7 @@ def find_nested_measures(root_node: Node) -> list[dict[str, Any]]:
             )
         elif pattern_idx == 1:  # Nested function with measure pattern
             nested_func = capture['nested_function'][0]
-            nested_name = unwrap_bytes(
-                capture['nested_func_name'][0].text
-            ).decode('utf-8')
+            nested_name = node_text(capture['nested_func_name'][0])
             nested_functions_with_measures.append(
                 {
                     'name': nested_name,
@@ -121,51 +126,65 @@ def find_nested_measures(root_node: Node) -> list[dict[str, Any]]:
                 }
             )
 
-    # Now match nested functions to their containing top-level functions
-    problematic_functions: list[dict[str, Any]] = []
+    # Now match nested functions to their containing top-level functions.
+    # Top-level functions do not overlap, so the candidate container of a
+    # nested function is the last one starting before it.
+    top_starts = sorted(
+        {info['node'].start_byte for info in top_level_functions}
+    )
+    top_nodes: dict[int, Node] = {
+        info['node'].start_byte: info['node'] for info in top_level_functions
+    }
+    nested_by_top: dict[int, list[dict[str, Any]]] = {}
 
-    for top_func_info in top_level_functions:
-        top_func_node = top_func_info['node']
-        nested_measures: list[dict[str, Any]] = []
-
-        for nested_info in nested_functions_with_measures:
-            nested_node = nested_info['node']
-
-            # Get nesting relationship in a single traversal
-            nesting_level = get_nesting_relationship(nested_node, top_func_node)
-
-            # Only include if it's truly nested (level > 0)
-            if nesting_level > 0:
-                nested_measures.append(
-                    {
-                        'function_name': nested_info['name'],
-                        'level': nesting_level,
-                        'range': nested_info['range'],
-                        'node': nested_node,
-                    }
-                )
+    for nested_info in nested_functions_with_measures:
+        nested_node = nested_info['node']
+        i = bisect_right(top_starts, nested_node.start_byte) - 1
+        if i < 0:
+            continue
+        top_func_node = top_nodes[top_starts[i]]
+
+        # Walks up from the nested node only, bounded by the nesting depth
+        nesting_level = get_nesting_relationship(nested_node, top_func_node)
 
+        # Only include if it's truly nested (level > 0)
+        if nesting_level > 0:
+            nested_by_top.setdefault(top_starts[i], []).append(
+                {
+                    'function_name': nested_info['name'],
+                    'level': nesting_level,
+                    'range': nested_info['range'],
+                    'node': nested_node,
+                }
+            )
+
+    problematic_functions: list[dict[str, Any]] = []
+    for top_func_info in top_level_functions:
+        nested_measures = nested_by_top.get(top_func_info['node'].start_byte)
         if nested_measures:
             problematic_functions.append(
                 {
                     'top_level_function_name': top_func_info['name'],
                     'node': top_func_info['node'],
                     'range': top_func_info['range'],
-                    'nested_measures': nested_measures,
+                    'nested_measures': list(nested_measures),
                 }
             )
 
     return problematic_functions
 
 
-def find_nested_rec(iml: str) -> list[dict[str, Any]]:
+@instrumented
+def find_nested_rec(iml: Source) -> list[dict[str, Any]]:
     """Find nested recursive function definitions in IML code.
 
     Returns:
         a list of dictionary for the name and location of each function
 
     """
-    tree = get_parser().parse(bytes(iml, 'utf-8'))
+    src = source_bytes(iml)
+    tree = parse(src)
+    source = SourceText(src)
     queries = {
         'top_level_functions': TOP_LEVEL_VALUE_DEFINITION_QUERY_SRC,
         'rec_functions': REC_QUERY_SRC,
@@ -180,20 +199,20 @@ def find_nested_rec(iml: str) -> list[dict[str, Any]]:
         for capture in captures_map.get('rec_functions', [])
     ]
 
-    #
+    # Top-level functions are identified by their byte range
     nested_rec_caps: list[RecCapture] = []
-    top_function_nodes: list[Node] = [c.top_function for c in top_captures]
+    top_function_ranges: set[tuple[int, int]] = {
+        c.top_function.byte_range for c in top_captures
+    }
 
     for rec_cap in rec_captures:
         rec_function_node = rec_cap.function_definition
-        if rec_function_node not in top_function_nodes:
+        if rec_function_node.byte_range not in top_function_ranges:
             nested_rec_caps.append(rec_cap)
 
     nested_rec_dict: list[dict[str, Any]] = []
     for cap in nested_rec_caps:
-        d: dict[str, Any] = {
-            'name': unwrap_bytes(cap.function_name.text).decode('utf-8')
-        }
+        d: dict[str, Any] = {'name': source.text(cap.function_name)}
         func_range = cap.function_definition.range
         start_point, end_point = func_range.start_point, func_range.end_point
         d['start_point'] = (start_point.row, start_point.column)
@@ -204,62 +223,41 @@ def find_nested_rec(iml: str) -> list[dict[str, Any]]:
     return nested_rec_dict
 
 
-def verify_capture_to_req(capture: VerifyCapture) -> dict[str, str]:
+def _source_text(iml: Source) -> SourceText | None:
+    """Return a `SourceText` of `iml`, unless it would need to be encoded."""
+    return None if isinstance(iml, str) else SourceText(iml)
+
+
+def _statement_body(node: Node, keyword: str, source: SourceText | None) -> str:
+    """Return the text of a statement without its keyword and parentheses."""
+    body = node_text(node, source).strip().removeprefix(keyword).strip()
+    if body.startswith('(') and body.endswith(')'):
+        body = body[1:-1].strip()
+    return body
+
+
+def verify_capture_to_req(
+    capture: VerifyCapture, source: SourceText | None = None
+) -> dict[str, str]:
     """Extract ImandraX request from a verify statement node."""
     node = capture.verify
-    req: dict[str, str] = {}
     assert node.type == 'verify_statement', 'not verify_statement'
-    assert node.text, 'None text'
-    verify_src = (
-        unwrap_bytes(node.text)
-        .decode('utf-8')
-        .strip()
-        .removeprefix('verify')
-        .strip()
-    )
-    # Remove parentheses
-    if verify_src.startswith('(') and verify_src.endswith(')'):
-        verify_src = verify_src[1:-1].strip()
-
-    req['src'] = verify_src
-    return req
+    return {'src': _statement_body(node, 'verify', source)}
 
 
-def instance_capture_to_req(capture: InstanceCapture) -> dict[str, str]:
+def instance_capture_to_req(
+    capture: InstanceCapture, source: SourceText | None = None
+) -> dict[str, str]:
     """Extract ImandraX request from an instance statement node."""
     node = capture.instance
-    req: dict[str, str] = {}
     assert node.type == 'instance_statement', 'not instance_statement'
-    assert node.text, 'None text'
-    instance_src = (
-        unwrap_bytes(node.text)
-        .decode('utf-8')
-        .strip()
-        .removeprefix('instance')
-        .strip()
-    )
-    # Remove parentheses
-    if instance_src.startswith('(') and instance_src.endswith(')'):
-        instance_src = instance_src[1:-1].strip()
-    req['src'] = instance_src
-    return req
+    return {'src': _statement_body(node, 'instance', source)}
 
 
-def eval_node_to_src(node: Node) -> str:
+def eval_node_to_src(node: Node, source: SourceText | None = None) -> str:
     """Extract str from an eval statement node."""
     assert node.type == 'eval_statement', 'not eval_statement'
-    assert node.text, 'None text'
-    src = (
-        unwrap_bytes(node.text)
-        .decode('utf-8')
-        .strip()
-        .removeprefix('eval')
-        .strip()
-    )
-    # Remove parentheses
-    if src.startswith('(') and src.endswith(')'):
-        src = src[1:-1].strip()
-    return src
+    return _statement_body(node, 'eval', source)
 
 
 class DecompParsingError(Exception):
@@ -268,136 +266,213 @@ class DecompParsingError(Exception):
     pass
 
 
-def top_application_to_decomp(node: Node) -> dict[str, Any]:
-    """Extract Decomp request request from a top application node."""
-    assert node.type == 'application_expression'
+LIFT_BOOL_VALUES = ['Default', 'Nested_equalities', 'Equalities', 'All']
 
-    extract_top_arg_query = mk_query(r"""
-    (application_expression
-        (value_path
-            (value_name) @top
-            (#eq? @top "top")
-        )
-        (labeled_argument
-            (label_name) @label
-        ) @arg
-        (unit)
-    )
-    """)
+# Binary composition operators and the prefix `~|` operator
+DECOMP_INFIX_OPERATORS = frozenset({'<<', '<|<', '|>>'})
+DECOMP_PREFIX_OPERATORS = frozenset({'~|'})
 
-    matches = run_query(query=extract_top_arg_query, node=node)
-    # print(f'Found {len(matches)} labeled arguments')
 
-    # print(f'Matches: \\n{matches}')
+class DecompLabels(TypedDict, total=False):
+    """Labeled arguments of a `top` application."""
 
-    res: dict[str, Any] = {}
+    assuming: str
+    basis: list[str]
+    rule_specs: list[str]
+    prune: bool
+    ctx_simp: bool
+    lift_bool: str
+    # Positional `[%id f]` argument, as in `top () [%id f]`
+    target: str
 
-    # Process each labeled argument based on its label
-    for _, capture in matches:
-        label_name_b = capture['label'][0].text
-        assert label_name_b, 'Never: no label'
-        label_name = label_name_b.decode('utf-8')
-        arg_node = capture['arg'][0]
-
-        match label_name:
-            case 'assuming':
-                # Parse assuming: ~assuming:[%id simple_branch]
-                assuming_query = mk_query(r"""
-                (extension
-                    "[%"
-                    (attribute_id) @attr_id
-                    (attribute_payload) @payload
-                    (#eq? @attr_id "id")
-                )
-                """)
-                assuming_matches = run_query(
-                    query=assuming_query, node=arg_node
-                )
-                if assuming_matches:
-                    payload_text = assuming_matches[0][1]['payload'][0].text
-                    assert payload_text, 'Never: no assuming payload'
-                    res['assuming'] = payload_text.decode('utf-8')
-
-            case 'basis' | 'rule_specs':
-                # Query each extension separately to get all identifiers
-                extension_query = mk_query(r"""
-                (extension
-                    "[%"
-                    (attribute_id)
-                    (attribute_payload
-                        (expression_item
-                            (value_path
-                                (value_name) @id
-                            )
-                        )
-                    )
-                )
-                """)
-                extension_matches = run_query(
-                    query=extension_query, node=arg_node
-                )
-                if extension_matches:
-                    ids: list[str] = []
-                    for match in extension_matches:
-                        id_node = match[1]['id'][0]
-                        id_text = id_node.text
-                        assert id_text, f'Never: no {label_name} id text'
-                        ids.append(id_text.decode('utf-8'))
-                    res[label_name] = ids
-
-            case 'prune' | 'ctx_simp':
-                # Parse boolean: ~prune:true
-                bool_query = mk_query(r"""
-                (boolean) @bool_val
-                """)
-                bool_matches = run_query(query=bool_query, node=arg_node)
-                if bool_matches:
-                    bool_text = bool_matches[0][1]['bool_val'][0].text
-                    assert bool_text, f'Never: no {label_name} boolean text'
-                    res[label_name] = bool_text.decode('utf-8') == 'true'
-
-            case 'lift_bool':
-                # Parse constructor: ~lift_bool:Default
-                constructor_query = mk_query(r"""
-                (constructor_path
-                    (constructor_name) @constructor
-                )
-                """)
-                constructor_matches = run_query(
-                    query=constructor_query, node=arg_node
-                )
-                if constructor_matches:
-                    constructor_text = constructor_matches[0][1]['constructor'][
-                        0
-                    ].text
-                    assert constructor_text, (
-                        'Never: no lift_bool constructor text'
+
+class DecompComposition(TypedDict):
+    """Composition of decompositions, e.g. `top () |>> prune`.
+
+    `args` holds one operand for prefix operators and two for infix ones.
+    Operands are `top` applications, nested compositions, or the name of a
+    decomposition value such as `prune`.
+    """
+
+    op: str
+    args: list['DecompTerm']
+
+
+DecompTerm = DecompLabels | DecompComposition | str
+
+
+class DecompReq(DecompLabels, total=False):
+    """Decomp request of a function.
+
+    Plain `top` applications are flattened into the request; composed
+    payloads are stored under `composition`.
+    """
+
+    name: str
+    composition: DecompComposition
+
+
+def _id_extension_names(node: Node) -> list[str]:
+    """Collect the identifiers of the `[%id ...]` extensions under `node`."""
+    ids: list[str] = []
+    cursor = node.walk()
+    while True:
+        current = cursor.node
+        assert current is not None, 'Never: cursor without node'
+        descend = True
+        if current.type == 'extension':
+            attr_id = current.child(1)
+            payload = current.child(2)
+            if (
+                attr_id is not None
+                and payload is not None
+                and attr_id.type == 'attribute_id'
+                and node_text(attr_id) == 'id'
+            ):
+                ids.append(node_text(payload).strip())
+                descend = False
+        if descend and cursor.goto_first_child():
+            continue
+        while not cursor.goto_next_sibling():
+            if not cursor.goto_parent() or cursor.node == node:
+                return ids
+
+
+def _add_decomp_label(res: DecompLabels, label_name: str, node: Node) -> None:
+    """Parse the value of a labeled argument of `top` into `res`."""
+    match label_name:
+        case 'assuming':
+            # Parse assuming: ~assuming:[%id simple_branch]
+            ids = _id_extension_names(node)
+            if ids:
+                res['assuming'] = ids[0]
+
+        case 'basis' | 'rule_specs':
+            ids = _id_extension_names(node)
+            if ids:
+                res[label_name] = ids
+
+        case 'prune' | 'ctx_simp':
+            # Parse boolean: ~prune:true
+            if node.type == 'boolean':
+                res[label_name] = node_text(node) == 'true'
+
+        case 'lift_bool':
+            # Parse constructor: ~lift_bool:Default
+            if node.type == 'constructor_path':
+                lift_bool_value = node_text(node)
+                if lift_bool_value not in LIFT_BOOL_VALUES:
+                    raise DecompParsingError(
+                        f'Invalid lift_bool value: {lift_bool_value}',
+                        f'should be one of {LIFT_BOOL_VALUES}',
                     )
-                    lift_bool_value = constructor_text.decode('utf-8')
-                    lift_bool_enum = [
-                        'Default',
-                        'Nested_equalities',
-                        'Equalities',
-                        'All',
-                    ]
-                    if lift_bool_value not in lift_bool_enum:
-                        raise DecompParsingError(
-                            f'Invalid lift_bool value: {lift_bool_value}',
-                            f'should be one of {lift_bool_enum}',
-                        )
-                    res['lift_bool'] = lift_bool_value
-            case _:
-                assert 'False', 'Never'
-
-    default_res: dict[str, Any] = {
+                res['lift_bool'] = lift_bool_value
+        case _:
+            pass
+
+
+def top_application_to_decomp(node: Node) -> DecompLabels:
+    """Extract Decomp request request from a top application node.
+
+    The arguments are read in a single pass over the children of the
+    application, without running sub-queries.
+    """
+    assert node.type == 'application_expression'
+
+    function = node.child_by_field_name('function')
+    if function is None or node_text(function) != 'top':
+        raise DecompParsingError(
+            f'Expected a `top` application, got: {node_text(node)}'
+        )
+
+    res: DecompLabels = {}
+    cursor = node.walk()
+    cursor.goto_first_child()
+    while cursor.goto_next_sibling():
+        if cursor.field_name != 'argument':
+            continue
+        arg_node = cursor.node
+        assert arg_node is not None, 'Never: cursor without node'
+
+        if arg_node.type == 'extension':
+            # Positional argument: top () [%id f]
+            ids = _id_extension_names(arg_node)
+            if ids:
+                res['target'] = ids[0]
+            continue
+        if arg_node.type != 'labeled_argument':
+            continue
+
+        label_node = next(
+            c for c in arg_node.children if c.type == 'label_name'
+        )
+        value_node = arg_node.child_by_field_name('expression')
+        if value_node is None:
+            continue
+        _add_decomp_label(res, node_text(label_node), value_node)
+
+    default_res: DecompLabels = {
         'basis': [],
         'rule_specs': [],
         'prune': False,
     }
 
-    res = default_res | res
+    return default_res | res
+
+
+def decomp_expression_to_term(node: Node) -> DecompTerm:
+    """Parse a decomp expression into a `top` request or a composition."""
+    match node.type:
+        case 'parenthesized_expression':
+            inner = node.child_by_field_name('expression')
+            assert inner is not None, 'Never: empty parentheses'
+            return decomp_expression_to_term(inner)
+        case 'application_expression':
+            return top_application_to_decomp(node)
+        case 'value_path':
+            return node_text(node)
+        case 'infix_expression':
+            op_node = node.child_by_field_name('operator')
+            left = node.child_by_field_name('left')
+            right = node.child_by_field_name('right')
+            assert op_node and left and right, 'Never: incomplete infix'
+            op = node_text(op_node)
+            if op not in DECOMP_INFIX_OPERATORS:
+                raise DecompParsingError(f'Unknown decomp operator: {op}')
+            return {
+                'op': op,
+                'args': [
+                    decomp_expression_to_term(left),
+                    decomp_expression_to_term(right),
+                ],
+            }
+        case 'prefix_expression':
+            op_node = node.child_by_field_name('operator')
+            operand = node.child_by_field_name('expression')
+            assert op_node and operand, 'Never: incomplete prefix'
+            op = node_text(op_node)
+            if op not in DECOMP_PREFIX_OPERATORS:
+                raise DecompParsingError(f'Unknown decomp operator: {op}')
+            return {'op': op, 'args': [decomp_expression_to_term(operand)]}
+        case _:
+            raise DecompParsingError(
+                f'Unsupported decomp expression: {node_text(node)}'
+            )
+
 
-    return res
+def _decomp_term_to_text(term: DecompTerm) -> str:
+    if isinstance(term, str):
+        return term
+    if 'op' in term:
+        args = [
+            text if isinstance(arg, str) else f'({text})'
+            for arg in term['args']
+            for text in [_decomp_term_to_text(arg)]
+        ]
+        if len(args) == 1:
+            return f'{term["op"]} {args[0]}'
+        return f' {term["op"]} '.join(args)
+    return decomp_req_to_top_appl_text(dict(term))
 
 
 def decomp_req_to_top_appl_text(req: dict[str, Any]) -> str:
@@ -411,7 +486,7 @@ def decomp_req_to_top_appl_text(req: dict[str, Any]) -> str:
         if k == 'assuming':
             if v is None:
                 continue
-            labels.append(f'~assuming:{mk_id(v[0])}')
+            labels.append(f'~assuming:{mk_id(v)}')
         if k == 'basis':
             if len(v) == 0:
                 continue
@@ -434,204 +509,495 @@ def decomp_req_to_top_appl_text(req: dict[str, Any]) -> str:
         if k == 'lift_bool':
             if v is None:
                 continue
-            s = '~lift_bool:'
-            s += f'{v} ()'
+            labels.append(f'~lift_bool:{v}')
 
-    return f'top {" ".join(labels) + " "}()'
+    text = f'top {" ".join(labels) + " "}()'
+    if req.get('target') is not None:
+        text += f' {mk_id(req["target"])}'
+    return text
 
 
-def decomp_attribute_payload_to_decomp_req_labels(node: Node) -> dict[str, Any]:
+def decomp_req_to_payload_text(req: dict[str, Any]) -> str:
+    """Convert a decomp request to the payload of a `[@@decomp ...]`."""
+    if 'composition' in req:
+        return _decomp_term_to_text(req['composition'])
+    return decomp_req_to_top_appl_text(req)
+
+
+def decomp_attribute_payload_to_decomp_req_labels(node: Node) -> DecompReq:
+    """Parse the payload of a `[@@decomp ...]` attribute.
+
+    A plain `top` application gives its labels; a composed payload gives a
+    `composition` entry.
+    """
     assert node.type == 'attribute_payload'
 
-    expect_appl = node.children[0].children[0]
-    if expect_appl.type != 'application_expression':
-        raise NotImplementedError('Composition operators are not supported yet')
+    expression_item = node.child(0)
+    expression = expression_item.child(0) if expression_item else None
+    if expression is None:
+        raise DecompParsingError('Empty decomp payload')
+    if expression.has_error:
+        raise DecompParsingError(
+            f'Invalid decomp payload: {node_text(expression)}'
+        )
 
-    return top_application_to_decomp(expect_appl)
+    term = decomp_expression_to_term(expression)
+    if isinstance(term, str):
+        raise DecompParsingError(f'Expected a decomposition, got: {term}')
+    if 'op' in term:
+        return {'composition': term}
+    return DecompReq(**term)
 
 
-def decomp_capture_to_req(capture: DecompCapture) -> dict[str, Any]:
-    req: dict[str, Any] = {}
-    req['name'] = unwrap_bytes(capture.decomposed_func_name.text).decode('utf8')
+def decomp_capture_to_req(
+    capture: DecompCapture, source: SourceText | None = None
+) -> DecompReq:
+    req: DecompReq = {}
+    req['name'] = node_text(capture.decomposed_func_name, source)
     req_labels = decomp_attribute_payload_to_decomp_req_labels(
         capture.decomp_payload
     )
-    req |= req_labels
+    req.update(req_labels)
     return req
 
 
-def extract_opaque_function_names(iml: str) -> list[str]:
+@instrumented
+def extract_opaque_function_names(
+    iml: Source,
+    tree: Tree | None = None,
+    *,
+    byte_range: ByteRange | None = None,
+    point_range: PointRange | None = None,
+) -> list[str]:
     opaque_functions: list[str] = []
+    query = mk_query(OPAQUE_QUERY_SRC)
+    if tree is None:
+        iml = source_bytes(iml)
+        tree = parse(iml)
+    source = _source_text(iml)
     matches = run_query(
-        mk_query(OPAQUE_QUERY_SRC),
-        code=iml,
+        query,
+        node=tree.root_node,
+        byte_range=byte_range,
+        point_range=point_range,
     )
     for _, capture in matches:
         value_name_node = capture['function_name'][0]
-        func_name = unwrap_bytes(value_name_node.text).decode('utf-8')
+        func_name = node_text(value_name_node, source)
         opaque_functions.append(func_name)
 
     return opaque_functions
 
 
-def remove_verify_reqs(
-    iml: str,
+@dataclass
+class ExtractedReqs[S: (str, bytes)]:
+    """Requests extracted from IML code, without modifying the code.
+
+    The code with the request nodes removed is only built, with an
+    incremental reparse, when `stripped` is first accessed. It has the type
+    of `iml`: str, or bytes for UTF-8 encoded code.
+    """
+
+    iml: S
+    tree: Tree
+    reqs: list[dict[str, Any]]
+    nodes: list[Node]
+
+    @cached_property
+    def stripped(self) -> tuple[S, Tree]:
+        """IML code and tree with the request nodes removed."""
+        session = EditSession[S](self.iml, self.tree)
+        session.delete_nodes(self.nodes)
+        return session.commit()
+
+
+@instrumented
+def remove_verify_reqs[S: (str, bytes)](
+    iml: S,
     tree: Tree,
     captures: list[VerifyCapture],
-) -> tuple[str, Tree]:
+) -> tuple[S, Tree]:
     """Remove verify requests from IML code."""
     verify_nodes = [capture.verify for capture in captures]
     new_iml, new_tree = delete_nodes(iml, tree, nodes=verify_nodes)
     return new_iml, new_tree
 
 
-def extract_verify_reqs(
-    iml: str, tree: Tree
-) -> tuple[str, Tree, list[dict[str, Any]]]:
-    root = tree.root_node
+@instrumented
+def collect_verify_reqs[S: (str, bytes)](
+    iml: S,
+    tree: Tree,
+    *,
+    byte_range: ByteRange | None = None,
+    point_range: PointRange | None = None,
+) -> ExtractedReqs[S]:
+    """Collect the verify requests, within the given range if any."""
     matches = run_query(
         mk_query(VERIFY_QUERY_SRC),
-        node=root,
+        node=tree.root_node,
+        byte_range=byte_range,
+        point_range=point_range,
     )
 
     verify_captures = [
         VerifyCapture.from_ts_capture(capture) for _, capture in matches
     ]
-    reqs: list[dict[str, Any]] = [
-        verify_capture_to_req(capture) for capture in verify_captures
-    ]
-    new_iml, new_tree = remove_verify_reqs(iml, tree, verify_captures)
-    return new_iml, new_tree, reqs
+    source = _source_text(iml)
+    return ExtractedReqs(
+        iml,
+        tree,
+        reqs=[
+            verify_capture_to_req(capture, source)
+            for capture in verify_captures
+        ],
+        nodes=[capture.verify for capture in verify_captures],
+    )
 
 
-def remove_instance_reqs(
-    iml: str,
+@instrumented
+def extract_verify_reqs[S: (str, bytes)](
+    iml: S,
+    tree: Tree,
+    *,
+    byte_range: ByteRange | None = None,
+    point_range: PointRange | None = None,
+) -> tuple[S, Tree, list[dict[str, Any]]]:
+    extracted = collect_verify_reqs(
+        iml, tree, byte_range=byte_range, point_range=point_range
+    )
+    new_iml, new_tree = extracted.stripped
+    return new_iml, new_tree, extracted.reqs
+
+
+@instrumented
+def remove_instance_reqs[S: (str, bytes)](
+    iml: S,
     tree: Tree,
     captures: list[InstanceCapture],
-) -> tuple[str, Tree]:
+) -> tuple[S, Tree]:
     """Remove instance requests from IML code."""
     instance_nodes = [capture.instance for capture in captures]
     new_iml, new_tree = delete_nodes(iml, tree, nodes=instance_nodes)
     return new_iml, new_tree
 
 
-def extract_instance_reqs(
-    iml: str, tree: Tree
-) -> tuple[str, Tree, list[dict[str, Any]]]:
-    root = tree.root_node
+@instrumented
+def collect_instance_reqs[S: (str, bytes)](
+    iml: S,
+    tree: Tree,
+    *,
+    byte_range: ByteRange | None = None,
+    point_range: PointRange | None = None,
+) -> ExtractedReqs[S]:
+    """Collect the instance requests, within the given range if any."""
     matches = run_query(
         mk_query(INSTANCE_QUERY_SRC),
-        node=root,
+        node=tree.root_node,
+        byte_range=byte_range,
+        point_range=point_range,
     )
 
     instance_captures = [
         InstanceCapture.from_ts_capture(capture) for _, capture in matches
     ]
+    source = _source_text(iml)
+    return ExtractedReqs(
+        iml,
+        tree,
+        reqs=[
+            instance_capture_to_req(capture, source)
+            for capture in instance_captures
+        ],
+        nodes=[capture.instance for capture in instance_captures],
+    )
 
-    reqs: list[dict[str, Any]] = [
-        instance_capture_to_req(capture) for capture in instance_captures
-    ]
-    new_iml, new_tree = remove_instance_reqs(iml, tree, instance_captures)
-    return new_iml, new_tree, reqs
+
+@instrumented
+def extract_instance_reqs[S: (str, bytes)](
+    iml: S,
+    tree: Tree,
+    *,
+    byte_range: ByteRange | None = None,
+    point_range: PointRange | None = None,
+) -> tuple[S, Tree, list[dict[str, Any]]]:
+    extracted = collect_instance_reqs(
+        iml, tree, byte_range=byte_range, point_range=point_range
+    )
+    new_iml, new_tree = extracted.stripped
+    return new_iml, new_tree, extracted.reqs
 
 
-def remove_decomp_reqs(
-    iml: str,
+@instrumented
+def remove_decomp_reqs[S: (str, bytes)](
+    iml: S,
     tree: Tree,
     captures: list[DecompCapture],
-) -> tuple[str, Tree]:
+) -> tuple[S, Tree]:
     """Remove decomp requests from IML code."""
     decomp_attr_nodes = [capture.decomp_attr for capture in captures]
     new_iml, new_tree = delete_nodes(iml, tree, nodes=decomp_attr_nodes)
     return new_iml, new_tree
 
 
-def extract_decomp_reqs(
-    iml: str, tree: Tree
-) -> tuple[str, Tree, list[dict[str, Any]]]:
-    root = tree.root_node
+@instrumented
+def collect_decomp_reqs[S: (str, bytes)](
+    iml: S,
+    tree: Tree,
+    *,
+    byte_range: ByteRange | None = None,
+    point_range: PointRange | None = None,
+) -> ExtractedReqs[S]:
+    """Collect the decomp requests, within the given range if any."""
     matches = run_query(
         mk_query(DECOMP_QUERY_SRC),
-        node=root,
+        node=tree.root_node,
+        byte_range=byte_range,
+        point_range=point_range,
     )
 
     decomp_captures = [
         DecompCapture.from_ts_capture(capture) for _, capture in matches
     ]
+    source = _source_text(iml)
+    return ExtractedReqs(
+        iml,
+        tree,
+        reqs=[
+            dict[str, Any](decomp_capture_to_req(capture, source))
+            for capture in decomp_captures
+        ],
+        nodes=[capture.decomp_attr for capture in decomp_captures],
+    )
 
-    reqs = [decomp_capture_to_req(capture) for capture in decomp_captures]
-    new_iml, new_tree = remove_decomp_reqs(iml, tree, decomp_captures)
-    return new_iml, new_tree, reqs
 
+@instrumented
+def extract_decomp_reqs[S: (str, bytes)](
+    iml: S,
+    tree: Tree,
+    *,
+    byte_range: ByteRange | None = None,
+    point_range: PointRange | None = None,
+) -> tuple[S, Tree, list[dict[str, Any]]]:
+    extracted = collect_decomp_reqs(
+        iml, tree, byte_range=byte_range, point_range=point_range
+    )
+    new_iml, new_tree = extracted.stripped
+    return new_iml, new_tree, extracted.reqs
+
+
+def named_item_to_req(
+    node: Node, name_node: Node, source: SourceText | None = None
+) -> dict[str, str]:
+    """Extract name and source of a theorem, lemma or axiom definition."""
+    return {
+        'name': node_text(name_node, source),
+        'src': node_text(node, source).strip(),
+    }
+
+
+@instrumented
+def iml_outline(
+    iml: Source,
+    tree: Tree | None = None,
+    *,
+    byte_range: ByteRange | None = None,
+    point_range: PointRange | None = None,
+) -> dict[str, Any]:
+    """Summarize the requests and annotated definitions of IML code.
+
+    All items are collected by a single merged query over the tree, without
+    editing or reparsing the code. The code is parsed if `tree` is not given.
+    With a range, only the items intersecting it are included.
+    """
+    if tree is None:
+        iml = source_bytes(iml)
+        tree = parse(iml)
+    return node_outline(
+        tree.root_node,
+        byte_range=byte_range,
+        point_range=point_range,
+        source=_source_text(iml),
+    )
+
+
+def node_outline(
+    node: Node,
+    *,
+    byte_range: ByteRange | None = None,
+    point_range: PointRange | None = None,
+    source: SourceText | None = None,
+) -> dict[str, Any]:
+    """Summarize the requests and annotated definitions within `node`.
+
+    The outline of a document is the concatenation, key by key, of the
+    outlines of its top-level items. Node texts are read from `source` if
+    given.
+    """
+    return outline_from_captures(
+        run_queries(
+            OUTLINE_QUERIES,
+            node,
+            byte_range=byte_range,
+            point_range=point_range,
+        ),
+        source,
+    )
+
+
+def outline_from_captures(
+    captures_map: dict[str, list[dict[str, list[Node]]]],
+    source: SourceText | None = None,
+) -> dict[str, Any]:
+    """Build an outline from the `run_queries` results of `OUTLINE_QUERIES`.
+
+    Node texts are read from `source` if given.
+    """
+
+    def captures(query_name: str) -> list[dict[str, list[Node]]]:
+        return captures_map.get(query_name, [])
 
-def iml_outline(iml: str) -> dict[str, Any]:
     outline: dict[str, Any] = {}
-    tree = get_parser().parse(bytes(iml, encoding='utf8'))
-    outline['verify_req'] = extract_verify_reqs(iml, tree)[2]
-    outline['instance_req'] = extract_instance_reqs(iml, tree)[2]
-    outline['decompose_req'] = extract_decomp_reqs(iml, tree)[2]
-    outline['opaque_function'] = extract_opaque_function_names(iml)
+    outline['verify_req'] = [
+        verify_capture_to_req(VerifyCapture.from_ts_capture(capture), source)
+        for capture in captures('verify')
+    ]
+    outline['instance_req'] = [
+        instance_capture_to_req(
+            InstanceCapture.from_ts_capture(capture), source
+        )
+        for capture in captures('instance')
+    ]
+    outline['decompose_req'] = [
+        decomp_capture_to_req(DecompCapture.from_ts_capture(capture), source)
+        for capture in captures('decomp')
+    ]
+    outline['opaque_function'] = [
+        node_text(OpaqueCapture.from_ts_capture(capture).function_name, source)
+        for capture in captures('opaque')
+    ]
+    outline['eval_req'] = [
+        {
+            'src': eval_node_to_src(
+                EvalCapture.from_ts_capture(capture).eval, source
+            )
+        }
+        for capture in captures('eval')
+    ]
+    outline['theorem'] = [
+        named_item_to_req(c.theorem, c.theorem_name, source)
+        for c in map(TheoremCapture.from_ts_capture, captures('theorem'))
+    ]
+    outline['lemma'] = [
+        named_item_to_req(c.lemma, c.lemma_name, source)
+        for c in map(LemmaCapture.from_ts_capture, captures('lemma'))
+    ]
+    outline['axiom'] = [
+        named_item_to_req(c.axiom, c.axiom_name, source)
+        for c in map(AxiomCapture.from_ts_capture, captures('axiom'))
+    ]
     return outline
 
 
-def insert_decomp_req(
-    iml: str,
-    tree: Tree,
+def outline_source(iml: Source) -> dict[str, Any]:
+    """Outline a source, parsed without going through the tree cache."""
+    src = source_bytes(iml)
+    return iml_outline(src, parse(src, cache=False))
+
+
+def extract_reqs_source(
+    iml: str | bytes,
+) -> dict[str, list[dict[str, Any]]]:
+    """Collect the verify, instance and decomp requests of a source.
+
+    The source is parsed once, without going through the tree cache, and
+    left untouched. Text is encoded once, so that node texts are read from
+    the encoded buffer rather than copied from the tree.
+    """
+    src = iml.encode('utf-8') if isinstance(iml, str) else iml
+    tree = parse(src, cache=False)
+    return {
+        'verify': collect_verify_reqs(src, tree).reqs,
+        'instance': collect_instance_reqs(src, tree).reqs,
+        'decomp': collect_decomp_reqs(src, tree).reqs,
+    }
+
+
+def stage_decomp_req[S: (str, bytes)](
+    session: EditSession[S],
     req: dict[str, Any],
-) -> tuple[str, Tree]:
-    func_def_node = find_func_definition(tree, req['name'])
+    index: DefinitionIndex | None = None,
+) -> None:
+    """Add the insertion of a decomp request to an edit session.
+
+    Pass a `DefinitionIndex` of `session.tree` when staging many requests.
+    """
+    func_def_node = find_func_definition(session.tree, req['name'], index)
     if func_def_node is None:
         raise ValueError(f'Function {req["name"]} not found in syntax tree')
 
     func_def_end_row = func_def_node.end_point[0]
 
-    top_appl_text = decomp_req_to_top_appl_text(req)
-    to_insert = f'[@@decomp {top_appl_text}]'
+    payload_text = decomp_req_to_payload_text(req)
+    to_insert = f'[@@decomp {payload_text}]'
 
-    new_iml, new_tree = insert_lines(
-        iml,
-        tree,
-        lines=[to_insert],
-        insert_after=func_def_end_row,
-    )
-    return new_iml, new_tree
+    session.insert_lines(lines=[to_insert], insert_after=func_def_end_row)
 
 
-def insert_verify_req(
-    iml: str,
+@instrumented
+def insert_decomp_req[S: (str, bytes)](
+    iml: S,
     tree: Tree,
-    verify_src: str,
-) -> tuple[str, Tree]:
+    req: dict[str, Any],
+    line_index: LineIndex | None = None,
+) -> tuple[S, Tree]:
+    session = EditSession[S](iml, tree, line_index)
+    stage_decomp_req(session, req)
+    return session.commit()
+
+
+def stage_verify_req[S: (str, bytes)](
+    session: EditSession[S], verify_src: str
+) -> None:
+    """Add the insertion of a verify request to an edit session."""
     if not (verify_src.startswith('(') and verify_src.endswith(')')):
         verify_src = f'({verify_src})'
     to_insert = f'verify {verify_src}'
 
-    file_end_row = tree.root_node.end_point[0]
-
-    new_iml, new_tree = insert_lines(
-        iml,
-        tree,
-        lines=[to_insert],
-        insert_after=file_end_row,
-    )
-    return new_iml, new_tree
+    file_end_row = session.tree.root_node.end_point[0]
+    session.insert_lines(lines=[to_insert], insert_after=file_end_row)
 
 
-def insert_instance_req(
-    iml: str,
+@instrumented
+def insert_verify_req[S: (str, bytes)](
+    iml: S,
     tree: Tree,
-    instance_src: str,
-) -> tuple[str, Tree]:
+    verify_src: str,
+    line_index: LineIndex | None = None,
+) -> tuple[S, Tree]:
+    session = EditSession[S](iml, tree, line_index)
+    stage_verify_req(session, verify_src)
+    return session.commit()
+
+
+def stage_instance_req[S: (str, bytes)](
+    session: EditSession[S], instance_src: str
+) -> None:
+    """Add the insertion of an instance request to an edit session."""
     if not (instance_src.startswith('(') and instance_src.endswith(')')):
         instance_src = f'({instance_src})'
     to_insert = f'instance {instance_src}'
 
-    file_end_row = tree.root_node.end_point[0]
+    file_end_row = session.tree.root_node.end_point[0]
+    session.insert_lines(lines=[to_insert], insert_after=file_end_row)
 
-    new_iml, new_tree = insert_lines(
-        iml,
-        tree,
-        lines=[to_insert],
-        insert_after=file_end_row,
-    )
-    return new_iml, new_tree
+
+@instrumented
+def insert_instance_req[S: (str, bytes)](
+    iml: S,
+    tree: Tree,
+    instance_src: str,
+    line_index: LineIndex | None = None,
+) -> tuple[S, Tree]:
+    session = EditSession[S](iml, tree, line_index)
+    stage_instance_req(session, instance_src)
+    return session.commit()
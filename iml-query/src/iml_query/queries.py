@@ -2,21 +2,39 @@
 
 from __future__ import annotations
 
-from dataclasses import dataclass, fields
-from typing import Self
+from dataclasses import dataclass
+from inspect import get_annotations
+from typing import Any, ClassVar, Self
 
 from tree_sitter import Node
 
 
 @dataclass(frozen=True)
 class BaseCapture:
+    # Constructor field names, in order. `dataclass` orders the fields of
+    # the bases first, and only processes them after `__init_subclass__`,
+    # so they are read from the annotations.
+    _field_names: ClassVar[tuple[str, ...]] = ()
+
+    def __init_subclass__(cls, **kwargs: Any) -> None:
+        super().__init_subclass__(**kwargs)
+        captures = [c for c in cls.__mro__ if issubclass(c, BaseCapture)]
+        cls._field_names = tuple(
+            dict.fromkeys(
+                name
+                for c in reversed(captures)
+                if c is not BaseCapture
+                for name in get_annotations(c)
+            )
+        )
+
     @classmethod
     def from_ts_capture(cls, capture: dict[str, list[Node]]) -> Self:
-        capture_: dict[str, Node] = {k: v[0] for k, v in capture.items()}
+        """Build the capture from the first node of each of its fields.
 
-        field_names = {f.name for f in fields(cls)}
-        filtered = {k: v for k, v in capture_.items() if k in field_names}
-        return cls(**filtered)
+        Captures of the match that are not fields of the class are ignored.
+        """
+        return cls(*[capture[name][0] for name in cls._field_names])
 
 
 VERIFY_QUERY_SRC = r"""
@@ -40,17 +58,44 @@ class InstanceCapture(BaseCapture):
 
 
 AXIOM_QUERY_SRC = r"""
-(axiom_definition) @axiom
+(axiom_definition
+    (value_name) @axiom_name
+) @axiom
 """
 
+
+@dataclass(slots=True, frozen=True)
+class AxiomCapture(BaseCapture):
+    axiom: Node
+    axiom_name: Node
+
+
 THEOREM_QUERY_SRC = r"""
-(theorem_definition) @theorem
+(theorem_definition
+    (value_name) @theorem_name
+) @theorem
 """
 
+
+@dataclass(slots=True, frozen=True)
+class TheoremCapture(BaseCapture):
+    theorem: Node
+    theorem_name: Node
+
+
 LEMMA_QUERY_SRC = r"""
-(lemma_definition) @lemma
+(lemma_definition
+    (value_name) @lemma_name
+) @lemma
 """
 
+
+@dataclass(slots=True, frozen=True)
+class LemmaCapture(BaseCapture):
+    lemma: Node
+    lemma_name: Node
+
+
 DECOMP_QUERY_SRC = r"""
 (value_definition
     (let_binding
@@ -77,6 +122,11 @@ EVAL_QUERY_SRC = r"""
 """
 
 
+@dataclass(slots=True, frozen=True)
+class EvalCapture(BaseCapture):
+    eval: Node
+
+
 # TODO:
 # (path import with explicit module name)
 # [@@@import Mod_name, "path/to/file.iml"]
@@ -217,3 +267,40 @@ REC_QUERY_SRC = r"""
 class RecCapture(BaseCapture):
     function_definition: Node
     function_name: Node
+
+
+# Single-pattern queries merged into one query by `processing.iml_outline`
+OUTLINE_QUERIES: dict[str, str] = {
+    'verify': VERIFY_QUERY_SRC,
+    'instance': INSTANCE_QUERY_SRC,
+    'decomp': DECOMP_QUERY_SRC,
+    'opaque': OPAQUE_QUERY_SRC,
+    'eval': EVAL_QUERY_SRC,
+    'theorem': THEOREM_QUERY_SRC,
+    'lemma': LEMMA_QUERY_SRC,
+    'axiom': AXIOM_QUERY_SRC,
+}
+
+
+NESTED_MEASURE_QUERY_SRC = r"""
+; Find top-level functions
+(compilation_unit
+    (value_definition
+        (let_binding
+            pattern: (value_name) @top_func_name
+        )
+    ) @top_function
+)
+
+; Find functions with a measure attribute
+(value_definition
+    (let_binding
+        pattern: (value_name) @nested_func_name
+        (item_attribute
+            "[@@"
+            (attribute_id) @_measure_id
+            (#eq? @_measure_id "measure")
+        )
+    )
+) @nested_function
+"""
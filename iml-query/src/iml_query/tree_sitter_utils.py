@@ -1,13 +1,72 @@
-from collections import defaultdict
-from typing import cast, overload
+import hashlib
+import threading
+import time
+from collections import OrderedDict, defaultdict
+from collections.abc import Callable
+from functools import cache
+from itertools import pairwise
+from typing import Literal, NamedTuple, cast, overload
 
 import structlog
 import tree_sitter_iml
-from tree_sitter import Language, Node, Parser, Query, QueryCursor, Tree
+from tree_sitter import (
+    Language,
+    Node,
+    Parser,
+    Point,
+    Query,
+    QueryCursor,
+    Tree,
+)
+
+from iml_query import queries
+from iml_query.instrumentation import span
+from iml_query.line_index import LineIndex, end_point
 
 logger = structlog.get_logger(__name__)
 
+# IML code, as text or as UTF-8 encoded bytes
+type Source = str | bytes | memoryview
 
+
+def source_bytes(iml: Source) -> bytes | memoryview:
+    """Return the UTF-8 bytes of `iml`, without copying bytes sources."""
+    return iml.encode('utf-8') if isinstance(iml, str) else iml
+
+
+class SourceText:
+    """Text of the nodes of a tree, sliced from the source it was parsed from.
+
+    `Node.text` copies the bytes of the node on every access. Here, nodes
+    are memoryview slices of the source buffer, decoded only by `text`.
+
+    Example:
+        source = SourceText(src)
+        source.view(node) == b'verify'  # compared without copying
+        source.text(node)
+
+    """
+
+    __slots__ = ('_view',)
+
+    def __init__(self, src: bytes | memoryview) -> None:
+        self._view = memoryview(src)
+
+    def view(self, node: Node) -> memoryview:
+        return self._view[node.start_byte : node.end_byte]
+
+    def text(self, node: Node) -> str:
+        return str(self.view(node), 'utf-8')
+
+
+def node_text(node: Node, source: SourceText | None = None) -> str:
+    """Return the text of `node`, from `source` if given."""
+    if source is not None:
+        return source.text(node)
+    return unwrap_bytes(node.text).decode('utf-8')
+
+
+@cache
 def get_language(ocaml: bool = False) -> Language:
     """Get the tree-sitter language for the given language."""
     if ocaml:
@@ -29,50 +88,541 @@ def create_parser(ocaml: bool = False) -> Parser:
     return parser
 
 
-_parser: Parser | None = None
+class ParserPool:
+    """Hands out one reusable parser per thread and language.
+
+    `Parser` objects are not thread-safe, so each thread gets its own parser
+    for each grammar, created on first use and reused afterwards.
+    """
+
+    def __init__(self) -> None:
+        self._local = threading.local()
+
+    def get(self, ocaml: bool = False) -> Parser:
+        parsers: dict[bool, Parser] | None = getattr(
+            self._local, 'parsers', None
+        )
+        if parsers is None:
+            parsers = self._local.parsers = {}
+        parser = parsers.get(ocaml)
+        if parser is None:
+            parser = parsers[ocaml] = create_parser(ocaml)
+        return parser
+
+
+_parser_pool = ParserPool()
+
+
+def get_parser(ocaml: bool = False) -> Parser:
+    """Get the calling thread's parser for the given language."""
+    return _parser_pool.get(ocaml)
+
+
+# Approximate memory held by a parse tree per node, about 70 times the size
+# of the source on generated workloads
+_TREE_NODE_BYTES = 160
+
+
+class TreeCacheInfo(NamedTuple):
+    hits: int
+    misses: int
+    max_bytes: int
+    currbytes: int
+    currsize: int
+
+
+class TreeCache:
+    """Bounded, thread-safe LRU cache of parse trees.
+
+    Entries are keyed by (language name, digest of the source). The budget
+    is measured in bytes of memory held by the trees, estimated from their
+    number of nodes (see `tree_size`). Least recently used trees are evicted
+    once the total exceeds `max_bytes`.
+    """
+
+    def __init__(self, max_bytes: int = 256 * 1024 * 1024) -> None:
+        if max_bytes < 0:
+            raise ValueError('max_bytes must be non-negative')
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._lru: OrderedDict[tuple[str, bytes], tuple[Tree, int]] = (
+            OrderedDict()
+        )
+        self._currbytes = 0
+
+    @staticmethod
+    def key(language: Language, src: bytes | memoryview) -> tuple[str, bytes]:
+        return (
+            language.name or '',
+            hashlib.blake2b(src, digest_size=16).digest(),
+        )
+
+    @staticmethod
+    def tree_size(tree: Tree) -> int:
+        """Estimate the memory held by `tree`, in bytes."""
+        return tree.root_node.descendant_count * _TREE_NODE_BYTES
+
+    def get(self, key: tuple[str, bytes]) -> Tree | None:
+        with self._lock:
+            entry = self._lru.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            self._lru.move_to_end(key)
+            self.hits += 1
+            return entry[0]
+
+    def put(
+        self, key: tuple[str, bytes], tree: Tree, size: int | None = None
+    ) -> None:
+        """Store `tree`, charged `size` bytes or its `tree_size`."""
+        if size is None:
+            size = self.tree_size(tree)
+        if size > self.max_bytes:
+            return
+        with self._lock:
+            old = self._lru.pop(key, None)
+            if old is not None:
+                self._currbytes -= old[1]
+            self._lru[key] = (tree, size)
+            self._currbytes += size
+            while self._currbytes > self.max_bytes:
+                _, (_, evicted_size) = self._lru.popitem(last=False)
+                self._currbytes -= evicted_size
+
+    def info(self) -> TreeCacheInfo:
+        with self._lock:
+            return TreeCacheInfo(
+                hits=self.hits,
+                misses=self.misses,
+                max_bytes=self.max_bytes,
+                currbytes=self._currbytes,
+                currsize=len(self._lru),
+            )
+
+    def clear(self) -> None:
+        """Drop all entries and reset the counters."""
+        with self._lock:
+            self._lru.clear()
+            self._currbytes = 0
+            self.hits = 0
+            self.misses = 0
+
+
+_tree_cache = TreeCache()
+
+
+def parse(iml: Source, ocaml: bool = False, *, cache: bool = True) -> Tree:
+    """Parse code, reusing the tree of an earlier parse of the same code.
+
+    Trees are cached by content digest (see `TreeCache`). A copy is returned,
+    so editing it with `Tree.edit` does not affect the cache. With
+    `cache=False`, the cache is neither looked up nor filled, e.g. for code
+    that is analyzed once. A bytes or memoryview source is parsed without
+    being copied; the tree refers to it for `Node.text`, so it must not be
+    modified afterwards.
+    """
+    src = source_bytes(iml)
+    with span('parse', bytes=len(src)) as s:
+        if not cache:
+            tree = get_parser(ocaml).parse(src)
+            if s is not None:
+                s.attrs['cached'] = False
+                s.nodes = tree.root_node.descendant_count
+            return tree
+        key = TreeCache.key(get_language(ocaml), src)
+        tree = _tree_cache.get(key)
+        if s is not None:
+            s.attrs['cached'] = tree is not None
+        if tree is None:
+            tree = get_parser(ocaml).parse(src)
+            _tree_cache.put(key, tree)
+        if s is not None:
+            s.nodes = tree.root_node.descendant_count
+    return tree.copy()
+
+
+class TreeEdit(NamedTuple):
+    """Arguments of one `Tree.edit` call."""
+
+    start_byte: int
+    old_end_byte: int
+    new_end_byte: int
+    start_point: Point
+    old_end_point: Point
+    new_end_point: Point
+
+    def apply(self, tree: Tree) -> None:
+        tree.edit(
+            start_byte=self.start_byte,
+            old_end_byte=self.old_end_byte,
+            new_end_byte=self.new_end_byte,
+            start_point=self.start_point,
+            old_end_point=self.old_end_point,
+            new_end_point=self.new_end_point,
+        )
+
+
+def reparse(src: bytes | memoryview, edited_tree: Tree) -> Tree:
+    """Parse `src` incrementally, reusing `edited_tree`.
+
+    `edited_tree` must be the previous tree with the `Tree.edit` calls
+    matching the changes of the source applied.
+    """
+    with span('reparse', bytes=len(src)) as s:
+        tree = get_parser().parse(src, old_tree=edited_tree)
+        if s is not None:
+            s.nodes = tree.root_node.descendant_count
+            s.attrs['changed_ranges'] = len(edited_tree.changed_ranges(tree))
+    return tree
+
+
+def get_tree_cache() -> TreeCache:
+    """Return the cache used by `parse`."""
+    return _tree_cache
+
+
+def tree_cache_info() -> TreeCacheInfo:
+    """Return hit/miss statistics of the parse-tree cache."""
+    return _tree_cache.info()
+
+
+def clear_tree_cache() -> None:
+    _tree_cache.clear()
+
+
+class QueryCacheInfo(NamedTuple):
+    hits: int
+    misses: int
+    maxsize: int
+    currsize: int
+    pinned: int
+
+
+class QueryCache:
+    """Bounded, thread-safe LRU cache of compiled queries.
+
+    Entries are keyed by (language name, query source). Pinned entries are
+    never evicted and do not count towards `maxsize`.
+    """
+
+    def __init__(self, maxsize: int = 256) -> None:
+        if maxsize < 0:
+            raise ValueError('maxsize must be non-negative')
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._lru: OrderedDict[tuple[str, str], Query] = OrderedDict()
+        self._pinned: dict[tuple[str, str], Query] = {}
+
+    def get(
+        self,
+        language: Language,
+        query_src: str,
+        *,
+        pin: bool = False,
+    ) -> Query:
+        """Return the compiled query, compiling it on a miss."""
+        key = (language.name or '', query_src)
+        with self._lock:
+            query = self._pinned.get(key)
+            if query is None:
+                query = self._lru.get(key)
+                if query is not None:
+                    self._lru.move_to_end(key)
+            if query is not None:
+                self.hits += 1
+                return query
+            self.misses += 1
+
+        # Compile outside the lock so that a slow compilation does not block
+        # lookups of other queries. Two threads racing on the same key both
+        # compile, and the first one to store its query wins.
+        with span('query.compile', bytes=len(query_src)) as s:
+            query = Query(language, query_src)
+            if s is not None:
+                s.attrs['patterns'] = query.pattern_count
+
+        with self._lock:
+            if pin:
+                return self._pinned.setdefault(key, query)
+            if key in self._lru:
+                self._lru.move_to_end(key)
+                return self._lru[key]
+            if self.maxsize > 0:
+                self._lru[key] = query
+                while len(self._lru) > self.maxsize:
+                    self._lru.popitem(last=False)
+        return query
+
+    def info(self) -> QueryCacheInfo:
+        with self._lock:
+            return QueryCacheInfo(
+                hits=self.hits,
+                misses=self.misses,
+                maxsize=self.maxsize,
+                currsize=len(self._lru),
+                pinned=len(self._pinned),
+            )
+
+    def clear(self) -> None:
+        """Drop all entries, including pinned ones, and reset the counters."""
+        with self._lock:
+            self._lru.clear()
+            self._pinned.clear()
+            self.hits = 0
+            self.misses = 0
+
+
+_query_cache = QueryCache()
+
+# Built-in query sources are compiled at most once per process
+_BUILTIN_QUERY_SRCS: frozenset[str] = frozenset(
+    value
+    for name, value in vars(queries).items()
+    if name.endswith('_QUERY_SRC') and isinstance(value, str)
+)
+
+
+def mk_query(query_src: str, ocaml: bool = False) -> Query:
+    """Create a Tree-sitter query from the given source.
+
+    Compiled queries are cached per language. The built-in `*_QUERY_SRC`
+    queries from `iml_query.queries` are pinned in the cache.
+    """
+    return _query_cache.get(
+        get_language(ocaml),
+        query_src,
+        pin=query_src in _BUILTIN_QUERY_SRCS,
+    )
+
+
+def precompile_queries(ocaml: bool = False) -> None:
+    """Compile all built-in queries ahead of their first use."""
+    for query_src in _BUILTIN_QUERY_SRCS:
+        mk_query(query_src, ocaml)
+
+
+def query_cache_info() -> QueryCacheInfo:
+    """Return hit/miss statistics of the compiled-query cache."""
+    return _query_cache.info()
+
+
+def clear_query_cache() -> None:
+    _query_cache.clear()
+
+
+type Match = tuple[int, dict[str, list[Node]]]
+
+type ByteRange = tuple[int, int]
+
+type PointRange = tuple[Point | tuple[int, int], Point | tuple[int, int]]
+
+Truncation = Literal['match_limit', 'max_matches', 'timeout', 'cancelled']
 
+# Size of the byte ranges queried between two checks of the time budget and
+# of the progress callback. The limits are checked between ranges rather
+# than with `QueryCursor.matches(progress_callback=...)`, which crashes the
+# interpreter as soon as the callback lets the query go on.
+_QUERY_BATCH_BYTES = 64 * 1024
 
-def get_parser() -> Parser:
-    global _parser
-    if _parser is None:
-        _parser = create_parser()
-    return _parser
 
+class QueryMatches(list[Match]):
+    """Matches returned by `run_query`.
+
+    `truncated` tells why matches may be missing, or is None if the results
+    are complete:
+        'match_limit': more matches were in progress than `match_limit`
+        'max_matches': there were more than `max_matches` matches
+        'timeout': the time budget ran out
+        'cancelled': the progress callback asked to stop
+    """
+
+    truncated: Truncation | None = None
+
+
+class QueryCaptures(dict[str, list[dict[str, list[Node]]]]):
+    """Captures returned by `run_queries`, see `QueryMatches.truncated`."""
+
+    truncated: Truncation | None = None
 
-def mk_query(query_src: str) -> Query:
-    """Create a Tree-sitter query from the given source."""
-    return Query(iml_language, query_src)
+
+def _query_batches(node: Node, lo: int, hi: int) -> list[tuple[int, int]]:
+    """Split [lo, hi) into byte ranges ending at ends of descendants of `node`.
+
+    A descendant larger than a range is split along its own children, so a
+    single huge or deeply nested item is not queried in one go.
+    """
+    ranges: list[tuple[int, int]] = []
+    start = lo
+    # Node methods walk down from the root, a cursor stays linear in depth
+    cursor = node.walk()
+    more = cursor.goto_first_child_for_byte(lo) is not None
+    while more:
+        child = cursor.node
+        assert child is not None, 'Never: cursor without node'
+        if child.start_byte >= hi:
+            break
+        if (
+            child.end_byte - child.start_byte > _QUERY_BATCH_BYTES
+            and cursor.goto_first_child_for_byte(start) is not None
+        ):
+            continue
+        end = min(child.end_byte, hi)
+        if end - start >= _QUERY_BATCH_BYTES:
+            ranges.append((start, end))
+            start = end
+        while not (more := cursor.goto_next_sibling()):
+            if not cursor.goto_parent() or cursor.node == node:
+                break
+    if start < hi or not ranges:
+        ranges.append((start, hi))
+    return ranges
+
+
+def _run_batched(
+    cursor: QueryCursor,
+    node: Node,
+    matches: QueryMatches,
+    *,
+    byte_range: ByteRange,
+    max_matches: int | None,
+    deadline: float | None,
+    progress_callback: Callable[[int, int], bool] | None,
+) -> None:
+    """Run `cursor` over `byte_range` batch by batch, checking the limits.
+
+    Tree-sitter returns every match intersecting the queried range, so a
+    match is kept only in the batch where its first captured node starts;
+    matches starting before the range go to the first batch and matches
+    starting after it to the last one. Matches are kept in order until
+    `max_matches`, and the query stops at the first one past it.
+    """
+    lo, hi = byte_range
+    batches = _query_batches(node, lo, hi)
+    for i, (start, end) in enumerate(batches):
+        if progress_callback is not None and progress_callback(
+            start - lo, hi - lo
+        ):
+            matches.truncated = 'cancelled'
+            return
+        if deadline is not None and time.monotonic() >= deadline:
+            matches.truncated = 'timeout'
+            return
+
+        cursor.set_byte_range(start, end)
+        is_first, is_last = i == 0, i == len(batches) - 1
+        for match in cursor.matches(node):
+            match_start = min(
+                (n.start_byte for ns in match[1].values() for n in ns),
+                default=lo,
+            )
+            if (is_first or start <= match_start) and (
+                is_last or match_start < end
+            ):
+                if max_matches is not None and len(matches) >= max_matches:
+                    matches.truncated = 'max_matches'
+                    return
+                matches.append(match)
 
 
 def run_query(
     query: Query,
     *,
-    code: str | bytes | None = None,
+    code: Source | None = None,
     node: Node | None = None,
-) -> list[tuple[int, dict[str, list[Node]]]]:
+    byte_range: ByteRange | None = None,
+    point_range: PointRange | None = None,
+    match_limit: int | None = None,
+    max_matches: int | None = None,
+    timeout: float | None = None,
+    progress_callback: Callable[[int, int], bool] | None = None,
+) -> QueryMatches:
     """Run a Tree-sitter query on the given code or node.
 
+    With `byte_range` or `point_range`, only the matches intersecting the
+    range are returned, and the parts of the tree outside of it are skipped.
+
+    Without a `timeout`, `progress_callback` or `max_matches`, the query
+    runs in a single pass. Otherwise it runs over ranges of about 64 KiB of
+    consecutive descendants of `node`, splitting larger items along their
+    children, and stops between two ranges when the time budget runs out,
+    the callback asks to, or `max_matches` is reached. The results gathered
+    so far are returned, with `truncated` set. A range is never
+    interrupted, so the budget can be exceeded by the time to query one
+    range.
+
+    Arguments:
+        query: the compiled query
+        code: code to parse and query
+        node: node to query, instead of `code`
+        byte_range: (start_byte, end_byte) to restrict the query to
+        point_range: (start_point, end_point) to restrict the query to
+        match_limit: maximum number of matches in progress at once, see
+            `QueryCursor.match_limit`
+        max_matches: maximum number of matches returned
+        timeout: time budget in seconds
+        progress_callback: called before each range with the number of
+            bytes queried so far and the total; returning True cancels the
+            query
+
     Return:
         A list of tuples where the first element is the pattern index and
         the second element is a dictionary that maps capture names to nodes.
 
     """
-    if code is None == node is None:
+    if (code is None) == (node is None):
         raise ValueError('Exactly one of code or node must be provided')
 
     if code is not None:
-        if isinstance(code, str):
-            code = bytes(code, 'utf8')
-
-        parser = create_parser(ocaml=False)
-        tree = parser.parse(code)
-
-        node = tree.root_node
+        node = parse(code).root_node
 
     node = cast(Node, node)
-
-    cursor = QueryCursor(query=query)
-    return cursor.matches(node)
+    lo, hi = node.start_byte, node.end_byte
+    if byte_range is not None:
+        if byte_range[0] > byte_range[1]:
+            raise ValueError(f'Invalid byte range {byte_range}')
+        lo, hi = max(lo, byte_range[0]), max(lo, min(hi, byte_range[1]))
+
+    with span('query.run', bytes=hi - lo) as s:
+        cursor = (
+            QueryCursor(query)
+            if match_limit is None
+            else QueryCursor(query, match_limit=match_limit)
+        )
+        if point_range is not None:
+            cursor.set_point_range(*point_range)
+        matches = QueryMatches()
+        if (
+            timeout is None
+            and progress_callback is None
+            and max_matches is None
+        ):
+            if byte_range is not None:
+                cursor.set_byte_range(lo, hi)
+            matches.extend(cursor.matches(node))
+        else:
+            _run_batched(
+                cursor,
+                node,
+                matches,
+                byte_range=(lo, hi),
+                max_matches=max_matches,
+                deadline=None
+                if timeout is None
+                else time.monotonic() + timeout,
+                progress_callback=progress_callback,
+            )
+        if matches.truncated is None and cursor.did_exceed_match_limit:
+            matches.truncated = 'match_limit'
+        if s is not None:
+            s.nodes = node.descendant_count
+            s.matches = len(matches)
+            s.attrs['truncated'] = matches.truncated
+    return matches
 
 
 def merge_queries(queries: dict[str, str]) -> str:
@@ -101,18 +651,32 @@ def merge_queries(queries: dict[str, str]) -> str:
 def run_queries(
     queries: dict[str, str],
     node: Node,
-) -> dict[str, list[dict[str, list[Node]]]]:
+    *,
+    byte_range: ByteRange | None = None,
+    point_range: PointRange | None = None,
+    match_limit: int | None = None,
+    max_matches: int | None = None,
+    timeout: float | None = None,
+    progress_callback: Callable[[int, int], bool] | None = None,
+) -> QueryCaptures:
     """Run multiple queries.
 
+    The range and limits apply to all queries together, see `run_query`.
+
     Returns:
-    dict[str, list[dict[str, list[Node]]]]: A dictionary of query names to
-        a list of captures. Each capture is a dictionary of capture names to
-        capture values.
+    QueryCaptures: A dictionary of query names to a list of captures. Each
+        capture is a dictionary of capture names to capture values.
 
     """
     matches = run_query(
         mk_query(merge_queries(queries)),
         node=node,
+        byte_range=byte_range,
+        point_range=point_range,
+        match_limit=match_limit,
+        max_matches=max_matches,
+        timeout=timeout,
+        progress_callback=progress_callback,
     )
 
     # query name -> list of captures
@@ -122,7 +686,9 @@ def run_queries(
         query_name = query_names[patten_idx]
         captures_map[query_name].append(capture)
 
-    return dict(captures_map)
+    captures = QueryCaptures(captures_map)
+    captures.truncated = matches.truncated
+    return captures
 
 
 def unwrap_bytes(node_text: bytes | None) -> bytes:
@@ -181,206 +747,360 @@ def delete_nodes(
 ) -> tuple[str, None]: ...
 
 
+@overload
 def delete_nodes(
-    iml: str,
+    iml: bytes | memoryview,
+    old_tree: Tree,
+    *,
+    nodes: list[Node],
+) -> tuple[bytes, Tree]: ...
+
+
+@overload
+def delete_nodes(
+    iml: bytes | memoryview,
+    *,
+    nodes: list[Node],
+) -> tuple[bytes, None]: ...
+
+
+def delete_nodes(
+    iml: Source,
     old_tree: Tree | None = None,
     *,
     nodes: list[Node],
-) -> tuple[str, Tree | None]:
+) -> tuple[str | bytes, Tree | None]:
     """Delete nodes from IML string and return updated string and tree.
 
-    Return new tree if old_tree is provided.
+    Return new tree if old_tree is provided. The new code has the same type
+    as `iml`, except that a memoryview gives bytes. The text is rebuilt in a
+    single pass, so the cost is linear in the size of the code.
 
     Arguments:
         nodes: list of nodes to delete
-        iml: old IML code
+        iml: old IML code, as str or UTF-8 encoded bytes
         old_tree: old parsed tree
 
     """
     if not nodes:
+        if isinstance(iml, memoryview):
+            iml = bytes(iml)
         return iml, old_tree
 
-    # Extract byte ranges from nodes
-    edits = [node.byte_range for node in nodes]
-
     # Check for overlapping edits
-    sorted_edits = sorted(edits, key=lambda x: x[0])
-    for i in range(len(sorted_edits) - 1):
-        curr_end = sorted_edits[i][1]
-        next_start = sorted_edits[i + 1][0]
-        if curr_end > next_start:
+    sorted_nodes = sorted(nodes, key=lambda x: x.start_byte)
+    for prev, curr in pairwise(sorted_nodes):
+        if prev.end_byte > curr.start_byte:
             raise ValueError(
-                f'Overlapping nodes: positions {sorted_edits[i]} and '
-                f'{sorted_edits[i + 1]}'
+                f'Overlapping nodes: positions {prev.byte_range} and '
+                f'{curr.byte_range}'
             )
 
-    # Apply deletions to text in reverse order to avoid offset issues
-    edits_reversed = sorted(edits, key=lambda x: x[0], reverse=True)
-    iml_b = bytes(iml, encoding='utf8')
-    for start, end in edits_reversed:
-        iml_b = iml_b[:start] + iml_b[end:]
-    iml = iml_b.decode('utf8')
+    iml_b = source_bytes(iml)
+    with span('edit', bytes=len(iml_b)) as s:
+        if s is not None:
+            s.attrs['edits'] = len(sorted_nodes)
+        new_iml_b = _splice(
+            iml_b,
+            [(node.start_byte, node.end_byte, b'') for node in sorted_nodes],
+        )
+
+        # Apply tree edits if we have an old tree
+        if old_tree is not None:
+            old_tree = old_tree.copy()
+
+            # Apply tree edits back to front, so that the positions of the
+            # remaining nodes are not shifted by the edits already applied
+            for node in reversed(sorted_nodes):
+                old_tree.edit(
+                    start_byte=node.start_byte,
+                    old_end_byte=node.end_byte,
+                    new_end_byte=node.start_byte,
+                    start_point=node.start_point,
+                    old_end_point=node.end_point,
+                    new_end_point=node.start_point,
+                )
 
     # Get new tree
-    # Apply tree edits if we have an old tree
-    if old_tree is not None:
-        old_tree = old_tree.copy()
-
-        # Sort nodes by start position for tree editing
-        sorted_nodes = sorted(nodes, key=lambda x: x.start_byte)
-
-        # Apply tree edits in forward order
-        for node in sorted_nodes:
-            old_tree.edit(
-                start_byte=node.start_byte,
-                old_end_byte=node.end_byte,
-                new_end_byte=node.start_byte,
-                start_point=node.start_point,
-                old_end_point=node.end_point,
-                new_end_point=node.start_point,
+    new_tree = reparse(new_iml_b, old_tree) if old_tree is not None else None
+
+    if isinstance(iml, str):
+        return new_iml_b.decode('utf8'), new_tree
+    return new_iml_b, new_tree
+
+
+def _splice(
+    src: bytes | memoryview, edits: list[tuple[int, int, bytes]]
+) -> bytes:
+    """Replace byte ranges of `src` in a single pass.
+
+    Arguments:
+        src: old text
+        edits: (start_byte, end_byte, new_text) tuples, sorted by position
+            and non-overlapping
+
+    """
+    view = memoryview(src)
+    parts: list[bytes | memoryview] = []
+    offset = 0
+    for start, end, new_text in edits:
+        parts.append(view[offset:start])
+        parts.append(new_text)
+        offset = end
+    parts.append(view[offset:])
+    return b''.join(parts)
+
+
+class EditSession[S: (str, bytes)]:
+    """Batch insertions and deletions into a single text rebuild and reparse.
+
+    All positions refer to the original document. Edits are validated for
+    overlaps once on `commit`, the new text is assembled in one pass, the
+    tree receives one `Tree.edit` per change, and the new tree is produced
+    by exactly one incremental parse.
+
+    The new code is a str if `iml` is a str, and bytes otherwise; bytes and
+    memoryview sources are edited without being decoded.
+
+    A session is single-use: once committed, further edits or commits raise
+    a ValueError. Start a new session on the returned code and tree instead.
+
+    Example:
+        session = EditSession(iml, tree)
+        session.delete_nodes(verify_nodes)
+        session.insert_lines(['verify (fun x -> x > 0)'], insert_after=10)
+        new_iml, new_tree = session.commit()
+
+    """
+
+    @overload
+    def __init__(
+        self: 'EditSession[str]',
+        iml: str,
+        tree: Tree,
+        line_index: LineIndex | None = None,
+    ) -> None: ...
+
+    @overload
+    def __init__(
+        self: 'EditSession[bytes]',
+        iml: bytes | memoryview,
+        tree: Tree,
+        line_index: LineIndex | None = None,
+    ) -> None: ...
+
+    @overload
+    def __init__(
+        self,
+        iml: S,
+        tree: Tree,
+        line_index: LineIndex | None = None,
+    ) -> None: ...
+
+    def __init__(
+        self,
+        iml: Source,
+        tree: Tree,
+        line_index: LineIndex | None = None,
+    ) -> None:
+        """Start a session on `iml` and its parsed `tree`.
+
+        A `line_index` of `iml` is reused if given, and built on first use
+        otherwise. It is updated in place on `commit` to index the new code.
+        """
+        self.tree = tree
+        self.src = source_bytes(iml)
+        self._text = iml if isinstance(iml, str) else None
+        self._line_index = line_index
+        # (start_byte, old_end_byte, new_text); kept in insertion order
+        self._edits: list[tuple[int, int, bytes]] = []
+        self._eof_newline_added = False
+        self._committed = False
+        # Copy of the old tree with all edits applied, set by `commit`. It is
+        # the `old_tree` of the incremental parse, so
+        # `edited_tree.changed_ranges(new_tree)` reports what changed.
+        self.edited_tree: Tree | None = None
+        # Edits applied to `edited_tree`, in order, set by `commit`
+        self.tree_edits: list[TreeEdit] = []
+
+    @property
+    def line_index(self) -> LineIndex:
+        if self._line_index is None:
+            self._line_index = LineIndex(self.src)
+        return self._line_index
+
+    def replace(self, start_byte: int, end_byte: int, text: str) -> None:
+        """Replace the bytes in [start_byte, end_byte) with `text`."""
+        self._check_open()
+        if not 0 <= start_byte <= end_byte <= len(self.src):
+            raise ValueError(
+                f'Invalid byte range ({start_byte}, {end_byte}) for a '
+                f'document of {len(self.src)} bytes'
+            )
+        self._edits.append((start_byte, end_byte, text.encode('utf-8')))
+
+    def insert(self, byte_offset: int, text: str) -> None:
+        """Insert `text` at `byte_offset`."""
+        self.replace(byte_offset, byte_offset, text)
+
+    def delete(self, start_byte: int, end_byte: int) -> None:
+        """Delete the bytes in [start_byte, end_byte)."""
+        self.replace(start_byte, end_byte, '')
+
+    def delete_nodes(self, nodes: list[Node]) -> None:
+        for node in nodes:
+            self.delete(node.start_byte, node.end_byte)
+
+    def insert_lines(self, lines: list[str], insert_after: int) -> None:
+        """Insert lines of code after the given line number.
+
+        Same semantics as `insert_lines`. Several insertions after the same
+        line are kept in the order they were added.
+        """
+        self._check_open()
+        if not lines:
+            return
+
+        line_index = self.line_index
+        ends_with_newline = line_index.ends_with_newline
+        # Number of lines, not counting the empty row after a final newline
+        n_lines = line_index.row_count - int(ends_with_newline)
+        if not self.src:
+            n_lines = 0
+
+        # Allow insert_after == n_lines when last line ends with \n
+        # (tree.root_node.end_point can point to the line after the last)
+        max_insert_after = n_lines if ends_with_newline else n_lines - 1
+        if insert_after < 0 or insert_after > max_insert_after:
+            raise ValueError(
+                f'Line number {insert_after} out of range '
+                f'(0-{max_insert_after})'
             )
 
-        parser = create_parser(ocaml=False)
-        new_tree = parser.parse(iml_b, old_tree=old_tree)
-    else:
-        new_tree = None
+        if insert_after + 1 < line_index.row_count:
+            insert_byte_pos = line_index.line_start(insert_after + 1)
+            need_leading_newline = False
+        else:
+            # Inserting at the end of the document. If the last line has no
+            # trailing newline, it must be separated from the inserted lines,
+            # but only once for all insertions there.
+            insert_byte_pos = len(self.src)
+            need_leading_newline = (
+                bool(self.src)
+                and not ends_with_newline
+                and not self._eof_newline_added
+            )
+            self._eof_newline_added |= need_leading_newline
+
+        insert_text = '\n'.join(lines)
+        if not insert_text.endswith('\n'):
+            insert_text += '\n'
+        if need_leading_newline:
+            insert_text = '\n' + insert_text
+        self.insert(insert_byte_pos, insert_text)
+
+    def _check_open(self) -> None:
+        if self._committed:
+            raise ValueError('EditSession already committed')
+
+    def _code(self, src: bytes | memoryview) -> S:
+        """Return `src` with the type of the code the session started with."""
+        if self._text is None:
+            return cast(S, bytes(src))
+        if src is self.src:
+            return cast(S, self._text)
+        return cast(S, bytes(src).decode('utf-8'))
+
+    def commit(self) -> tuple[S, Tree]:
+        """Apply all collected edits and return the new code and tree."""
+        self._check_open()
+        if not self._edits:
+            self._committed = True
+            return self._code(self.src), self.tree
+
+        # Zero-width insertions sort before a deletion at the same offset;
+        # the sort is stable, so edits at the same offset keep their order.
+        edits = sorted(self._edits, key=lambda e: (e[0], e[1] > e[0]))
+        for prev, curr in pairwise(edits):
+            if prev[1] > curr[0]:
+                raise ValueError(
+                    f'Overlapping edits: positions {prev[:2]} and {curr[:2]}'
+                )
+
+        with span('edit', bytes=len(self.src)) as s:
+            if s is not None:
+                s.attrs['edits'] = len(edits)
+            new_src, tree, tree_edits = self._apply_edits(edits)
+        self._committed = True
+        self.edited_tree = tree
+        self.tree_edits = tree_edits
+
+        new_tree = reparse(new_src, tree)
+        return self._code(new_src), new_tree
+
+    def _apply_edits(
+        self, edits: list[tuple[int, int, bytes]]
+    ) -> tuple[bytes, Tree, list[TreeEdit]]:
+        """Splice sorted `edits` into the source and edit a copy of the tree."""
+        line_index = self.line_index
+        tree_edits: list[TreeEdit] = []
+        # Tree edits go back to front, so that the positions of the remaining
+        # edits are not shifted by the ones already applied
+        for start, old_end, new_text in reversed(edits):
+            start_point = line_index.point_at(start)
+            tree_edits.append(
+                TreeEdit(
+                    start,
+                    old_end,
+                    start + len(new_text),
+                    start_point,
+                    line_index.point_at(old_end),
+                    end_point(start_point, new_text),
+                )
+            )
+        new_src = _splice(self.src, edits)
+        line_index.apply_edits(edits)
 
-    return iml, new_tree
+        tree = self.tree.copy()
+        for tree_edit in tree_edits:
+            tree_edit.apply(tree)
+        return new_src, tree, tree_edits
 
 
-def insert_lines(
-    iml: str,
+def insert_lines[S: (str, bytes)](
+    iml: S,
     tree: Tree,
     lines: list[str],
     insert_after: int,
-) -> tuple[str, Tree]:
+    line_index: LineIndex | None = None,
+) -> tuple[S, Tree]:
     r"""Insert lines of code after the given line number.
 
-    AI: this is implemented by AI
-
     Arguments:
-        iml: old IML code
+        iml: old IML code, as str or UTF-8 encoded bytes
         tree: old parsed tree
         lines: list of lines to insert (without trailing newlines)
         insert_after: line number to insert after
             (0-based, must be < len(lines))
+        line_index: line index of `iml`, built if not given; updated in place
+            to index the new code
 
     Returns:
         new IML code and new tree
 
     Implementation notes:
         Leading newline handling:
-            When using splitlines(keepends=True), only the last line may lack
-            a trailing newline (if the original string doesn't end with '\n').
-            If inserting after such a line, we must prepend '\n' to separate
-            the existing line from the inserted content.
-
-        Tree edit point calculation:
-            Edit points are (row, col) tuples where col is the byte offset.
-
-            Case 1 - Last line without trailing newline:
-                start_point = (insert_after, byte_len_of_line)
-                Insertion happens at the end of the current line.
+            Only the last line may lack a trailing newline (if the original
+            string doesn't end with '\n'). If inserting after such a line, we
+            must prepend '\n' to separate the existing line from the inserted
+            content.
 
-            Case 2 - Normal line with trailing newline:
-                start_point = (insert_after + 1, 0)
-                Insertion happens at the beginning of the next line.
-
-            For both cases:
-                old_end_point = start_point (zero-width insertion)
-                new_end_point = (start_row + num_newlines, 0)
+        Use `EditSession` to apply many insertions with a single reparse.
 
     """
-    if not lines:
-        return iml, tree
-
-    tree = tree.copy()
-
-    # Split into lines to find insertion point
-    # TODO: use line info in tree to determine line number
-    iml_lines = iml.splitlines(keepends=True)
-
-    # Validate line number
-    # Allow insert_after == len(iml_lines) when last line ends with \n
-    # (tree.root_node.end_point can point to the line after the last)
-    max_insert_after = len(iml_lines) - 1
-    if iml_lines and iml_lines[-1].endswith('\n'):
-        max_insert_after = len(iml_lines)
-
-    if insert_after < 0 or insert_after > max_insert_after:
-        raise ValueError(
-            f'Line number {insert_after} out of range (0-{max_insert_after})'
-        )
-
-    # Calculate byte position for insertion
-    # Find the end of the line we're inserting after
-    if insert_after >= len(iml_lines):
-        # Inserting after the last line (when file ends with \n)
-        insert_byte_pos = sum(len(line.encode('utf-8')) for line in iml_lines)
-        need_leading_newline = False  # Last line already has \n
-    else:
-        lines_before = iml_lines[: insert_after + 1]
-        insert_byte_pos = sum(
-            len(line.encode('utf-8')) for line in lines_before
-        )
-        # Check if we need to add a leading newline
-        # (the last line might not end with "\n", so which case we need to add
-        # it)
-        need_leading_newline = not iml_lines[insert_after].endswith('\n')
-
-    # Prepare the text to insert (ensure lines end with newlines)
-    insert_text = '\n'.join(lines)
-    if not insert_text.endswith('\n'):
-        insert_text += '\n'
-    if need_leading_newline:
-        insert_text = '\n' + insert_text
-
-    insert_bytes = insert_text.encode('utf-8')
-    insert_length = len(insert_bytes)
-
-    # Calculate tree edit points
-    if insert_after >= len(iml_lines):
-        # Inserting after all lines (file ends with \n)
-        start_row = insert_after
-        start_col = 0
-    elif need_leading_newline:
-        # Inserting at the end of line insert_after (no trailing newline)
-        start_row = insert_after
-        start_col = len(iml_lines[insert_after].encode('utf-8'))
-    else:
-        # Inserting at the start of the next line
-        start_row = insert_after + 1
-        start_col = 0
-
-    start_point = (start_row, start_col)
-    old_end_point = start_point  # For insertion, old_end = start
-
-    # Calculate end point based on number of newlines inserted
-    num_newlines = insert_text.count('\n')
-    new_end_point = (start_row + num_newlines, 0)
-
-    # Apply tree edit
-    tree.edit(
-        start_byte=insert_byte_pos,
-        old_end_byte=insert_byte_pos,  # Insertion: old_end = start
-        new_end_byte=insert_byte_pos + insert_length,
-        start_point=start_point,
-        old_end_point=old_end_point,
-        new_end_point=new_end_point,
-    )
-
-    # Apply text insertion
-    iml_bytes = iml.encode('utf-8')
-    new_iml_bytes = (
-        iml_bytes[:insert_byte_pos] + insert_bytes + iml_bytes[insert_byte_pos:]
-    )
-    new_iml = new_iml_bytes.decode('utf-8')
-
-    # Parse new tree
-    parser = create_parser(ocaml=False)
-    new_tree = parser.parse(new_iml_bytes, old_tree=tree)
-
-    return new_iml, new_tree
+    session = EditSession[S](iml, tree, line_index)
+    session.insert_lines(lines, insert_after)
+    return session.commit()
 
 
 def fmt_node_with_leaf_text(node: Node) -> str:
@@ -1,3 +1,4 @@
+from importlib.metadata import PackageNotFoundError, version
 from pathlib import Path
 
 from rich.console import Console, RenderableType
@@ -20,6 +21,14 @@ def find_pyproject_dir(curr_path: Path, nth: int = 1) -> Path:
         curr_path = curr_path.parent
 
 
+def package_version(name: str) -> str:
+    """Return the installed version of a package, or 'unknown'."""
+    try:
+        return version(name)
+    except PackageNotFoundError:
+        return 'unknown'
+
+
 def get_rich_str(
     *renderables: RenderableType | object, plain: bool = True
 ) -> str:
@@ -0,0 +1,229 @@
+"""Deterministic generator of synthetic IML workloads.
+
+The generated code parses without errors and mixes the constructs that the
+queries of `iml_query` look for, in tunable proportions. Output is produced
+item by item, so files of hundreds of MB can be written in constant memory:
+
+    python -m iml_query.workload --size 100000000 -o big.iml
+
+Example:
+    iml = generate_iml(WorkloadSpec(definitions=50, let_rec_ratio=0.5))
+
+"""
+
+import argparse
+import random
+from collections.abc import Iterator, Sequence
+from dataclasses import dataclass
+from pathlib import Path
+
+_WORDS = (
+    'alpha', 'beta', 'gamma', 'delta', 'state', 'input', 'output', 'bound',
+    'measure', 'proof', 'lemma', 'invariant', 'step', 'value', 'list',
+    'tree', 'node', 'count', 'total', 'index', 'range',
+)  # fmt: skip
+
+
+@dataclass(slots=True, frozen=True)
+class WorkloadSpec:
+    """Shape of a synthetic workload.
+
+    Ratios are probabilities per top-level definition, except
+    `measure_ratio`, which applies to recursive definitions only.
+
+    Arguments:
+        definitions: number of top-level function definitions
+        max_let_depth: maximum number of nested `let ... in` per body
+        let_rec_ratio: recursive definitions
+        measure_ratio: recursive definitions with a `[@@measure]`
+        nested_rec_ratio: definitions with a local recursive helper,
+            annotated with a nested `[@@measure]`
+        opaque_ratio: `[@@opaque]` declarations
+        decomp_ratio: `[@@decomp]` attributes
+        verify_ratio: `verify` statements
+        instance_ratio: `instance` statements
+        eval_ratio: `eval` statements
+        imports: number of `[@@@import]` directives at the top of the file
+        comment_ratio: comments before a definition
+        comment_words: words per comment
+        string_ratio: string constants, as plain or quoted strings
+
+    """
+
+    definitions: int = 100
+    max_let_depth: int = 3
+    let_rec_ratio: float = 0.3
+    measure_ratio: float = 0.5
+    nested_rec_ratio: float = 0.1
+    opaque_ratio: float = 0.1
+    decomp_ratio: float = 0.2
+    verify_ratio: float = 0.3
+    instance_ratio: float = 0.2
+    eval_ratio: float = 0.1
+    imports: int = 2
+    comment_ratio: float = 0.3
+    comment_words: int = 12
+    string_ratio: float = 0.1
+
+
+class _Generator:
+    def __init__(self, spec: WorkloadSpec, seed: int) -> None:
+        self.spec = spec
+        self.rng = random.Random(seed)
+
+    def chance(self, ratio: float) -> bool:
+        return self.rng.random() < ratio
+
+    def words(self, n: int) -> str:
+        return ' '.join(self.rng.choice(_WORDS) for _ in range(n))
+
+    def imports(self) -> str:
+        return ''.join(
+            f'[@@@import Mod{i}, "lib/mod{i}.iml"]\n'
+            for i in range(self.spec.imports)
+        ) + ('\n' if self.spec.imports else '')
+
+    def body(self, arg: str, indent: str) -> str:
+        """Nested `let ... in` ending with an expression of `arg`."""
+        depth = self.rng.randint(0, self.spec.max_let_depth)
+        lines: list[str] = []
+        prev = arg
+        for d in range(depth):
+            op = self.rng.choice('+-*')
+            lines.append(
+                f'{indent}{"  " * d}let v{d} = {prev} {op} '
+                f'{self.rng.randint(1, 9)} in\n'
+            )
+            prev = f'v{d}'
+        lines.append(f'{indent}{"  " * depth}{prev}\n')
+        return ''.join(lines)
+
+    def definition(self, i: int) -> str:
+        spec = self.spec
+        parts: list[str] = []
+        if self.chance(spec.comment_ratio):
+            parts.append(f'(* {self.words(spec.comment_words)} *)\n')
+        if self.chance(spec.string_ratio):
+            if self.chance(0.5):
+                parts.append(f'let s{i} = "{self.words(4)}"\n\n')
+            else:
+                parts.append(f'let s{i} = {{|{self.words(4)}|}}\n\n')
+        if self.chance(spec.opaque_ratio):
+            parts.append(f'let g{i} : int -> int = ()\n[@@opaque]\n\n')
+
+        if self.chance(spec.let_rec_ratio):
+            parts.append(
+                f'let rec f{i} (x : int) : int =\n'
+                f'  if x <= 0 then 0\n'
+                f'  else\n'
+                f'{self.body("x", "    ")}'
+                f'    + f{i} (x - 1)\n'
+            )
+            if self.chance(spec.measure_ratio):
+                parts.append('[@@measure Ordinal.of_int x]\n')
+        elif self.chance(spec.nested_rec_ratio):
+            parts.append(
+                f'let f{i} (x : int) : int =\n'
+                f'  let rec go (n : int) : int =\n'
+                f'    if n <= 0 then 0 else 1 + go (n - 1)\n'
+                f'  [@@measure Ordinal.of_int n]\n'
+                f'  in\n'
+                f'{self.body("go x", "  ")}'
+            )
+        else:
+            parts.append(f'let f{i} (x : int) : int =\n{self.body("x", "  ")}')
+        if self.chance(spec.decomp_ratio):
+            parts.append('[@@decomp top ~prune:true ()]\n')
+        parts.append('\n')
+
+        if self.chance(spec.verify_ratio):
+            parts.append(f'verify (fun x -> x > 0 ==> f{i} x = f{i} x)\n\n')
+        if self.chance(spec.instance_ratio):
+            parts.append(
+                f'instance (fun x -> f{i} x = {self.rng.randint(0, 99)})\n\n'
+            )
+        if self.chance(spec.eval_ratio):
+            parts.append(f'eval (f{i} {self.rng.randint(0, 9)})\n\n')
+        return ''.join(parts)
+
+
+def iter_iml(
+    spec: WorkloadSpec | None = None,
+    *,
+    seed: int = 0,
+    target_bytes: int | None = None,
+) -> Iterator[str]:
+    """Yield the code of a workload, one chunk per top-level definition.
+
+    Arguments:
+        spec: shape of the workload, `WorkloadSpec()` by default
+        seed: the same seed and spec always give the same code
+        target_bytes: if given, generate definitions until the UTF-8 size
+            of the code reaches it, instead of `spec.definitions`
+
+    """
+    spec = spec if spec is not None else WorkloadSpec()
+    gen = _Generator(spec, seed)
+    chunk = gen.imports()
+    size = len(chunk)
+    yield chunk
+    i = 0
+    while (
+        size < target_bytes
+        if target_bytes is not None
+        else i < spec.definitions
+    ):
+        chunk = gen.definition(i)
+        size += len(chunk)  # the generated code is ASCII
+        yield chunk
+        i += 1
+
+
+def generate_iml(
+    spec: WorkloadSpec | None = None,
+    *,
+    seed: int = 0,
+    target_bytes: int | None = None,
+) -> str:
+    """Return the code of a workload, see `iter_iml`."""
+    return ''.join(iter_iml(spec, seed=seed, target_bytes=target_bytes))
+
+
+def write_iml(
+    path: str | Path,
+    spec: WorkloadSpec | None = None,
+    *,
+    seed: int = 0,
+    target_bytes: int | None = None,
+) -> int:
+    """Write a workload to `path` and return its size in bytes."""
+    size = 0
+    with Path(path).open('w', encoding='utf-8') as f:
+        for chunk in iter_iml(spec, seed=seed, target_bytes=target_bytes):
+            f.write(chunk)
+            size += len(chunk)
+    return size
+
+
+def main(argv: Sequence[str] | None = None) -> None:
+    parser = argparse.ArgumentParser(
+        description='Write a synthetic IML workload.'
+    )
+    parser.add_argument('-o', '--output', type=Path, required=True)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument(
+        '--size', type=int, help='target size in bytes (overrides --defs)'
+    )
+    parser.add_argument('--defs', type=int, default=WorkloadSpec().definitions)
+    args = parser.parse_args(argv)
+    size = write_iml(
+        args.output,
+        WorkloadSpec(definitions=args.defs),
+        seed=args.seed,
+        target_bytes=args.size,
+    )
+    print(f'Wrote {size} bytes to {args.output}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,150 @@
+import asyncio
+import threading
+import time
+
+import pytest
+
+from iml_query.aio import (
+    AsyncExecutor,
+    aextract_decomp_reqs,
+    aiml_outline,
+    aparse,
+    arun_query,
+)
+from iml_query.instrumentation import Span, add_hook, remove_hook
+from iml_query.processing import (
+    extract_decomp_reqs,
+    extract_verify_reqs,
+    iml_outline,
+)
+from iml_query.queries import VERIFY_QUERY_SRC
+from iml_query.tree_sitter_utils import (
+    clear_tree_cache,
+    get_parser,
+    mk_query,
+    parse,
+    run_query,
+)
+
+IML = """\
+let f x = x + 1
+[@@decomp top ()]
+
+verify (fun x -> f x > x)
+"""
+
+
+def test_async_api_matches_sync_api():
+    executor = AsyncExecutor(max_workers=2)
+
+    async def main():
+        return await asyncio.gather(
+            aparse(IML, executor=executor),
+            aiml_outline(IML, executor=executor),
+            aextract_decomp_reqs(IML, executor=executor),
+            arun_query(mk_query(VERIFY_QUERY_SRC), code=IML, executor=executor),
+        )
+
+    tree, outline, (iml2, _, reqs), matches = asyncio.run(main())
+    executor.shutdown()
+
+    sync_tree = get_parser().parse(IML.encode())
+    assert str(tree.root_node) == str(sync_tree.root_node)
+    assert outline == iml_outline(IML)
+    sync_iml2, _, sync_reqs = extract_decomp_reqs(IML, sync_tree)
+    assert (iml2, reqs) == (sync_iml2, sync_reqs)
+    assert len(matches) == 1
+    assert matches.truncated is None
+    # Node texts are read from the source once the parse is done
+    (_, capture), *_ = run_query(
+        mk_query(VERIFY_QUERY_SRC), node=sync_tree.root_node
+    )
+    assert matches[0][1]['verify'][0].text == capture['verify'][0].text
+    assert tree.root_node.text == IML.encode()
+
+
+def test_async_executor_limits_concurrency():
+    executor = AsyncExecutor(max_workers=4, max_concurrency=2)
+    lock = threading.Lock()
+    active = 0
+    peak = 0
+
+    def work(_cancelled: threading.Event) -> None:
+        nonlocal active, peak
+        with lock:
+            active += 1
+            peak = max(peak, active)
+        time.sleep(0.02)
+        with lock:
+            active -= 1
+
+    async def main():
+        await asyncio.gather(*(executor.run(work) for _ in range(8)))
+
+    asyncio.run(main())
+    # A second event loop gets its own limit
+    asyncio.run(main())
+    executor.shutdown()
+    assert peak == 2
+
+
+def test_async_parse_cancellation():
+    executor = AsyncExecutor(max_workers=1)
+    iml = 'let f x = x + 1\n' * 200_000
+
+    start = time.perf_counter()
+    get_parser().parse(iml.encode())
+    full_parse_time = time.perf_counter() - start
+
+    async def main() -> float:
+        task = asyncio.create_task(aparse(iml, executor=executor))
+        await asyncio.sleep(0.01)
+        start = time.perf_counter()
+        task.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await task
+        cancel_time = time.perf_counter() - start
+        # The worker is free again
+        tree = await aparse('let g y = y', executor=executor)
+        assert tree.root_node.child_count == 1
+        return cancel_time
+
+    cancel_time = asyncio.run(main())
+    executor.shutdown()
+    # The parse stopped instead of running to completion
+    assert cancel_time < full_parse_time / 2
+
+
+def test_async_cancellation_after_parse():
+    executor = AsyncExecutor(max_workers=1)
+    iml = 'let f x = x + 1\nverify (fun x -> f x > x)\n' * 2_000
+    parsed = threading.Event()
+    resume = threading.Event()
+
+    def hook(span: Span) -> None:
+        # Hold the worker between the parse and the outline
+        if span.name == 'parse' and not parsed.is_set():
+            parsed.set()
+            resume.wait()
+
+    async def main() -> bool:
+        task = asyncio.create_task(aiml_outline(iml, executor=executor))
+        await asyncio.to_thread(parsed.wait)
+        task.cancel()
+        await asyncio.sleep(0.01)
+        resume.set()
+        done, _ = await asyncio.wait([task], timeout=5)
+        return task in done and task.cancelled()
+
+    clear_tree_cache()
+    add_hook(hook)
+    try:
+        assert asyncio.run(main())
+    finally:
+        remove_hook(hook)
+        resume.set()
+        executor.shutdown(wait=False)
+
+    # The tree cached by the cancelled call still reads the source
+    _, _, reqs = extract_verify_reqs(iml, parse(iml))
+    assert len(reqs) == 2_000
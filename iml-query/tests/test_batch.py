@@ -0,0 +1,60 @@
+from pathlib import Path
+
+from iml_query.batch import extract_reqs_many, init_worker, outline_many
+from iml_query.processing import iml_outline
+from iml_query.tree_sitter_utils import clear_query_cache, query_cache_info
+
+
+def _write_models(tmp_path: Path, n: int) -> list[Path]:
+    paths: list[Path] = []
+    for i in range(n):
+        path = tmp_path / f'model_{i}.iml'
+        path.write_text(
+            f'let f{i} x = x + {i}\n'
+            f'[@@decomp top ()]\n\n'
+            f'verify (fun x -> f{i} x > x)\n'
+            f'instance (fun x -> f{i} x = {i + 1})\n'
+        )
+        paths.append(path)
+    return paths
+
+
+def test_init_worker_compiles_outline_query():
+    clear_query_cache()
+    init_worker()
+    misses = query_cache_info().misses
+
+    iml_outline('let f x = x + 1\n[@@decomp top ()]\n')
+    assert query_cache_info().misses == misses
+
+
+def test_outline_many(tmp_path: Path):
+    paths = _write_models(tmp_path, 12)
+    missing = tmp_path / 'missing.iml'
+    paths.insert(5, missing)
+
+    in_process = outline_many(paths, workers=0)
+    pooled = outline_many(paths, workers=2, chunksize=3)
+
+    assert [r.path for r in pooled] == paths
+    assert pooled == in_process
+    assert not pooled[5].ok
+    assert pooled[5].error is not None
+    assert pooled[5].error.startswith('FileNotFoundError')
+    assert pooled[0].result == iml_outline(paths[0].read_text())
+
+
+def test_extract_reqs_many(tmp_path: Path):
+    paths = _write_models(tmp_path, 3)
+    results = extract_reqs_many(paths, workers=2)
+
+    assert all(r.ok for r in results)
+    assert results[2].result == {
+        'verify': [{'src': 'fun x -> f2 x > x'}],
+        'instance': [{'src': 'fun x -> f2 x = 3'}],
+        'decomp': [
+            {'name': 'f2', 'basis': [], 'rule_specs': [], 'prune': False}
+        ],
+    }
+    # The files are read, not modified
+    assert paths[2].read_text().startswith('let f2 x = x + 2\n[@@decomp')
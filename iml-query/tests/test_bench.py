@@ -0,0 +1,31 @@
+import json
+from pathlib import Path
+
+from iml_query.bench import main
+
+CORPUS = Path(__file__).parents[2] / 'test' / 'corpus'
+
+
+def test_bench_report_and_baseline(tmp_path: Path):
+    output = tmp_path / 'bench.json'
+    args = ['--sizes', '2', '--repeat', '2', '--warmup', '0']
+    assert main([*args, '--corpus', str(CORPUS), '--output', str(output)]) == 0
+
+    report = json.loads(output.read_text())
+    results = report['results']
+    assert {r['input'] for r in results} == {'synthetic-2', 'corpus'}
+    assert {r['case'] for r in results} >= {
+        'parse',
+        'run_query',
+        'iml_outline',
+        'delete_nodes',
+        'insert_lines',
+        'extract_decomp_reqs',
+    }
+    assert all(r['p50_ms'] <= r['p99_ms'] for r in results)
+
+    # A baseline faster than anything achievable makes every case regress
+    for r in results:
+        r['p50_ms'] = 1e-9
+    output.write_text(json.dumps(report))
+    assert main([*args, '--cases', 'parse', '--baseline', str(output)]) == 1
@@ -0,0 +1,68 @@
+from pathlib import Path
+
+from iml_query.cache import AnalysisCache
+from iml_query.processing import iml_outline
+
+IML = """\
+let f x =
+  let rec g y = if y <= 0 then 0 else g (y - 1)
+  [@@measure Ordinal.of_int y]
+  in
+  g x
+
+verify (fun x -> f x >= 0)
+"""
+
+
+def test_analysis_cache_hits(tmp_path: Path):
+    with AnalysisCache(tmp_path) as cache:
+        outline = cache.iml_outline(IML)
+        assert outline == iml_outline(IML)
+        assert cache.iml_outline(IML) == outline
+        measures = cache.find_nested_measures(IML)
+        assert [m['top_level_function_name'] for m in measures] == ['f']
+        assert measures[0]['nested_measures'][0]['level'] == 1
+        assert cache.find_nested_rec(IML)[0]['name'] == 'g'
+        assert cache.collect_reqs(IML)['verify'] == [
+            {'src': 'fun x -> f x >= 0'}
+        ]
+        info = cache.info()
+        assert (info.hits, info.misses, info.entries) == (1, 4, 4)
+        # The analyses of a source share one digest
+        assert cache.digest(IML) is cache.digest(IML)
+
+    # Results persist across instances
+    with AnalysisCache(tmp_path) as cache:
+        assert cache.iml_outline(IML) == outline
+        assert cache.find_nested_measures(IML) == measures
+        assert cache.info().hits == 2
+        # Another text is another entry
+        cache.iml_outline(IML + '\n')
+        assert cache.info().misses == 1
+
+
+def test_analysis_cache_eviction(tmp_path: Path):
+    with AnalysisCache(tmp_path, max_size=600) as cache:
+        texts = [f'let f{i} x = x + {i}\n' for i in range(6)]
+        for text in texts:
+            cache.iml_outline(text)
+        info = cache.info()
+        assert info.size <= 600
+        assert 0 < info.entries < 6
+        # The most recent entry is kept, the oldest is evicted
+        assert cache.get(cache.key('iml_outline', texts[-1])) is not None
+        assert cache.get(cache.key('iml_outline', texts[0])) is None
+
+
+def test_analysis_cache_size_total(tmp_path: Path):
+    with AnalysisCache(tmp_path) as cache:
+        cache.set('kind:a', [1, 2, 3])
+        cache.set('kind:a', [1])
+        cache.set('kind:b', 'xy')
+        assert cache.info().size == len('[1]') + len('"xy"')
+
+    # The total is stored with the entries
+    with AnalysisCache(tmp_path) as cache:
+        assert cache.info().size == len('[1]') + len('"xy"')
+        cache.clear()
+        assert cache.info().size == 0
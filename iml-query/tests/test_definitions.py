@@ -0,0 +1,90 @@
+from inline_snapshot import snapshot
+
+from iml_query.definitions import DefinitionIndex
+from iml_query.processing import find_func_definition
+from iml_query.tree_sitter_utils import EditSession, SourceText, get_parser
+
+IML = """\
+let f x =
+  let rec g y =
+    if y <= 0 then 0 else g (y - 1)
+  [@@measure Ordinal.of_int y]
+  in
+  g x
+
+let rec even n = if n = 0 then true else odd (n - 1)
+and odd n = if n = 0 then false else even (n - 1)
+
+let secret x = x * 3
+[@@opaque]
+
+verify (fun x -> f x = 0)
+"""
+
+
+def summarize(index: DefinitionIndex) -> list[tuple[object, ...]]:
+    return [
+        (
+            d.name,
+            d.range.start_point,
+            d.range.end_point,
+            d.top_level,
+            d.recursive,
+            d.measure,
+            d.opaque,
+        )
+        for d in index
+    ]
+
+
+def test_definition_index():
+    tree = get_parser().parse(bytes(IML, encoding='utf8'))
+    index = DefinitionIndex(tree)
+
+    assert [
+        (d.name, d.top_level, d.recursive, d.measure, d.opaque) for d in index
+    ] == snapshot(
+        [
+            ('f', True, False, False, False),
+            ('g', False, True, True, False),
+            ('even', True, True, False, False),
+            ('odd', True, True, False, False),
+            ('secret', True, False, False, True),
+        ]
+    )
+    for name in ['f', 'g', 'even', 'odd', 'secret']:
+        definition = index.first(name)
+        assert definition is not None
+        assert definition.node == find_func_definition(tree, name)
+    assert 'h' not in index
+    assert index.first('h') is None
+    assert index.get('even')[0].node == index.get('odd')[0].node
+
+    # Names read from the source buffer
+    with_source = DefinitionIndex(tree, source=SourceText(IML.encode()))
+    assert summarize(with_source) == summarize(index)
+
+
+def test_definition_index_refresh():
+    tree = get_parser().parse(bytes(IML, encoding='utf8'))
+    index = DefinitionIndex(tree)
+    collected = index.items_collected
+    assert collected == len(tree.root_node.children)
+
+    session = EditSession(IML, tree)
+    session.insert(0, '(* header *)\n')
+    session.replace(IML.index('secret'), IML.index('secret') + 6, 'hidden')
+    new_iml, new_tree = session.commit()
+    assert session.edited_tree is not None
+    index.refresh(new_tree, session.edited_tree, session.tree_edits)
+
+    assert summarize(index) == summarize(DefinitionIndex(new_tree))
+    assert index.first('hidden') is not None
+    assert 'secret' not in index
+    # Items away from the edits, such as `let rec even ... and odd ...`, are
+    # not walked again
+    assert index.items_collected - collected < len(new_tree.root_node.children)
+    odd = index.first('odd')
+    assert odd is not None
+    assert odd.node == find_func_definition(new_tree, 'odd')
+    assert new_iml.startswith('(* header *)')
@@ -0,0 +1,112 @@
+import random
+
+import pytest
+
+from iml_query.definitions import DefinitionIndex
+from iml_query.document import ContentChange, ImlDocument, Position
+from iml_query.processing import DecompParsingError, iml_outline
+from iml_query.tree_sitter_utils import get_parser
+
+IML = """\
+let f x = x + 1
+[@@decomp top ()]
+
+let rec g y = if y <= 0 then 0 else g (y - 1)
+
+verify (fun x -> f x > x)
+
+let secret x = x * 3
+[@@opaque]
+
+instance (fun x -> g x = 0)
+"""
+
+
+def test_document_tracks_edits():
+    doc = ImlDocument(IML)
+    assert doc.outline == iml_outline(IML)
+    # Cached until the next edit
+    assert doc.outline is doc.outline
+    assert [d.name for d in doc.definitions] == ['f', 'g', 'secret']
+
+    computed = doc.outline_items_computed
+
+    # Edit the verify statement, on line 5
+    doc.apply_changes(
+        [
+            {
+                'range': {
+                    'start': {'line': 5, 'character': 17},
+                    'end': {'line': 5, 'character': 20},
+                },
+                'text': 'f (f x)',
+            }
+        ]
+    )
+    assert doc.version == 1
+    assert doc.verify_reqs == [{'src': 'fun x -> f (f x) > x'}]
+    assert doc.outline == iml_outline(doc.text)
+    # Only the edited item is outlined again
+    assert doc.outline_items_computed == computed + 1
+
+    doc.replace(doc.text.index('secret'), doc.text.index('secret') + 6, 'h')
+    assert [d.name for d in doc.definitions] == ['f', 'g', 'h']
+    assert doc.outline['opaque_function'] == ['h']
+    assert str(doc.tree.root_node) == str(get_parser().parse(doc.src).root_node)
+
+    doc.apply_changes([{'text': 'verify (fun x -> x = x)'}])
+    assert doc.verify_reqs == [{'src': 'fun x -> x = x'}]
+    assert len(doc.definitions) == 0
+
+
+def test_document_position_encodings():
+    iml = 'let s = "é😀" in s\n'
+    utf16 = ImlDocument(iml)
+    utf32 = ImlDocument(iml, position_encoding='utf-32')
+    utf8 = ImlDocument(iml, position_encoding='utf-8')
+
+    # Position right after the emoji
+    after_emoji = iml.encode().index(b'"', 9) + 0
+    assert utf16.byte_at({'line': 0, 'character': 12}) == after_emoji
+    assert utf32.byte_at({'line': 0, 'character': 11}) == after_emoji
+    assert utf8.byte_at({'line': 0, 'character': after_emoji}) == after_emoji
+    # Past the end of the line or of the document
+    assert utf16.byte_at({'line': 0, 'character': 99}) == len(iml.encode()) - 1
+    assert utf16.byte_at({'line': 5, 'character': 0}) == len(iml.encode())
+
+
+def _position(text: str, offset: int) -> Position:
+    prefix = text[:offset]
+    return {
+        'line': prefix.count('\n'),
+        'character': len(prefix) - (prefix.rfind('\n') + 1),
+    }
+
+
+def test_document_random_edits():
+    rng = random.Random(0)
+    doc = ImlDocument(IML)
+    snippets = ['', 'x', ' + 1', '\n', 'verify (fun y -> y = y)\n', 'let z = 2']
+    for _ in range(50):
+        text = doc.text
+        start = rng.randrange(len(text) + 1)
+        end = min(len(text), start + rng.randrange(5))
+        snippet = rng.choice(snippets)
+        change: ContentChange = {
+            'range': {
+                'start': _position(text, start),
+                'end': _position(text, end),
+            },
+            'text': snippet,
+        }
+        doc.apply_changes([change])
+        assert doc.text == text[:start] + snippet + text[end:]
+        try:
+            expected = iml_outline(doc.text)
+        except DecompParsingError:
+            with pytest.raises(DecompParsingError):
+                doc.outline  # noqa: B018
+        else:
+            assert doc.outline == expected
+        fresh = DefinitionIndex(get_parser().parse(doc.src))
+        assert [d.name for d in doc.definitions] == [d.name for d in fresh]
@@ -0,0 +1,116 @@
+import random
+
+from tree_sitter import Node
+
+from iml_query.incremental import IncrementalQuery, ItemSpans
+from iml_query.processing import collect_verify_reqs
+from iml_query.queries import OUTLINE_QUERIES
+from iml_query.tree_sitter_utils import EditSession, get_parser, run_queries
+
+
+def _summary(
+    captures_map: dict[str, list[dict[str, list[Node]]]],
+) -> dict[str, list[dict[str, list[tuple[str, int, int]]]]]:
+    return {
+        name: [
+            {
+                capture_name: [
+                    (n.type, n.start_byte, n.end_byte) for n in nodes
+                ]
+                for capture_name, nodes in capture.items()
+            }
+            for capture in captures
+        ]
+        for name, captures in captures_map.items()
+    }
+
+
+def _model(n: int) -> str:
+    return ''.join(
+        f'let f{i} x = x + {i}\n[@@decomp top ()]\n\n'
+        f'verify (fun x -> f{i} x > x)\n\n'
+        for i in range(n)
+    )
+
+
+def test_incremental_query_requeries_changed_items():
+    iml = _model(50)
+    tree = get_parser().parse(iml.encode())
+    query = IncrementalQuery(OUTLINE_QUERIES, tree)
+    assert _summary(query.captures()) == _summary(
+        run_queries(OUTLINE_QUERIES, tree.root_node)
+    )
+    assert query.queried_items == 100
+
+    # Delete one verify statement and add one at the end
+    session = EditSession(iml, tree)
+    session.delete_nodes(collect_verify_reqs(iml, tree).nodes[10:11])
+    session.insert_lines(
+        ['verify (fun x -> x = x)'], insert_after=tree.root_node.end_point[0]
+    )
+    new_iml, new_tree = session.commit()
+    assert session.edited_tree is not None
+    query.update(new_tree, session.edited_tree, session.tree_edits)
+
+    captures = query.captures()
+    assert _summary(captures) == _summary(
+        run_queries(OUTLINE_QUERIES, new_tree.root_node)
+    )
+    # Only the new item is queried; nodes belong to the new tree
+    assert query.queried_items == 101
+    verify = captures['verify'][-1]['verify'][0]
+    assert verify.text == b'verify (fun x -> x = x)'
+    assert len(captures['verify']) == 50
+    assert new_iml.count('verify') == 50
+
+
+def test_item_spans_follow_random_edits():
+    rng = random.Random(0)
+    iml = _model(30)
+    tree = get_parser().parse(iml.encode())
+    spans = ItemSpans(tree)
+    query = IncrementalQuery(OUTLINE_QUERIES, tree)
+    snippets = ['', 'x', ' + 1', '\n', '\nverify (fun y -> y = y)\n', '(* c *)']
+    for _ in range(60):
+        session = EditSession(iml, tree)
+        for _ in range(rng.randrange(1, 4)):
+            start = rng.randrange(len(iml) + 1)
+            session.replace(start, min(len(iml), start + rng.randrange(4)), '')
+        session.insert(rng.randrange(len(iml) + 1), rng.choice(snippets))
+        try:
+            iml, new_tree = session.commit()
+        except ValueError:  # overlapping edits
+            continue
+        assert session.edited_tree is not None
+        spans.update(new_tree, session.edited_tree, session.tree_edits)
+        query.update(new_tree, session.edited_tree, session.tree_edits)
+        tree = new_tree
+
+        children = tree.root_node.children
+        assert [
+            (spans.start(spans.span(i)), spans.end(spans.span(i)))
+            for i in range(len(spans))
+        ] == [(c.start_byte, c.end_byte) for c in children]
+        assert _summary(query.captures()) == _summary(
+            run_queries(OUTLINE_QUERIES, tree.root_node)
+        )
+    # Far fewer items are queried again than a full requery after each edit
+    assert query.queried_items < 60 + 6 * 60
+
+
+def test_incremental_query_caches_captures():
+    iml = _model(5)
+    tree = get_parser().parse(iml.encode())
+    query = IncrementalQuery(OUTLINE_QUERIES, tree)
+    captures = query.captures()
+    assert query.captures() is captures
+
+    session = EditSession(iml, tree)
+    session.insert(0, 'let z = 0\n')
+    _, new_tree = session.commit()
+    assert session.edited_tree is not None
+    query.update(new_tree, session.edited_tree, session.tree_edits)
+    assert query.captures() is not captures
+    assert query.captures()['verify'][0]['verify'][0].start_byte == (
+        captures['verify'][0]['verify'][0].start_byte + len('let z = 0\n')
+    )
@@ -0,0 +1,56 @@
+from iml_query.instrumentation import (
+    Span,
+    add_hook,
+    is_enabled,
+    record_spans,
+    remove_hook,
+)
+from iml_query.processing import iml_outline
+from iml_query.tree_sitter_utils import (
+    EditSession,
+    clear_tree_cache,
+    parse,
+)
+
+IML = """\
+let f x = x + 1
+
+verify (fun x -> f x > x)
+"""
+
+
+def test_spans_of_outline_and_edit():
+    assert not is_enabled()
+    clear_tree_cache()
+    with record_spans() as spans:
+        outline = iml_outline(IML)
+    assert outline['verify_req']
+    assert not is_enabled()
+
+    by_name = {s.name: s for s in spans}
+    assert by_name['parse'].bytes == len(IML)
+    assert by_name['parse'].attrs['cached'] is False
+    assert by_name['parse'].nodes
+    assert by_name['query.run'].matches == 1
+    assert by_name['processing.iml_outline'].bytes == len(IML)
+    # The outer span finishes last
+    assert spans[-1].name == 'processing.iml_outline'
+    assert all(s.duration_ns > 0 for s in spans)
+
+    session = EditSession(IML, parse(IML))
+    session.insert_lines(['verify (fun x -> x = x)'], insert_after=1)
+    with record_spans() as spans:
+        session.commit()
+    assert [s.name for s in spans] == ['edit', 'reparse']
+    assert spans[0].attrs['edits'] == 1
+
+
+def test_failing_hook_does_not_break_call():
+    def hook(_: Span) -> None:
+        raise RuntimeError('boom')
+
+    add_hook(hook)
+    try:
+        assert iml_outline(IML)['verify_req']
+    finally:
+        remove_hook(hook)
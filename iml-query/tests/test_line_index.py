@@ -0,0 +1,84 @@
+import random
+
+import pytest
+from inline_snapshot import snapshot
+from tree_sitter import Point
+
+from iml_query.line_index import LineIndex
+from iml_query.processing import insert_verify_req
+from iml_query.tree_sitter_utils import get_parser
+
+
+def test_line_index_conversions():
+    src = 'let x = 1\nlet é = 2\n\nverify (x = 1)'
+    index = LineIndex(src)
+
+    assert index.line_starts == snapshot([0, 10, 21, 22])
+    assert index.row_count == 4
+    assert not index.ends_with_newline
+
+    tree = get_parser().parse(bytes(src, encoding='utf8'))
+    for node in tree.root_node.children:
+        assert index.point_at(node.start_byte) == node.start_point
+        assert index.point_at(node.end_byte) == node.end_point
+        assert index.byte_at(node.start_point) == node.start_byte
+
+    assert index.line_end(1) == 21
+    assert index.line_end(3) == len(src.encode('utf-8'))
+    with pytest.raises(ValueError):
+        index.point_at(100)
+    with pytest.raises(ValueError):
+        index.byte_at(Point(0, 20))
+
+
+def test_line_index_incremental_edits():
+    rng = random.Random(0)
+    src = b''.join(
+        b'let f%d x =\n  x + %d\n' % (i, i) for i in range(20)
+    ).decode()
+    index = LineIndex(src)
+    for _ in range(50):
+        # A batch of sorted, non-overlapping replacements
+        starts = sorted(rng.sample(range(len(src) + 1), 3))
+        edits = [
+            (
+                start,
+                min(start + rng.randint(0, 8), next_start),
+                rng.choice(['', '\n', 'ab\ncd\n', 'xyz']).encode(),
+            )
+            for start, next_start in zip(
+                starts, [*starts[1:], len(src)], strict=True
+            )
+        ]
+        parts: list[str] = []
+        offset = 0
+        for start, end, text in edits:
+            parts += [src[offset:start], text.decode()]
+            offset = end
+        src = ''.join([*parts, src[offset:]])
+
+        index.apply_edits(edits)
+        fresh = LineIndex(src)
+        offsets = rng.sample(range(len(src) + 1), 5)
+        assert [index.point_at(o) for o in offsets] == [
+            fresh.point_at(o) for o in offsets
+        ]
+        assert (index.line_starts, index.length) == (
+            fresh.line_starts,
+            fresh.length,
+        )
+
+
+def test_insert_reqs_share_line_index():
+    iml = 'let f x = x + 1\n'
+    tree = get_parser().parse(bytes(iml, encoding='utf8'))
+    index = LineIndex(iml)
+
+    iml, tree = insert_verify_req(iml, tree, 'fun x -> f x > x', index)
+    iml, tree = insert_verify_req(iml, tree, 'fun x -> f x <> x', index)
+    assert iml == snapshot("""\
+let f x = x + 1
+verify (fun x -> f x > x)
+verify (fun x -> f x <> x)
+""")
+    assert index.line_starts == LineIndex(iml).line_starts
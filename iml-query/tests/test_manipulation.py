@@ -1,18 +1,27 @@
+import pytest
 from inline_snapshot import snapshot
 
+from iml_query.line_index import LineIndex
 from iml_query.processing import (
+    collect_decomp_reqs,
+    collect_instance_reqs,
+    collect_verify_reqs,
     decomp_req_to_top_appl_text,
     extract_decomp_reqs,
     extract_verify_reqs,
     find_func_definition,
     insert_decomp_req,
     insert_verify_req,
+    stage_decomp_req,
+    stage_instance_req,
+    stage_verify_req,
 )
 from iml_query.queries import (
     DECOMP_QUERY_SRC,
     VERIFY_QUERY_SRC,
 )
 from iml_query.tree_sitter_utils import (
+    EditSession,
     delete_nodes,
     get_parser,
     insert_lines,
@@ -83,7 +92,7 @@ if x = 1 || x = 2 then x + 1 else x - 1
     decomp_req_2 = decomp_reqs[1]
 
     assert decomp_req_to_top_appl_text(decomp_req_2) == snapshot(
-        'top ~basis:[[%id simple_branch] ; [%id f]] ~rule_specs:[[%id simple_branch]] ~prune:true ~assuming:[%id s] ~ctx_simp:true ()'  # noqa: E501
+        'top ~basis:[[%id simple_branch] ; [%id f]] ~rule_specs:[[%id simple_branch]] ~prune:true ~assuming:[%id simple_branch] ~ctx_simp:true ~lift_bool:Default ()'  # noqa: E501
     )
 
     # %%
@@ -108,7 +117,7 @@ let simple_branch x =if x = 1 || x = 2 then x + 1 else x - 1
 let f x = x + 1
 
 let simple_branch2  = simple_branch
-[@@decomp top ~basis:[[%id simple_branch] ; [%id f]] ~rule_specs:[[%id simple_branch]] ~prune:true ~assuming:[%id s] ~ctx_simp:true ()]
+[@@decomp top ~basis:[[%id simple_branch] ; [%id f]] ~rule_specs:[[%id simple_branch]] ~prune:true ~assuming:[%id simple_branch] ~ctx_simp:true ~lift_bool:Default ()]
 
 
 let simple_branch3 x =
@@ -124,7 +133,7 @@ let simple_branch x =if x = 1 || x = 2 then x + 1 else x - 1
 let f x = x + 1
 
 let simple_branch2  = simple_branch
-[@@decomp top ~basis:[[%id simple_branch] ; [%id f]] ~rule_specs:[[%id simple_branch]] ~prune:true ~assuming:[%id s] ~ctx_simp:true ()]
+[@@decomp top ~basis:[[%id simple_branch] ; [%id f]] ~rule_specs:[[%id simple_branch]] ~prune:true ~assuming:[%id simple_branch] ~ctx_simp:true ~lift_bool:Default ()]
 
 
 let simple_branch3 x =
@@ -408,3 +417,156 @@ let y = 2
         raise AssertionError('Expected ValueError')
     except ValueError as e:
         assert 'out of range' in str(e)
+
+
+def test_collect_reqs_is_read_only():
+    iml = """\
+let double (x: int) : int = x * 2
+[@@decomp top ()]
+
+verify (fun x -> x > 0 ==> double x > x)
+
+instance (fun x -> double x = 4)
+"""
+    parser = get_parser()
+    tree = parser.parse(bytes(iml, encoding='utf8'))
+
+    extracted = collect_verify_reqs(iml, tree)
+    assert extracted.reqs == snapshot(
+        [{'src': 'fun x -> x > 0 ==> double x > x'}]
+    )
+    # The stripped code is only built on demand
+    assert 'stripped' not in vars(extracted)
+    assert collect_instance_reqs(iml, tree).reqs == snapshot(
+        [{'src': 'fun x -> double x = 4'}]
+    )
+    assert collect_decomp_reqs(iml, tree).reqs == snapshot(
+        [{'name': 'double', 'basis': [], 'rule_specs': [], 'prune': False}]
+    )
+
+    new_iml, new_tree = extracted.stripped
+    assert (new_iml, str(new_tree.root_node)) == (
+        extract_verify_reqs(iml, tree)[0],
+        str(extract_verify_reqs(iml, tree)[1].root_node),
+    )
+    assert 'verify' not in new_iml
+
+
+def test_edit_session_batches_edits():
+    iml = """\
+let f x = x + 1
+
+verify (fun x -> f x > x)
+
+let g x = x * 2
+
+verify (fun x -> g x >= x)\
+"""
+    parser = get_parser()
+    tree = parser.parse(bytes(iml, encoding='utf8'))
+    extracted = collect_verify_reqs(iml, tree)
+
+    session = EditSession(iml, tree)
+    session.delete_nodes(extracted.nodes)
+    stage_decomp_req(session, {'name': 'g', 'basis': ['f']})
+    stage_decomp_req(session, {'name': 'f', 'prune': True})
+    for req in extracted.reqs:
+        stage_verify_req(session, req['src'])
+    stage_instance_req(session, 'fun x -> g x = 4')
+    new_iml, new_tree = session.commit()
+
+    assert new_iml == snapshot("""\
+let f x = x + 1
+[@@decomp top ~prune:true ()]
+
+
+
+let g x = x * 2
+[@@decomp top ~basis:[[%id f]] ()]
+
+
+verify (fun x -> f x > x)
+verify (fun x -> g x >= x)
+instance (fun x -> g x = 4)
+""")
+    # The incremental parse agrees with a parse from scratch
+    assert str(new_tree.root_node) == str(
+        parser.parse(bytes(new_iml, encoding='utf8')).root_node
+    )
+    assert session.edited_tree is not None
+    assert session.edited_tree.changed_ranges(new_tree)
+
+
+def test_edit_session_rejects_overlaps():
+    iml = 'let f x = x + 1\n'
+    tree = get_parser().parse(bytes(iml, encoding='utf8'))
+
+    session = EditSession(iml, tree)
+    session.delete(0, 10)
+    session.insert(4, 'rec ')
+    with pytest.raises(ValueError, match='Overlapping edits'):
+        session.commit()
+
+    # Insertions at the boundary of a deletion are fine
+    session = EditSession(iml, tree)
+    session.replace(4, 5, 'g')
+    session.insert(4, 'rec ')
+    session.insert(0, '(* f *)\n')
+    new_iml, _ = session.commit()
+    assert new_iml == snapshot("""\
+(* f *)
+let rec g x = x + 1
+""")
+
+
+def test_edit_session_is_single_use():
+    iml = 'let f x = x + 1\n'
+    tree = get_parser().parse(bytes(iml, encoding='utf8'))
+    line_index = LineIndex(iml)
+
+    session = EditSession(iml, tree, line_index)
+    session.insert(0, '(* f *)\n')
+    new_iml, new_tree = session.commit()
+    with pytest.raises(ValueError, match='already committed'):
+        session.commit()
+    with pytest.raises(ValueError, match='already committed'):
+        session.insert(0, '(* g *)\n')
+    with pytest.raises(ValueError, match='already committed'):
+        session.insert_lines(['verify (fun x -> x = x)'], insert_after=0)
+    # The shared line index was updated once, for the committed edits only
+    assert line_index.line_starts == LineIndex(new_iml).line_starts
+
+    session = EditSession(new_iml, new_tree, line_index)
+    session.insert_lines(['verify (fun x -> x = x)'], insert_after=1)
+    newer_iml, _ = session.commit()
+    assert newer_iml == snapshot("""\
+(* f *)
+let f x = x + 1
+verify (fun x -> x = x)
+""")
+    assert line_index.line_starts == LineIndex(newer_iml).line_starts
+
+
+def test_delete_nodes_bytes_input():
+    iml = ''.join(
+        f'let f{i} x = x + {i}\nverify (fun x -> f{i} x > x)\n'
+        for i in range(50)
+    )
+    iml_b = bytes(iml, encoding='utf8')
+    tree = get_parser().parse(iml_b)
+    nodes = [
+        capture['verify'][0]
+        for _, capture in run_query(
+            mk_query(VERIFY_QUERY_SRC), node=tree.root_node
+        )
+    ]
+    assert len(nodes) == 50
+
+    new_iml_b, new_tree = delete_nodes(memoryview(iml_b), tree, nodes=nodes)
+    assert isinstance(new_iml_b, bytes)
+    assert new_iml_b.count(b'verify') == 0
+    assert new_iml_b.decode('utf8') == delete_nodes(iml, nodes=nodes)[0]
+    # The incremental parse agrees with a parse from scratch
+    assert str(new_tree.root_node) == str(
+        get_parser().parse(new_iml_b).root_node
+    )
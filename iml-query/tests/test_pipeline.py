@@ -0,0 +1,84 @@
+import threading
+from pathlib import Path
+
+import pytest
+
+from iml_query.pipeline import (
+    iter_paths,
+    outline_directory,
+    parse_sources,
+    prefetch,
+    read_sources,
+)
+from iml_query.processing import iml_outline
+from iml_query.tree_sitter_utils import clear_tree_cache, tree_cache_info
+
+
+def test_outline_directory(tmp_path: Path):
+    (tmp_path / 'sub').mkdir()
+    (tmp_path / 'b.iml').write_text('verify (fun x -> x = x)\n')
+    (tmp_path / 'a.iml').write_text('let f x = x\n[@@opaque]\n')
+    (tmp_path / 'sub' / 'c.iml').write_text('instance (fun x -> x > 0)\n')
+    (tmp_path / 'sub' / 'bad.iml').write_bytes(b'\xff\xfe')
+    (tmp_path / 'notes.txt').write_text('not iml')
+
+    paths = list(iter_paths(tmp_path))
+    assert [p.relative_to(tmp_path).as_posix() for p in paths] == [
+        'a.iml',
+        'b.iml',
+        'sub/bad.iml',
+        'sub/c.iml',
+    ]
+    assert len(list(iter_paths(tmp_path, recursive=False))) == 2
+
+    records = list(outline_directory(tmp_path))
+    assert [r.path for r in records] == paths
+    assert records[0].result == iml_outline('let f x = x\n[@@opaque]\n')
+    assert records[2].error is not None
+    assert records[2].error.startswith('UnicodeDecodeError')
+    assert records[3].result is not None
+    assert records[3].result['instance_req'] == [{'src': 'fun x -> x > 0'}]
+
+
+def test_parse_sources_streams(tmp_path: Path):
+    for i in range(5):
+        (tmp_path / f'{i}.iml').write_text(f'let f{i} x = x\n')
+
+    clear_tree_cache()
+    parsed = parse_sources(read_sources(iter_paths(tmp_path), prefetch_size=1))
+    first = next(parsed)
+    assert first.tree is not None
+    assert first.tree.root_node.child_count == 1
+    parsed.close()
+    # The trees are not kept by the tree cache
+    assert tree_cache_info().currsize == 0
+
+
+def test_prefetch_is_bounded_and_stops():
+    produced = 0
+    started = threading.Event()
+
+    def items():
+        nonlocal produced
+        for i in range(1000):
+            produced += 1
+            started.set()
+            yield i
+
+    it = prefetch(items(), size=2)
+    assert next(it) == 0
+    started.wait()
+    assert produced <= 4
+    it.close()
+    assert produced <= 4
+
+
+def test_prefetch_forwards_errors():
+    def items():
+        yield 1
+        raise ValueError('boom')
+
+    it = prefetch(items())
+    assert next(it) == 1
+    with pytest.raises(ValueError, match='boom'):
+        next(it)
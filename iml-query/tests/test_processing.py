@@ -1,4 +1,3 @@
-import pytest
 from inline_snapshot import snapshot
 
 from iml_query.processing import (
@@ -6,8 +5,10 @@ from iml_query.processing import (
     extract_decomp_reqs,
     extract_instance_reqs,
     extract_opaque_function_names,
+    extract_verify_reqs,
     find_nested_rec,
     iml_outline,
+    insert_decomp_req,
     insert_instance_req,
     instance_capture_to_req,
     verify_capture_to_req,
@@ -19,7 +20,7 @@ from iml_query.queries import (
     InstanceCapture,
     VerifyCapture,
 )
-from iml_query.tree_sitter_utils import get_parser, mk_query, run_query
+from iml_query.tree_sitter_utils import get_parser, mk_query, parse, run_query
 
 
 def test_verify_node_to_req():
@@ -278,6 +279,10 @@ instance positive_predicate\
                 },
             ],
             'opaque_function': ['expensive_computation', 'external_api_call'],
+            'eval_req': [],
+            'theorem': [],
+            'lemma': [],
+            'axiom': [],
         }
     )
 
@@ -328,7 +333,6 @@ let context_sensitive x y z =
     )
 
 
-@pytest.mark.xfail
 def test_composition_operator_decomp_parsing():
     """Test detailed parsing of complex decomp examples from decomp_eg2.iml."""
     iml = """\
@@ -352,7 +356,111 @@ let infeasible_branches x =
 
     parser = get_parser()
     tree = parser.parse(bytes(iml, encoding='utf8'))
-    _, _, _decomp_reqs = extract_decomp_reqs(iml, tree)
+    _, _, decomp_reqs = extract_decomp_reqs(iml, tree)
+    assert decomp_reqs[1] == snapshot(
+        {
+            'name': 'infeasible_branches',
+            'composition': {
+                'op': '|>>',
+                'args': [
+                    {'basis': [], 'rule_specs': [], 'prune': False},
+                    'prune',
+                ],
+            },
+        }
+    )
+
+
+def test_decomp_composition_round_trip():
+    iml = """\
+let base_function x = x mod 3
+
+let merged = base_function
+[@@decomp top ~basis:[[%id base_function]] () << top () [%id base_function]]
+
+let redundant_regions x = if x > 0 then 1 else 1
+[@@decomp ~| (top ~prune:true ())]
+
+let nested x = x + 1
+[@@decomp (top () <|< top () [%id base_function]) |>> prune]
+
+let assumed x = x - 1
+[@@decomp (top ~assuming:[%id p] ~lift_bool:Equalities ()) |>> prune]
+"""
+    tree = get_parser().parse(bytes(iml, encoding='utf8'))
+    iml2, tree2, decomp_reqs = extract_decomp_reqs(iml, tree)
+    assert decomp_reqs == snapshot(
+        [
+            {
+                'name': 'merged',
+                'composition': {
+                    'op': '<<',
+                    'args': [
+                        {
+                            'basis': ['base_function'],
+                            'rule_specs': [],
+                            'prune': False,
+                        },
+                        {
+                            'basis': [],
+                            'rule_specs': [],
+                            'prune': False,
+                            'target': 'base_function',
+                        },
+                    ],
+                },
+            },
+            {
+                'name': 'redundant_regions',
+                'composition': {
+                    'op': '~|',
+                    'args': [{'basis': [], 'rule_specs': [], 'prune': True}],
+                },
+            },
+            {
+                'name': 'nested',
+                'composition': {
+                    'op': '|>>',
+                    'args': [
+                        {
+                            'op': '<|<',
+                            'args': [
+                                {'basis': [], 'rule_specs': [], 'prune': False},
+                                {
+                                    'basis': [],
+                                    'rule_specs': [],
+                                    'prune': False,
+                                    'target': 'base_function',
+                                },
+                            ],
+                        },
+                        'prune',
+                    ],
+                },
+            },
+            {
+                'name': 'assumed',
+                'composition': {
+                    'op': '|>>',
+                    'args': [
+                        {
+                            'basis': [],
+                            'rule_specs': [],
+                            'prune': False,
+                            'assuming': 'p',
+                            'lift_bool': 'Equalities',
+                        },
+                        'prune',
+                    ],
+                },
+            },
+        ]
+    )
+
+    for req in decomp_reqs:
+        iml2, tree2 = insert_decomp_req(iml2, tree2, req)
+    _, _, decomp_reqs2 = extract_decomp_reqs(iml2, tree2)
+    assert decomp_reqs2 == decomp_reqs
 
 
 def test_mixed_requests_extraction():
@@ -466,3 +574,101 @@ let rec normal_rec x =
             },
         ]
     )
+
+
+def test_iml_outline_statements():
+    """Test iml_outline on eval statements, theorems, lemmas and axioms."""
+    iml = """\
+let double x = x * 2
+
+axiom double_pos x = x > 0 ==> double x > 0
+
+theorem double_ge x = x >= 0 ==> double x >= x
+[@@by auto]
+
+lemma double_zero = double 0 = 0
+
+eval (double 21)
+
+verify (fun x -> double x = x + x)\
+"""
+    parser = get_parser()
+    tree = parser.parse(bytes(iml, encoding='utf8'))
+    outline = iml_outline(iml, tree)
+    assert outline == snapshot(
+        {
+            'verify_req': [{'src': 'fun x -> double x = x + x'}],
+            'instance_req': [],
+            'decompose_req': [],
+            'opaque_function': [],
+            'eval_req': [{'src': 'double 21'}],
+            'theorem': [
+                {
+                    'name': 'double_ge',
+                    'src': """\
+theorem double_ge x = x >= 0 ==> double x >= x
+[@@by auto]\
+""",
+                }
+            ],
+            'lemma': [
+                {
+                    'name': 'double_zero',
+                    'src': 'lemma double_zero = double 0 = 0',
+                }
+            ],
+            'axiom': [
+                {
+                    'name': 'double_pos',
+                    'src': 'axiom double_pos x = x > 0 ==> double x > 0',
+                }
+            ],
+        }
+    )
+
+
+def test_extract_reqs_in_range():
+    iml = """\
+let f x = x + 1
+[@@decomp top ()]
+
+let g x = x - 1
+[@@decomp top ~prune:true ()]
+
+verify (fun x -> g x < x)
+"""
+    tree = get_parser().parse(iml.encode('utf-8'))
+    g = tree.root_node.child(1)
+    assert g is not None
+
+    _, _, reqs = extract_decomp_reqs(
+        iml, tree, byte_range=(g.start_byte, g.end_byte)
+    )
+    assert [req['name'] for req in reqs] == ['g']
+    outline = iml_outline(iml, tree, point_range=(g.start_point, g.end_point))
+    assert [req['name'] for req in outline['decompose_req']] == ['g']
+    assert outline['verify_req'] == []
+
+
+def test_bytes_source_end_to_end():
+    iml = """\
+let f x = x + 1
+[@@decomp top ()]
+
+verify (fun x -> f x > x)
+"""
+    src = iml.encode('utf-8')
+    tree = parse(memoryview(src))
+    assert iml_outline(memoryview(src), tree) == iml_outline(iml)
+
+    new_src, new_tree, reqs = extract_verify_reqs(src, tree)
+    assert isinstance(new_src, bytes)
+    assert reqs == [{'src': 'fun x -> f x > x'}]
+    assert new_src.decode('utf-8') == extract_verify_reqs(iml, tree)[0]
+
+    new_src, new_tree = insert_instance_req(
+        new_src, new_tree, 'fun x -> f x = 2'
+    )
+    assert isinstance(new_src, bytes)
+    assert new_src.endswith(b'instance (fun x -> f x = 2)\n')
+    assert not new_tree.root_node.has_error
@@ -1,10 +1,17 @@
+from dataclasses import dataclass
+
 from inline_snapshot import snapshot
 from rich.pretty import Pretty
+from tree_sitter import Node
 
 from iml_query.processing import find_nested_measures
 from iml_query.queries import (
     DECOMP_QUERY_SRC,
+    OPAQUE_QUERY_SRC,
     VERIFY_QUERY_SRC,
+    BaseCapture,
+    DecompCapture,
+    OpaqueCapture,
 )
 from iml_query.tree_sitter_utils import (
     get_parser,
@@ -98,6 +105,38 @@ end_point=(31, 43)>
 """)  # noqa: E501
 
 
+def test_find_nested_measures_many_functions():
+    chunks: list[str] = []
+    for i in range(50):
+        if i % 3 == 0:
+            chunks.append(
+                f'let top{i} x =\n'
+                f'  let rec go{i} y =\n'
+                f'    if y <= 0 then 0 else go{i} (y - 1)\n'
+                f'  [@@measure Ordinal.of_int y]\n'
+                f'  in\n'
+                f'  go{i} x\n'
+            )
+        else:
+            chunks.append(
+                f'let top{i} x = x + {i}\n[@@measure Ordinal.of_int 1]\n'
+            )
+    tree = get_parser().parse('\n'.join(chunks).encode('utf8'))
+    problematic_funcs = find_nested_measures(tree.root_node)
+
+    assert [
+        (
+            f['top_level_function_name'],
+            [(m['function_name'], m['level']) for m in f['nested_measures']],
+        )
+        for f in problematic_funcs
+    ] == [(f'top{i}', [(f'go{i}', 1)]) for i in range(0, 50, 3)]
+    for f in problematic_funcs:
+        for m in f['nested_measures']:
+            assert f['node'].start_byte <= m['node'].start_byte
+            assert m['node'].end_byte <= f['node'].end_byte
+
+
 def test_complex_decomp_with_composition():
     """Test complex decomp parsing with composition operators."""
     iml = """\
@@ -176,3 +215,40 @@ def test_edge_cases_empty_content():
         mk_query(VERIFY_QUERY_SRC), node=tree_simple.root_node
     )
     assert len(matches_simple) == 0
+
+
+def test_capture_from_match():
+    iml = """\
+let f x = x
+[@@opaque]
+[@@decomp top ()]
+"""
+    root = get_parser().parse(iml.encode('utf-8')).root_node
+    (_, match), *_ = run_query(mk_query(DECOMP_QUERY_SRC), node=root)
+    decomp = DecompCapture.from_ts_capture(match)
+    assert unwrap_bytes(decomp.decomposed_func_name.text) == b'f'
+    assert decomp.decomp_payload.type == 'attribute_payload'
+
+    # Extra captures are ignored
+    (_, opaque_match), *_ = run_query(mk_query(OPAQUE_QUERY_SRC), node=root)
+    opaque = OpaqueCapture.from_ts_capture(opaque_match | match)
+    assert unwrap_bytes(opaque.function_name.text) == b'f'
+
+
+def test_capture_subclass_fields():
+    @dataclass(slots=True, frozen=True)
+    class ItemCapture(BaseCapture):
+        item: Node
+
+    @dataclass(slots=True, frozen=True)
+    class NamedItemCapture(ItemCapture):
+        name: Node
+
+    root = get_parser().parse(b'let f x = x').root_node
+    item = root.children[0]
+    name = item.children[1]
+    # Fields of the base class come first, as in the constructor
+    capture = NamedItemCapture.from_ts_capture(
+        {'name': [name], 'item': [item], 'other': [root]}
+    )
+    assert (capture.item, capture.name) == (item, name)
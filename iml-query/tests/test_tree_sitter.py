@@ -1,13 +1,28 @@
 # pyright: basic
+import threading
+
 from inline_snapshot import snapshot
+from tree_sitter import Parser
 
+from iml_query.queries import VALUE_DEFINITION_QUERY_SRC
 from iml_query.tree_sitter_utils import (
+    QueryCache,
+    SourceText,
+    TreeCache,
+    clear_query_cache,
+    clear_tree_cache,
+    get_language,
     get_nesting_relationship,
     get_parser,
     mk_query,
+    parse,
+    query_cache_info,
+    run_queries,
     run_query,
+    tree_cache_info,
     unwrap_bytes,
 )
+from iml_query.workload import generate_iml
 
 
 def test_get_nesting_relationship():
@@ -101,3 +116,218 @@ let top_level_function x = x + 1
             },
         }
     )
+
+
+def test_mk_query_cache():
+    """Built-in queries compile once; other queries go through the LRU."""
+    clear_query_cache()
+
+    q1 = mk_query(VALUE_DEFINITION_QUERY_SRC)
+    q2 = mk_query(VALUE_DEFINITION_QUERY_SRC)
+    assert q1 is q2
+    assert mk_query(VALUE_DEFINITION_QUERY_SRC, ocaml=True) is not q1
+
+    adhoc_src = '(value_definition) @def'
+    assert mk_query(adhoc_src) is mk_query(adhoc_src)
+
+    info = query_cache_info()
+    assert (info.hits, info.misses) == (2, 3)
+    assert (info.currsize, info.pinned) == (1, 2)
+
+
+def test_query_cache_lru_eviction():
+    language = get_language()
+    cache = QueryCache(maxsize=2)
+
+    q_a = cache.get(language, '(verify_statement) @a')
+    cache.get(language, '(instance_statement) @b')
+    # Touch `a` so that `b` becomes the least recently used entry
+    assert cache.get(language, '(verify_statement) @a') is q_a
+    cache.get(language, '(eval_statement) @c')
+
+    assert cache.info().currsize == 2
+    assert cache.get(language, '(verify_statement) @a') is q_a
+    assert cache.info().misses == 3
+    cache.get(language, '(instance_statement) @b')
+    assert cache.info().misses == 4
+
+    pinned = cache.get(language, '(lemma_definition) @d', pin=True)
+    for src in ['(axiom_definition) @e', '(theorem_definition) @f']:
+        cache.get(language, src)
+    assert cache.get(language, '(lemma_definition) @d') is pinned
+
+
+def test_parser_pool_is_per_thread():
+    parser = get_parser()
+    assert get_parser() is parser
+    assert get_parser(ocaml=True) is not parser
+    assert get_parser(ocaml=True).language == get_language(ocaml=True)
+
+    other: list[Parser] = []
+    thread = threading.Thread(target=lambda: other.append(get_parser()))
+    thread.start()
+    thread.join()
+    assert other[0] is not parser
+
+
+def test_parse_tree_cache():
+    clear_tree_cache()
+    iml = 'let f x = x + 1\n'
+    tree = parse(iml)
+    tree.edit(
+        start_byte=0,
+        old_end_byte=3,
+        new_end_byte=0,
+        start_point=(0, 0),
+        old_end_point=(0, 3),
+        new_end_point=(0, 0),
+    )
+    again = parse(iml.encode())
+    # Edits to a returned tree do not leak into the cache
+    assert not again.root_node.has_changes
+    assert str(again.root_node) == str(
+        get_parser().parse(iml.encode()).root_node
+    )
+    assert parse(iml, ocaml=True).language == get_language(ocaml=True)
+    info = tree_cache_info()
+    assert (info.hits, info.misses, info.currsize) == (1, 2, 2)
+
+
+def test_tree_cache_byte_budget():
+    cache = TreeCache(max_bytes=10)
+    language = get_language()
+    srcs = [b'let a = 1', b'let b = 2', b'let c = 3']
+    for src in srcs:
+        cache.put(TreeCache.key(language, src), get_parser().parse(src), 5)
+    assert cache.info().currsize == 2
+    assert cache.get(TreeCache.key(language, srcs[0])) is None
+    assert cache.get(TreeCache.key(language, srcs[2])) is not None
+    # A tree larger than the budget is not cached
+    big = b'let d = 4'
+    cache.put(TreeCache.key(language, big), get_parser().parse(big), 11)
+    assert cache.info().currbytes == 10
+
+
+def test_tree_cache_charges_tree_size():
+    clear_tree_cache()
+    iml = 'let f x = x + 1\n'
+    tree = parse(iml)
+    assert tree_cache_info().currbytes == TreeCache.tree_size(tree) > len(iml)
+    # Trees parsed without the cache are not kept
+    parse('let g y = y\n', cache=False)
+    assert tree_cache_info().currsize == 1
+
+
+def test_run_query_limits():
+    iml = generate_iml(target_bytes=300_000)
+    root = parse(iml).root_node
+    query = mk_query(VALUE_DEFINITION_QUERY_SRC)
+    expected = run_query(query, node=root)
+    assert expected.truncated is None
+
+    # Querying range by range gives the same matches, each once
+    progress: list[int] = []
+    batched = run_query(
+        query,
+        node=root,
+        timeout=60,
+        progress_callback=lambda done, _: bool(progress.append(done)),
+    )
+    assert batched.truncated is None
+    assert len(progress) > 1
+    assert [(i, c['function_definition'][0].id) for i, c in batched] == [
+        (i, c['function_definition'][0].id) for i, c in expected
+    ]
+
+    cancelled = run_query(
+        query, node=root, progress_callback=lambda done, _: done > 0
+    )
+    assert cancelled.truncated == 'cancelled'
+    assert 0 < len(cancelled) < len(expected)
+
+    timed_out = run_query(query, node=root, timeout=1e-9)
+    assert timed_out.truncated == 'timeout'
+    assert len(timed_out) < len(expected)
+
+    capped = run_query(query, node=root, max_matches=10)
+    assert capped.truncated == 'max_matches'
+    assert capped == expected[:10]
+
+    limited = run_queries(
+        {'def': VALUE_DEFINITION_QUERY_SRC}, root, match_limit=1
+    )
+    assert limited.truncated == 'match_limit'
+
+
+def test_run_query_limits_within_item():
+    # A single definition much larger than the ranges queried at once
+    iml = 'let big x =\n' + ''.join(
+        f'  let v{i} = x + {i} in\n' for i in range(10_000)
+    )
+    root = parse(iml + '  x\n').root_node
+    assert root.child_count == 1
+    query = mk_query(VALUE_DEFINITION_QUERY_SRC)
+    expected = run_query(query, node=root)
+
+    batched = run_query(query, node=root, timeout=60)
+    assert batched == expected
+
+    cancelled = run_query(
+        query, node=root, progress_callback=lambda done, _: done > 0
+    )
+    assert cancelled.truncated == 'cancelled'
+    assert 0 < len(cancelled) < len(expected)
+
+    capped = run_query(query, node=root, max_matches=3)
+    assert capped.truncated == 'max_matches'
+    assert capped == expected[:3]
+
+
+def test_run_query_ranges():
+    iml = generate_iml(target_bytes=200_000)
+    root = parse(iml).root_node
+    query = mk_query(VALUE_DEFINITION_QUERY_SRC)
+    everything = run_query(query, node=root)
+
+    item = root.child(root.child_count // 2)
+    assert item is not None
+    start, end = item.start_byte, item.end_byte + 1000
+
+    def intersecting(matches):
+        return [
+            c['function_definition'][0].id
+            for _, c in matches
+            if c['function_definition'][0].start_byte < end
+            and c['function_definition'][0].end_byte > start
+        ]
+
+    expected = intersecting(everything)
+    assert expected
+    by_bytes = run_query(query, node=root, byte_range=(start, end))
+    assert (
+        intersecting(by_bytes)
+        == expected
+        == [c['function_definition'][0].id for _, c in by_bytes]
+    )
+    # Batched runs honour the range as well
+    batched = run_query(query, node=root, byte_range=(start, end), timeout=60)
+    assert [c['function_definition'][0].id for _, c in batched] == expected
+
+    by_points = run_query(
+        query, node=root, point_range=(item.start_point, item.end_point)
+    )
+    assert by_points
+    assert all(
+        c['function_definition'][0].start_point <= item.end_point
+        for _, c in by_points
+    )
+
+
+def test_source_text():
+    src = 'let é = "ü"\n'.encode()
+    tree = parse(src)
+    source = SourceText(src)
+    for node in (tree.root_node, tree.root_node.child(0)):
+        assert node is not None
+        assert source.view(node) == node.text
+        assert source.text(node) == unwrap_bytes(node.text).decode('utf-8')
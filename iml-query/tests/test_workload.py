@@ -0,0 +1,48 @@
+from pathlib import Path
+
+from iml_query.processing import find_nested_measures, iml_outline
+from iml_query.tree_sitter_utils import get_parser
+from iml_query.workload import (
+    WorkloadSpec,
+    generate_iml,
+    iter_iml,
+    write_iml,
+)
+
+
+def test_generate_iml_parses_cleanly():
+    spec = WorkloadSpec(
+        definitions=200,
+        max_let_depth=5,
+        let_rec_ratio=0.4,
+        nested_rec_ratio=0.5,
+        string_ratio=0.5,
+        verify_ratio=0.5,
+    )
+    for seed in range(3):
+        iml = generate_iml(spec, seed=seed)
+        tree = get_parser().parse(iml.encode('utf-8'))
+        assert not tree.root_node.has_error
+
+    iml = generate_iml(spec, seed=2)
+    assert generate_iml(spec, seed=2) == iml
+    assert generate_iml(spec, seed=1) != iml
+
+    tree = get_parser().parse(iml.encode('utf-8'))
+    outline = iml_outline(iml, tree)
+    assert outline['verify_req']
+    assert outline['instance_req']
+    assert outline['decompose_req']
+    assert outline['opaque_function']
+    assert outline['eval_req']
+    assert find_nested_measures(tree.root_node)
+
+
+def test_generate_iml_target_size(tmp_path: Path):
+    chunks = list(iter_iml(target_bytes=10_000))
+    size = sum(len(c) for c in chunks)
+    assert 10_000 <= size < 10_000 + max(len(c) for c in chunks)
+
+    path = tmp_path / 'big.iml'
+    assert write_iml(path, target_bytes=10_000) == size
+    assert path.read_text() == ''.join(chunks)